@@ -188,7 +188,7 @@
    //! @{
    // write here the action to associate to each USB event
    // be carefull not to waste time in order not disturbing the functions
-#define Usb_sof_action()
+#define Usb_sof_action()         sof_action();
 #define Usb_wake_up_action()
 #define Usb_resume_action()
 #define Usb_suspend_action()     suspend_action();
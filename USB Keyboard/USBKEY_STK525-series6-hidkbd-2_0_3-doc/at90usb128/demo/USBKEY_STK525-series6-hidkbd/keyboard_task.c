@@ -60,8 +60,94 @@
 // E.g: if we read SLEEP_KEY, we read next_key and sleep (next_key * SLEEP_MS)
 #define SLEEP_KEY 249
 #define SLEEP_MS 100
-const U8 code usb_keys[] = {HID_ENTER, SLEEP_KEY, 30, ESCAPE_KEY_START + 1, HID_MODIFIER_LEFT_GUI, HID_R, SLEEP_KEY, 5, HID_N, HID_O, HID_T, HID_E, HID_P, HID_A, HID_D, SLEEP_KEY, 5, HID_ENTER, SLEEP_KEY, 27, HID_CAPS_LOCK, HID_H, HID_CAPS_LOCK, HID_E, HID_L, HID_L, HID_O, HID_SPACEBAR, HID_CAPS_LOCK, HID_W, HID_CAPS_LOCK, HID_O, HID_R, HID_L, HID_D, ESCAPE_KEY_START + 1, HID_MODIFIER_LEFT_SHIFT, HID_1, HID_ENTER};
-#define SIZEOF_USB_KEYS     (Uint16)sizeof(usb_keys)
+// this key waits for the number of ms that follows it. The ms are a varint:
+// 7 bits per byte, least significant first, the top bit is set in every
+// byte but the last (up to 5 bytes for 32 bits).
+#define DELAY_KEY 247
+// this key repeats the block of keys right before it.
+// It is followed by the number of repetitions and the length of the block,
+// both 16 bit little endian:
+// REPEAT_KEY, count_lo, count_hi, length_lo, length_hi
+// With compressed keys the length is the number of flash bytes to rewind.
+#define REPEAT_KEY 250
+#define REPEAT_HEADER_SIZE 5
+// this key types a run of keys using the 6 keycodes of a report.
+// It is followed by the modifier, the number of keys n and the n keys:
+// REPORT_KEY, modifier, n, key_1, ..., key_n
+// Every report presses the next key of the run while the (up to 5) keys
+// before it are still held, so no empty report is sent between the keys.
+// A single release report follows the last key. A key must not appear twice
+// within REPORT_ROLLOVER + 1 consecutive keys of a run as it would still be
+// held.
+#define REPORT_KEY 248
+#define REPORT_ROLLOVER 6
+// this key types the ASCII characters that follow it. It is followed by the
+// number of characters n and the n characters:
+// STRING_KEY, n, char_1, ..., char_n
+// The keys of every character are looked up in ascii_keys, each character
+// is pressed and released like a single key.
+#define STRING_KEY 246
+// set in the ascii_keys entries of characters that are typed with shift
+#define ASCII_SHIFT 0x80
+// this key types a block of keys stored earlier again, like a subroutine.
+// It is followed by the distance back from the CALL_KEY to the start of the
+// block and the length of the block, both 16 bit little endian:
+// CALL_KEY, back_lo, back_hi, length_lo, length_hi
+// The block returns once length bytes of it were read. It may call other
+// blocks, up to MAX_CALL_DEPTH deep, but never contains a REPEAT_KEY.
+// With compressed keys back and length count flash bytes.
+#define CALL_KEY 245
+#define CALL_SIZE 5
+#define MAX_CALL_DEPTH 4
+// usb_keys starts with a header so that the keys of a built .hex can be
+// replaced without recompiling (see payload.py and intel_hex.py):
+// 8 byte magic, 16 bit capacity (little endian), number of payloads n,
+// then an index entry per payload: 16 bit offset of its keys in usb_keys,
+// 16 bit length, flags. The keys of the payloads follow the index.
+#define USB_KEYS_COUNT_OFFSET 10
+#define USB_KEYS_HEADER_SIZE 11
+#define USB_KEYS_ENTRY_SIZE 5
+// usb_keys starts at a flash page and is padded to whole pages (SPM_PAGESIZE
+// bytes), so replacing its payloads only rewrites its own pages and
+// delta_flash.py can flash just those
+#define USB_KEYS_PAGE_SIZE 256
+#ifdef __GNUC__
+#define USB_KEYS_ALIGN __attribute__((aligned(USB_KEYS_PAGE_SIZE)))
+#else
+#define USB_KEYS_ALIGN
+#endif
+// the button held when the board is plugged in selects the payload that is
+// typed: none the first one, north, east, south and west the next ones.
+// Once it was typed the center button types it again and a direction types
+// the payload of that direction.
+#define MAX_PAYLOADS 5
+#define BUTTON_NONE 0
+#define BUTTON_NORTH 1
+#define BUTTON_EAST 2
+#define BUTTON_SOUTH 3
+#define BUTTON_WEST 4
+#define BUTTON_CENTER 5
+// the buttons of the LaFortuna pull their pin low: the directions are on
+// PC2 to PC5, the center button on PE7
+#define BUTTON_DIRECTIONS ((1<<PC2)|(1<<PC3)|(1<<PC4)|(1<<PC5))
+// with this flag the keys are compressed (see compress.py) into tokens:
+// control < LZ_MATCH: the next control + 1 bytes are keys
+// control >= LZ_MATCH, offset_lo, offset_hi: the next
+// (control - LZ_MATCH + LZ_MIN_MATCH) keys are read from the keys of the
+// payload at offset. The length in the index is the length of the
+// compressed keys.
+#define USB_KEYS_COMPRESSED 0x01
+#define LZ_MATCH 0x80
+#define LZ_MIN_MATCH 6
+// the first key is typed once the device has been enumerated for this many
+// ms, which gives the host time to load its HID driver. Measure the time the
+// target host needs (python simulator.py --settle-ms shows the effect) and
+// raise it for slow hosts.
+#define ENUMERATION_SETTLE_MS 1000
+const U8 code usb_keys[] USB_KEYS_ALIGN = {'D', 'u', 'c', 'k', 'y', 'P', 'L', '3', 0xf5, 0x00, 0x01, 0x10, 0x00, 0x2b, 0x00, 0x00, 40, 247, 184, 23, 252, 8, 21, 247, 244, 3, 17, 18, 23, 8, 19, 4, 7, 247, 244, 3, 40, 247, 190, 21, 252, 2, 11, 8, 15, 15, 18, 44, 252, 2, 26, 18, 21, 15, 7, 252, 2, 30, 40, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0};
+// keycode (| ASCII_SHIFT) of every ASCII character, generated from
+// hid_keys.CHARACTERS by rubber_ducky_to_hex.py
+const U8 code ascii_keys[] = {0, 0, 0, 0, 0, 0, 0, 0, 0, 43, 40, 0, 0, 40, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 44, 158, 180, 160, 161, 162, 164, 52, 166, 167, 85, 87, 54, 86, 55, 84, 39, 30, 31, 32, 33, 34, 35, 36, 37, 38, 179, 51, 182, 103, 183, 184, 159, 132, 133, 134, 135, 136, 137, 138, 139, 140, 141, 142, 143, 144, 145, 146, 147, 148, 149, 150, 151, 152, 153, 154, 155, 156, 157, 47, 49, 48, 163, 173, 53, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 175, 177, 176, 181, 0};
 #define myabs(n)  ((n) < 0 ? -(n) : (n))
 //_____ D E C L A R A T I O N S ____________________________________________
 volatile U8    cpt_sof;
@@ -72,11 +158,59 @@ U8    usb_kbd_state;
 U16   usb_data_to_send;
 #ifdef __GNUC__
 PGM_VOID_P     usb_key_pointer;
+PGM_VOID_P     match_pointer;
+PGM_VOID_P     payload_pointer;
 #else
 U8   code *    usb_key_pointer;
+U8   code *    match_pointer;
+U8   code *    payload_pointer;
+#endif
+// the payload that is typed and the button held the last time they were read
+U8 selectedPayload = 0;
+U8 lastButton = BUTTON_NONE;
+// state of the decompressor
+bool compressed = false;
+U8 literalLeft = 0;
+U8 matchLeft = 0;
+// state of the REPORT_KEY run being typed
+bool packing = false;
+U8 packedModifier = HID_MODIFIER_NONE;
+U8 packedLength = 0;
+U8 packedIndex = 0;
+// the keys of the run that are held, in the order they were pressed
+U8 packedWindow[REPORT_ROLLOVER];
+U8 packedHeld = 0;
+// characters of the STRING_KEY run being typed that were not read yet
+U8 stringLeft = 0;
+// where to carry on after the CALL_KEY blocks being typed
+U8 callDepth = 0;
+#ifdef __GNUC__
+PGM_VOID_P     callPointers[MAX_CALL_DEPTH];
+#else
+U8   code *    callPointers[MAX_CALL_DEPTH];
 #endif
+U16 callLeft[MAX_CALL_DEPTH];
+// delays are timed with the start of frame the host sends every ms, so the
+// scheduler keeps running (and USB keeps being serviced) while waiting.
+// cpt_sof is incremented by sof_action, the ms still to wait are in delayLeft
+U32 delayLeft = 0;
+U8 lastSof = 0;
+bool settled = false;
 void process_key(void);
 void sendNothing(void);
+U8 read_flash_key(void);
+U8 read_usb_key(void);
+U32 read_varint(void);
+void start_delay(U32 ms);
+bool delaying(void);
+void repeat_block(void);
+void call_block(void);
+void start_packed_report(void);
+void send_packed_report(void);
+void next_string_key(void);
+U8 held_button(void);
+U8 pressed_button(void);
+void start_payload(U8 index);
 //! This function initializes the hardware/software ressources required for keyboard task.
 //!
 void keyboard_task_init(void)
@@ -87,6 +221,25 @@ void keyboard_task_init(void)
   usb_kbd_state     = 0;
   // Joy_init();
   cpt_sof           = 0;
+  delayLeft         = 0;
+  settled           = false;
+  Usb_enable_sof_interrupt();
+  // inputs with pull ups
+  DDRC &= ~BUTTON_DIRECTIONS;
+  PORTC |= BUTTON_DIRECTIONS;
+  DDRE &= ~(1<<PE7);
+  PORTE |= (1<<PE7);
+  // let the pull ups charge the pins
+  _delay_us(10);
+  lastButton = held_button();
+  if (lastButton != BUTTON_CENTER) {
+    selectedPayload = lastButton;
+  }
+}
+//! Counts the start of frames, called by the USB interrupt every ms
+void sof_action(void)
+{
+  cpt_sof++;
 }
 //! @brief Entry point of the mouse management
 //! This function links the mouse and the USB bus.
@@ -95,6 +248,13 @@ void keyboard_task(void)
 {
   if(Is_device_enumerated())
   {
+    if (!settled) {
+      settled = true;
+      start_delay(ENUMERATION_SETTLE_MS);
+    }
+    if (delaying()) {
+      return;
+    }
     // if USB ready to transmit new data :
     //        - if last time = 0, nothing
     //        - if key pressed -> transmit key
@@ -108,6 +268,11 @@ void keyboard_task(void)
       Usb_select_endpoint(EP_KBD_IN);
       if(Is_usb_write_enabled())
       {
+        if (packing)
+        {
+          send_packed_report();
+          return;
+        }
         if ( transmit_no_key==FALSE)
         {
           process_key();
@@ -142,6 +307,11 @@ void keyboard_task(void)
       }
     }
   }
+  else
+  {
+    // settle again when the host enumerates the device again
+    settled = false;
+  }
 }
 void sendNothing(void) {
   key_hit = FALSE;
@@ -167,13 +337,9 @@ void process_key(void) {
   transmit_no_key = TRUE;
   // if we have to sleep
   if (shouldSleep) {
-    // sleep SLEEP_MS * current read key value
-    // avr requires sleeping a compile-time constant int value. so loop
-    // `usb_key` times
-    // https://www.avrfreaks.net/forum/error-1-builtinavrdelaycycles-expects-integer-constant
-    for (int i = 0; i < usb_key; i++) {
-      _delay_ms(SLEEP_MS);
-    }
+    // sleep SLEEP_MS * current read key value, the empty report is sent
+    // once the delay is over
+    start_delay((U32)usb_key * SLEEP_MS);
     shouldSleep = false;
     return;
   } else if (usb_key == SLEEP_KEY) {
@@ -219,46 +385,285 @@ void process_key(void) {
   }
 }
 bool isFirstMessage = true;
-int keysCounter = 0;
-int firstNKeys = 4;
+bool repeating = false;
+U16 repeatsLeft = 0;
+//! Reads the next byte of usb_keys
+U8 read_flash_key(void)
+{
+  usb_data_to_send --;
+#ifndef __GNUC__
+  return *usb_key_pointer++;
+#else
+  return pgm_read_byte_near(usb_key_pointer++);
+#endif
+}
+//! Reads the next key, decompressing the keys if they are compressed.
+//! Matches are copied from usb_keys itself so no RAM buffer is needed.
+U8 read_usb_key(void)
+{
+  U8 control;
+  if (!compressed) {
+    return read_flash_key();
+  }
+  if (literalLeft == 0 && matchLeft == 0) {
+    control = read_flash_key();
+    if (control >= LZ_MATCH) {
+      U16 offset = read_flash_key();
+      offset |= (U16)read_flash_key() << 8;
+      matchLeft = control - LZ_MATCH + LZ_MIN_MATCH;
+      match_pointer = payload_pointer + offset;
+    } else {
+      literalLeft = control + 1;
+    }
+  }
+  if (matchLeft != 0) {
+    matchLeft--;
+#ifndef __GNUC__
+    return *match_pointer++;
+#else
+    return pgm_read_byte_near(match_pointer++);
+#endif
+  }
+  literalLeft--;
+  return read_flash_key();
+}
+//! Reads a varint operand
+U32 read_varint(void)
+{
+  U32 value = 0;
+  U8 shift = 0;
+  U8 key;
+  do {
+    key = read_usb_key();
+    value |= (U32)(key & 0x7F) << shift;
+    shift += 7;
+  } while (key & 0x80);
+  return value;
+}
+// Starts waiting ms before the next report is sent
+void start_delay(U32 ms)
+{
+  lastSof = cpt_sof;
+  delayLeft = ms;
+}
+// Returns TRUE while a delay started by start_delay is running. cpt_sof wraps
+// every 256 ms, which is fine as long as this is called more often than that
+// - it is called on every pass of the scheduler.
+bool delaying(void)
+{
+  U8 now = cpt_sof;
+  U8 elapsed = now - lastSof;
+  lastSof = now;
+  if (elapsed >= delayLeft) {
+    delayLeft = 0;
+    return FALSE;
+  }
+  delayLeft -= elapsed;
+  return TRUE;
+}
+//! Returns the BUTTON_ that is held, BUTTON_NONE if none is
+U8 held_button(void)
+{
+  U8 pins = ~PINC;
+  if (pins & (1<<PC2)) return BUTTON_NORTH;
+  if (pins & (1<<PC3)) return BUTTON_EAST;
+  if (pins & (1<<PC4)) return BUTTON_SOUTH;
+  if (pins & (1<<PC5)) return BUTTON_WEST;
+  if (!(PINE & (1<<PE7))) return BUTTON_CENTER;
+  return BUTTON_NONE;
+}
+//! Returns the BUTTON_ that was pressed since the last call, BUTTON_NONE if
+//! none was. Holding a button presses it once.
+U8 pressed_button(void)
+{
+  U8 held = held_button();
+  U8 pressed = held != lastButton ? held : BUTTON_NONE;
+  lastButton = held;
+  return pressed;
+}
+// This function starts typing the payload at index of the usb_keys index.
+// Nothing is typed if there is no such payload.
+void start_payload(U8 index)
+{
+  usb_key_pointer = usb_keys + USB_KEYS_COUNT_OFFSET;
+  if (index >= read_flash_key()) {
+    return;
+  }
+  usb_key_pointer = usb_keys + USB_KEYS_HEADER_SIZE
+                    + index * USB_KEYS_ENTRY_SIZE;
+  U16 offset = read_flash_key();
+  offset |= (U16)read_flash_key() << 8;
+  U16 length = read_flash_key();
+  length |= (U16)read_flash_key() << 8;
+  compressed = read_flash_key() & USB_KEYS_COMPRESSED;
+  payload_pointer = usb_keys + offset;
+  usb_key_pointer = payload_pointer;
+  usb_data_to_send = length;
+  usb_kbd_state = 1;
+}
+// This function handles REPEAT_KEY. The first time a REPEAT_KEY is read the
+// number of repetitions is loaded, then each time it is read again the read
+// pointer is moved back to the start of the block until no repetitions are
+// left. Repeating costs no flash space per repetition.
+void repeat_block(void)
+{
+  U16 count = read_usb_key();
+  count |= (U16)read_usb_key() << 8;
+  U16 length = read_usb_key();
+  length |= (U16)read_usb_key() << 8;
+  if (!repeating) {
+    repeating = true;
+    repeatsLeft = count;
+  }
+  if (repeatsLeft == 0) {
+    // done, carry on after the header
+    repeating = false;
+    return;
+  }
+  repeatsLeft--;
+  usb_key_pointer -= length + REPEAT_HEADER_SIZE;
+  usb_data_to_send += length + REPEAT_HEADER_SIZE;
+}
+// This function handles CALL_KEY. The read pointer and the bytes left are
+// saved and the block is read, kbd_test_hit carries on after the CALL_KEY
+// once the block is done.
+void call_block(void)
+{
+  U16 back = read_usb_key();
+  back |= (U16)read_usb_key() << 8;
+  U16 length = read_usb_key();
+  length |= (U16)read_usb_key() << 8;
+  if (callDepth == MAX_CALL_DEPTH) {
+    // never written by the optimizer, the call is skipped
+    return;
+  }
+  callPointers[callDepth] = usb_key_pointer;
+  callLeft[callDepth] = usb_data_to_send;
+  callDepth++;
+  usb_key_pointer -= back + CALL_SIZE;
+  usb_data_to_send = length;
+}
+// This function handles REPORT_KEY. The keys of the run are read one report
+// at a time by send_packed_report.
+void start_packed_report(void)
+{
+  packedModifier = read_usb_key();
+  packedLength = read_usb_key();
+  packedIndex = 0;
+  packedHeld = 0;
+  packing = true;
+}
+// This function sends the report pressing the next key of the run, or the
+// release report once all keys were pressed.
+void send_packed_report(void)
+{
+  U8 i;
+  if (packedIndex == packedLength) {
+    packing = false;
+    sendNothing();
+    return;
+  }
+  if (packedHeld == REPORT_ROLLOVER) {
+    // release the key pressed first to make room for the next one
+    for (i = 1; i < REPORT_ROLLOVER; i++) {
+      packedWindow[i - 1] = packedWindow[i];
+    }
+    packedHeld--;
+  }
+  packedWindow[packedHeld++] = read_usb_key();
+  Usb_write_byte(packedModifier);     // Byte0: Modifier
+  Usb_write_byte(0);                  // Byte1: Reserved
+  for (i = 0; i < REPORT_ROLLOVER; i++) {
+    Usb_write_byte(i < packedHeld ? packedWindow[i] : 0);
+  }
+  Usb_send_in();
+  packedIndex++;
+}
+// This function reads the next character of a STRING_KEY run and sets
+// usb_key and modifier to its keys, which process_key then sends.
+void next_string_key(void)
+{
+  U8 entry;
+#ifndef __GNUC__
+  entry = ascii_keys[read_usb_key() & 0x7F];
+#else
+  entry = pgm_read_byte_near(ascii_keys + (read_usb_key() & 0x7F));
+#endif
+  usb_key = entry & ~ASCII_SHIFT;
+  modifier = (entry & ASCII_SHIFT) ? HID_MODIFIER_LEFT_SHIFT
+                                   : HID_MODIFIER_NONE;
+  stringLeft--;
+}
 //! @brief Chech keyboard key hit
 //! This function scans the keyboard keys and update the scan_key word.
 //!   if a key is pressed, the key_hit bit is set to TRUE.
 //!
 void kbd_test_hit(void)
 {
-  if (keysCounter < firstNKeys) {
-    _delay_ms(3000);
-  }
-  keysCounter++;
   switch (usb_kbd_state)
   {
     case 0:
-      // if (Is_btn_middle())
-      // if (((PORTE & (1<<PE7)) ?FALSE : TRUE))
+      if (isFirstMessage)
       {
-        // type usb_keys only once
-        if (!isFirstMessage) return;
+        // the payload selected when the board was plugged in
         isFirstMessage = false;
-        usb_kbd_state = 1;
-        usb_key_pointer = usb_keys;
-        usb_data_to_send = SIZEOF_USB_KEYS;
+        start_payload(selectedPayload);
+      }
+      else
+      {
+        // replay on demand
+        U8 pressed = pressed_button();
+        if (pressed == BUTTON_NONE) return;
+        if (pressed != BUTTON_CENTER) selectedPayload = pressed;
+        start_payload(selectedPayload);
       }
       break;
     case 1:
-      if (usb_data_to_send != 0)
+      // the last keys may be a match which is not read from the flash left
+      if (usb_data_to_send != 0 || matchLeft != 0)
       {
         if ((key_hit == FALSE) && (transmit_no_key == FALSE))
         {
-#ifndef __GNUC__
-          usb_key = *usb_key_pointer++;
-#else
-          usb_key = pgm_read_byte_near(usb_key_pointer++);
-#endif
-          usb_data_to_send --;
+          if (stringLeft != 0) {
+            next_string_key();
+            key_hit = TRUE;
+            return;
+          }
+          usb_key = read_usb_key();
+          // sleep amounts and modifiers are operands, not opcodes
+          if (!shouldSleep && modifierKeysToRead <= ESCAPE_KEY_START) {
+            if (usb_key == REPEAT_KEY) {
+              repeat_block();
+              return;
+            }
+            if (usb_key == CALL_KEY) {
+              call_block();
+              return;
+            }
+            if (usb_key == DELAY_KEY) {
+              // no report is sent for a delay
+              start_delay(read_varint());
+              return;
+            }
+            if (usb_key == REPORT_KEY) {
+              start_packed_report();
+            }
+            if (usb_key == STRING_KEY) {
+              // the characters are typed by the next calls
+              stringLeft = read_usb_key();
+              return;
+            }
+          }
           key_hit = TRUE;
         }
       }
+      else if (callDepth != 0)
+      {
+        // the called block is done, carry on after its CALL_KEY
+        callDepth--;
+        usb_key_pointer = callPointers[callDepth];
+        usb_data_to_send = callLeft[callDepth];
+      }
       else
       {
         usb_kbd_state = 0;
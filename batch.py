@@ -0,0 +1,184 @@
+'''
+Compiles many DuckyScript files at once.
+
+Every worker process builds in its own copy of the firmware tree, so no two
+builds ever touch the same keyboard_task.c or object files. The .hex of
+every script is written to the output directory together with
+manifest.json describing each build.
+
+Usage: python batch.py SCRIPT_OR_DIRECTORY... [--output-dir DIR] [--jobs N]
+'''
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+import build
+import ducky
+import ducky_script_parser as dsp
+import ducky_to_hid as dth
+import optimizer
+import utilities
+
+# Firmware files that are not needed to build it
+WORKSPACE_IGNORE = shutil.ignore_patterns('*.zip', '*.gif', '*.a90', 'doc',
+                                          'doc.html', 'iar')
+
+# Per worker process state, set by init_worker. The parser keeps no state
+# between parses, so one is kept for all the scripts of the worker.
+workspace_path: Optional[str] = None
+cache: Optional[build.BuildCache] = None
+parser: Optional[dsp.DuckyScriptParser] = None
+
+
+def find_scripts(paths: List[str]) -> List[str]:
+    '''
+    Expands directories to the .txt files in them
+    '''
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(
+                os.path.join(path, x) for x in os.listdir(path)
+                if x.endswith('.txt')))
+        else:
+            result.append(path)
+    return result
+
+
+def output_name(script_path: str) -> str:
+    return os.path.splitext(os.path.basename(script_path))[0] + '.hex'
+
+
+def init_worker(firmware_path: str, workspaces_path: str,
+                cache_path: str) -> None:
+    '''
+    Creates the private firmware tree of this worker. copytree keeps the
+    mtimes so the prebuilt objects stay up to date.
+    '''
+    global workspace_path, cache, parser
+    workspace_path = os.path.join(workspaces_path, f'worker-{os.getpid()}')
+    shutil.copytree(firmware_path, workspace_path, ignore=WORKSPACE_IGNORE)
+    cache = build.BuildCache(cache_path)
+    parser = dsp.DuckyScriptParser()
+
+
+def compile_script(script_path: str, output_path: str,
+                   reserve: Optional[int] = None,
+                   text_encoding: str = 'keys',
+                   compress: bool = False,
+                   opt_level: int = optimizer.DEFAULT_LEVEL) -> Dict:
+    '''
+    Builds one script in this worker's firmware tree, the way
+    rubber_ducky_to_hex.py does.
+    Returns its manifest entry; failures are reported there, not raised.
+    '''
+    start = time.perf_counter()
+    entry = {'script': script_path, 'output': output_path}
+    try:
+        converter = dth.DuckyScriptConverter(text_encoding)
+        # what --verbose would print about the stages
+        messages: List[str] = []
+        converted, flags = ducky.convert_script(
+            utilities.iter_lines(script_path), converter, opt_level,
+            compress, log=messages.append, parser=parser)
+        report = ducky.compile_payload(
+            [(converted, flags)], workspace_path, output_path, cache,
+            reserve, jobs=1, quiet=True)
+        entry.update({
+            'status': 'ok',
+            'log': messages,
+            'payload_bytes': report.payload_size,
+            'hex_bytes': os.path.getsize(output_path),
+            'cache_hit': report.cache_hit,
+            'keystrokes_saved': converter.keystrokes_saved,
+            'compressed': bool(flags),
+            'steps': dict(report.steps),
+        })
+    except Exception as e:
+        entry.update({
+            'status': 'error',
+            'error': f'{type(e).__name__}: {e}',
+            'traceback': traceback.format_exc(),
+        })
+    entry['seconds'] = time.perf_counter() - start
+    return entry
+
+
+def compile_batch(script_paths: List[str], output_dir: str,
+                  jobs: Optional[int] = None,
+                  reserve: Optional[int] = None,
+                  text_encoding: str = 'keys',
+                  compress: bool = False,
+                  opt_level: int = optimizer.DEFAULT_LEVEL,
+                  firmware_path: str = ducky.FIRMWARE_PATH,
+                  cache_path: str = ducky.BUILD_CACHE_PATH
+                  ) -> List[Dict]:
+    names = [output_name(x) for x in script_paths]
+    duplicates = sorted(set(x for x in names if names.count(x) > 1))
+    if duplicates:
+        raise ValueError(f'Scripts would overwrite each other: {duplicates}')
+    os.makedirs(output_dir, exist_ok=True)
+
+    workspaces_path = tempfile.mkdtemp(prefix='ducky-batch-')
+    try:
+        with ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_worker,
+                initargs=(firmware_path, workspaces_path,
+                          cache_path)) as executor:
+            futures = [executor.submit(compile_script, script,
+                                       os.path.join(output_dir, name),
+                                       reserve, text_encoding, compress,
+                                       opt_level)
+                       for script, name in zip(script_paths, names)]
+            manifest = [x.result() for x in futures]
+    finally:
+        shutil.rmtree(workspaces_path, ignore_errors=True)
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scripts', nargs='+', metavar='SCRIPT_OR_DIRECTORY')
+    parser.add_argument('--output-dir', default='payloads',
+                        help='where the .hex files and manifest.json are '
+                             'written (default: %(default)s)')
+    parser.add_argument('--jobs', type=int,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('--reserve', metavar='BYTES', type=int,
+                        help='reserve room for payloads of up to BYTES, see '
+                             'rubber_ducky_to_hex.py --reserve')
+    parser.add_argument('--text-encoding', default='keys',
+                        choices=sorted(dth.TEXT_ENCODINGS),
+                        help='see rubber_ducky_to_hex.py --text-encoding')
+    parser.add_argument('--compress', action='store_true',
+                        help='see rubber_ducky_to_hex.py --compress')
+    parser.add_argument('--opt-level', metavar='N', type=int,
+                        default=optimizer.DEFAULT_LEVEL,
+                        choices=range(optimizer.MAX_LEVEL + 1),
+                        help='see rubber_ducky_to_hex.py --opt-level')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    manifest = compile_batch(find_scripts(args.scripts), args.output_dir,
+                             args.jobs, args.reserve, args.text_encoding,
+                             args.compress, args.opt_level)
+    failed = [x for x in manifest if x['status'] != 'ok']
+    for entry in failed:
+        print(f'{entry["script"]}: {entry["error"]}')
+    print(f'{len(manifest) - len(failed)}/{len(manifest)} scripts built in '
+          f'{time.perf_counter() - start:.2f}s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,92 @@
+'''
+Compares the old chain of responsibility walk against the keyword dispatch
+table used by the parser on large synthetic DuckyScript files.
+
+Usage: python benchmarks/bench_dispatch.py [number_of_lines]
+'''
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ducky_script_parser as dsp  # noqa: E402
+import ducky_to_hid as dth  # noqa: E402
+
+SCRIPT_LINES = ['REM synthetic line', 'DELAY 500', 'GUI r', 'WINDOWS',
+                'STRING notepad', 'STRING Hello World!', 'ENTER', 'SPACE',
+                'MENU', 'SHIFT TAB', 'ALT F4', 'DOWNARROW', 'LEFT', 'HOME']
+
+
+def synthetic_script(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [rng.choice(SCRIPT_LINES) for _ in range(n)]
+
+
+def chain_walk(handlers, lines):
+    '''
+    The pre-dispatch behaviour: ask each handler in order whether the line
+    starts with one of its keywords.
+    '''
+    result = []
+    for line in lines:
+        for handler in handlers:
+            if any([line.startswith(start)
+                    for start in handler.line_startings]):
+                result.append(handler._parse(line))
+                break
+    return result
+
+
+def dispatch(dispatcher, lines):
+    return [dispatcher.handle(line) for line in lines]
+
+
+def chain_order(dispatcher):
+    '''
+    Handlers in registration order, followed by the default handler - the
+    order in which the old chain visited them.
+    '''
+    handlers = []
+    for handler in dispatcher.handlers.values():
+        if handler not in handlers:
+            handlers.append(handler)
+    if dispatcher.default is not None:
+        handlers.append(dispatcher.default)
+    return handlers
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def report(stage, lines, before, after):
+    print(f'{stage:<10} chain: {lines / before:>12,.0f} lines/s   '
+          f'dispatch: {lines / after:>12,.0f} lines/s   '
+          f'speedup: {before / after:.2f}x')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lines = synthetic_script(n)
+    print(f'{n} synthetic lines')
+
+    parser = dsp.DuckyScriptParser()
+    before, chained = timed(chain_walk, chain_order(parser.dispatcher),
+                            lines)
+    after, dispatched = timed(dispatch, parser.dispatcher, lines)
+    assert chained == dispatched
+    report('parse', n, before, after)
+
+    # The converter dispatches on the op type produced by the parser
+    converter = dth.DuckyScriptConverter()
+    after, _ = timed(converter.convert,
+                     [x for x in dispatched if x is not None])
+    print(f'{"convert":<10} {n / after:>52,.0f} lines/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+'''
+Throughput of the compile pipeline on generated DuckyScript (see corpus.py)
+of 1k, 100k and 1M lines, checked against a stored baseline.
+
+Every stage is measured on its own and together as the streamed pipeline:
+
+    read      utilities.iter_lines
+    parse     DuckyScriptParser.parse of the read lines
+    convert   DuckyScriptConverter.convert of the parsed ops
+    optimize  optimizer.optimize of the converted keys at the default
+              --opt-level
+    pipeline  lines streamed through parse, convert and the optimizer into a
+              file, the way rubber_ducky_to_hex.py does
+
+and reports lines/s, bytes/s (of DuckyScript) and the peak RSS of the
+process. Each measurement runs in a fresh process so the peak RSS of one
+does not hide another, and the best of --repeat runs is kept.
+
+The results are compared with benchmarks/baseline.json; a stage that got
+slower or bigger than the baseline by more than --threshold fails the run
+(exit code 1), and so does a stage the baseline has no result for.
+--update-baseline stores the results as the new baseline - do that on the
+machine that runs the check, and whenever a stage is added.
+
+With --baseline-rev the baseline is measured instead, in the same run and on
+the same scripts, with the compiler modules of a git revision checked out
+into a temporary worktree, so the comparison does not depend on the
+machine. Stages the base revision cannot run fail the run as missing.
+
+Usage: python benchmarks/bench_pipeline.py [--sizes N,...] [--mix MIX]
+           [--repeat N] [--threshold FRACTION]
+           [--baseline JSON | --update-baseline | --baseline-rev REV]
+'''
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import corpus
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+SIZES = [1000, 100000, 1000000]
+STAGES = ['read', 'parse', 'convert', 'optimize', 'pipeline']
+THRESHOLD = 0.25
+
+
+def run_stage(stage: str, script_path: str,
+              root: str) -> Optional[Tuple[float, int]]:
+    '''
+    Runs one stage on the script with the compiler modules of the tree at
+    `root`, in a process of its own.
+    Returns the seconds the stage took and the peak RSS in KiB, None if the
+    modules cannot run the stage.
+    '''
+    sys.path.insert(0, root)
+    try:
+        import ducky_script_parser as dsp
+        import ducky_to_hid as dth
+        import payload
+        import utilities
+        if stage in ('optimize', 'pipeline'):
+            import optimizer
+            optimizer.Optimizer
+        dth.DuckyScriptConverter.iter_convert
+    except (ImportError, AttributeError):
+        # a revision from before the stage
+        return None
+
+    lines = ops = keys = None
+    if stage in ('parse', 'convert', 'optimize'):
+        lines = list(utilities.iter_lines(script_path))
+    if stage in ('convert', 'optimize'):
+        ops = dsp.DuckyScriptParser().parse(lines)
+        lines = None
+    if stage == 'optimize':
+        keys = dth.DuckyScriptConverter().convert(ops)
+        ops = None
+
+    start = time.perf_counter()
+    if stage == 'read':
+        for _ in utilities.iter_lines(script_path):
+            pass
+    elif stage == 'parse':
+        dsp.DuckyScriptParser().parse(lines)
+    elif stage == 'convert':
+        dth.DuckyScriptConverter().convert(ops)
+    elif stage == 'optimize':
+        optimizer.optimize(keys)
+    else:
+        ops = dsp.DuckyScriptParser().iter_parse(
+            utilities.iter_lines(script_path))
+        payload.write_binary(os.devnull, optimizer.Optimizer().iter_optimize(
+            dth.DuckyScriptConverter().iter_convert(ops)))
+    seconds = time.perf_counter() - start
+    # KiB on Linux
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(stage: str, script_path: str, repeat: int,
+            root: str) -> Optional[Tuple[float, int]]:
+    seconds: List[float] = []
+    rss: List[int] = []
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(run_stage, stage, script_path,
+                                     root).result()
+        if result is None:
+            return None
+        seconds.append(result[0])
+        rss.append(result[1])
+    return min(seconds), min(rss)
+
+
+def benchmark(sizes: List[int], mix: Dict[str, int], repeat: int,
+              roots: List[str]) -> List[Dict[str, Dict]]:
+    '''
+    Returns '<lines>/<stage>' -> lines/s, bytes/s and peak RSS for the
+    compiler modules of each of `roots`. The trees are measured one after
+    the other for every stage, so they run under the same conditions.
+    '''
+    results: List[Dict[str, Dict]] = [{} for _ in roots]
+    with tempfile.TemporaryDirectory(prefix='ducky-bench-') as tmp:
+        for lines in sizes:
+            script_path = os.path.join(tmp, f'{lines}.txt')
+            size = corpus.write(script_path, lines, mix)
+            for stage in STAGES:
+                for root, result in zip(roots, results):
+                    measured = measure(stage, script_path, repeat, root)
+                    if measured is None:
+                        continue
+                    seconds, rss = measured
+                    result[f'{lines}/{stage}'] = {
+                        'lines_per_s': lines / seconds,
+                        'bytes_per_s': size / seconds,
+                        'peak_rss_kib': rss,
+                    }
+    return results
+
+
+def checkout(rev: str, path: str) -> None:
+    '''
+    Checks out the git revision `rev` of this repository into a new
+    worktree at `path`
+    '''
+    subprocess.run(['git', 'worktree', 'add', '--detach', '--quiet', path,
+                    rev], cwd=ROOT_PATH, check=True)
+
+
+def remove_worktree(path: str) -> None:
+    subprocess.run(['git', 'worktree', 'remove', '--force', path],
+                   cwd=ROOT_PATH, check=True)
+
+
+def regressions(results: Dict[str, Dict], baseline: Dict[str, Dict],
+                threshold: float) -> List[str]:
+    '''
+    Returns a description of every result worse than the baseline by more
+    than `threshold` and of every result the baseline has none for
+    '''
+    result = []
+    for name, current in results.items():
+        old = baseline.get(name)
+        if old is None:
+            result.append(f'{name}: missing from the baseline')
+            continue
+        if current['lines_per_s'] < old['lines_per_s'] * (1 - threshold):
+            result.append(f'{name}: {current["lines_per_s"]:,.0f} lines/s, '
+                          f'baseline {old["lines_per_s"]:,.0f}')
+        if current['peak_rss_kib'] > old['peak_rss_kib'] * (1 + threshold):
+            result.append(f'{name}: {current["peak_rss_kib"]:,} KiB peak '
+                          f'RSS, baseline {old["peak_rss_kib"]:,}')
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='numbers of lines (default: %(default)s)')
+    parser.add_argument('--mix', type=corpus.parse_mix,
+                        help='see corpus.py --mix')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per measurement, the best one is kept '
+                             '(default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='allowed regression as a fraction of the '
+                             'baseline (default: %(default)s)')
+    parser.add_argument('--baseline', metavar='JSON', default=BASELINE_PATH)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--update-baseline', action='store_true',
+                      help='store the results as the baseline')
+    mode.add_argument('--baseline-rev', metavar='REV',
+                      help='measure the git revision REV and compare with '
+                           'it instead of the stored baseline')
+    args = parser.parse_args(argv)
+    if not args.update_baseline and not args.baseline_rev \
+            and not os.path.exists(args.baseline):
+        parser.error(f'no baseline at {args.baseline}, run with '
+                     f'--update-baseline or --baseline-rev')
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory(prefix='ducky-base-') as tmp:
+        roots = [ROOT_PATH]
+        if args.baseline_rev:
+            base_path = os.path.join(tmp, 'base')
+            checkout(args.baseline_rev, base_path)
+            roots.append(base_path)
+        try:
+            results = benchmark(sizes, args.mix, args.repeat, roots)
+        finally:
+            if args.baseline_rev:
+                remove_worktree(base_path)
+    if args.update_baseline:
+        baseline = {}
+    elif args.baseline_rev:
+        baseline = results[1]
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f'{"lines":>8} {"stage":<9} {"lines/s":>12} {"MB/s":>8} '
+          f'{"peak RSS MiB":>12}' + (f' {"vs base":>8}' if baseline else ''))
+    for name, result in results[0].items():
+        lines, stage = name.split('/')
+        base = baseline.get(name)
+        print(f'{lines:>8} {stage:<9} {result["lines_per_s"]:>12,.0f} '
+              f'{result["bytes_per_s"] / 1e6:>8.2f} '
+              f'{result["peak_rss_kib"] / 1024:>12.1f}'
+              + (f' {result["lines_per_s"] / base["lines_per_s"]:>7.2f}x'
+                 if base else ''))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results[0], f, indent=2)
+        print(f'baseline written to {args.baseline}')
+        return 0
+    failed = regressions(results[0], baseline, args.threshold)
+    for failure in failed:
+        print(f'REGRESSION {failure}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
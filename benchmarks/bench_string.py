@@ -0,0 +1,131 @@
+'''
+Compares the old per character if/elif ladder against the precomputed
+character table used by StringConverter on long STRING lines, and the bytes
+each stores. The packed text encoding is measured too: it is neither faster
+to compile nor smaller - on text that changes case often every shift change
+starts a REPORT_KEY run - what it saves are the HID reports of typing.
+
+Usage: python benchmarks/bench_string.py [line_length] [number_of_lines]
+'''
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ducky_to_hid as dth  # noqa: E402
+import hid_keys  # noqa: E402
+from ducky_ir import Text  # noqa: E402
+
+# The characters the ladder knew about
+LADDER_CHARS = string.ascii_letters + string.digits + '"\'()*+-/,.;:<>=?@[] !'
+
+
+def ladder_special(char):
+    shift = [hid_keys.ESCAPE_KEY_START + 1, hid_keys.MODIFIER_LEFT_SHIFT]
+    if char == '"':
+        result = shift + [hid_keys.KEYCODES['SINGLEQUOTE']]
+    elif char == "'":
+        result = [hid_keys.KEYCODES['SINGLEQUOTE']]
+    elif char == '(':
+        result = shift + [hid_keys.KEYCODES['9']]
+    elif char == ')':
+        result = shift + [hid_keys.KEYCODES['0']]
+    elif char == '*':
+        result = [hid_keys.KEYCODES['KEYPAD_MULTIPLY']]
+    elif char == '+':
+        result = [hid_keys.KEYCODES['KEYPAD_PLUS']]
+    elif char == '-':
+        result = [hid_keys.KEYCODES['KEYPAD_MINUS']]
+    elif char == '/':
+        result = [hid_keys.KEYCODES['KEYPAD_DIVIDE']]
+    elif char == ',':
+        result = [hid_keys.KEYCODES['COMMA']]
+    elif char == '.':
+        result = [hid_keys.KEYCODES['DOT']]
+    elif char == ';':
+        result = [hid_keys.KEYCODES['SEMICOLON']]
+    elif char == ':':
+        result = shift + [hid_keys.KEYCODES['SEMICOLON']]
+    elif char == '<':
+        result = shift + [hid_keys.KEYCODES['COMMA']]
+    elif char == '>':
+        result = shift + [hid_keys.KEYCODES['DOT']]
+    elif char == '=':
+        result = [hid_keys.KEYCODES['KEYPAD_EQUAL']]
+    elif char == '?':
+        result = shift + [hid_keys.KEYCODES['SLASH']]
+    elif char == '@':
+        result = shift + [hid_keys.KEYCODES['2']]
+    elif char == '[':
+        result = [hid_keys.KEYCODES['LEFT_SQUARE_BRACKET']]
+    elif char == ']':
+        result = [hid_keys.KEYCODES['RIGHT_SQUARE_BRACKET']]
+    elif char == ' ':
+        result = [hid_keys.KEYCODES['SPACEBAR']]
+    elif char == '!':
+        result = shift + [hid_keys.KEYCODES['1']]
+    else:
+        raise ValueError(f'Char not implemented as HID: {char}')
+    return result
+
+
+def ladder(text):
+    '''
+    The pre-table behaviour: walk the ladder for every character
+    '''
+    result = []
+    for char in text:
+        if char.isdigit():
+            result.append(hid_keys.KEYCODES[char])
+        elif char.isalpha() and char.islower():
+            result.append(hid_keys.KEYCODES[char.upper()])
+        elif char.isalpha() and char.isupper():
+            result.extend([hid_keys.KEYCODES['CAPS_LOCK'],
+                           hid_keys.KEYCODES[char],
+                           hid_keys.KEYCODES['CAPS_LOCK']])
+        else:
+            result.extend(ladder_special(char))
+    return bytes(result)
+
+
+def synthetic_text(length, seed=0):
+    rng = random.Random(seed)
+    return ''.join(rng.choice(LADDER_CHARS) for _ in range(length))
+
+
+def timed(func, texts):
+    start = time.perf_counter()
+    result = [func(x) for x in texts]
+    return time.perf_counter() - start, result
+
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    texts = [synthetic_text(length, seed) for seed in range(n)]
+    chars = length * n
+    print(f'{n} STRING lines of {length} characters')
+
+    converter = dth.StringConverter(Text)
+    before, laddered = timed(ladder, texts)
+    after, table = timed(converter.convert, [Text(x) for x in texts])
+    # only the encoding of capitals changed
+    assert ladder(texts[0].lower()) == converter.convert(
+        Text(texts[0].lower()))
+    print(f'ladder: {chars / before:>14,.0f} chars/s   '
+          f'table: {chars / after:>14,.0f} chars/s   '
+          f'speedup: {before / after:.2f}x')
+    print(f'ladder: {sum(map(len, laddered)):>14,} bytes     '
+          f'table: {sum(map(len, table)):>14,} bytes     '
+          f'keystrokes saved: {converter.keystrokes_saved:,}')
+    packed_time, packed = timed(dth.PackedStringConverter(Text).convert,
+                                [Text(x) for x in texts])
+    print(f'packed: {chars / packed_time:>14,.0f} chars/s   '
+          f'{sum(map(len, packed)):>14,} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+'''
+Types the reference scripts in benchmarks/typing with the simulated firmware
+(see simulator.py) and reports the size, HID reports and time of every
+payload for each text encoding, so encodings can be compared by number.
+
+Usage: python benchmarks/bench_typing.py [SCRIPT...]
+'''
+import glob
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compress  # noqa: E402
+import ducky_script_parser as dsp  # noqa: E402
+import ducky_to_hid as dth  # noqa: E402
+import simulator  # noqa: E402
+import utilities  # noqa: E402
+
+SCRIPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'typing')
+
+
+def measure(script_path, text_encoding):
+    ops = dsp.DuckyScriptParser().iter_parse(utilities.iter_lines(script_path))
+    keys = dth.DuckyScriptConverter(text_encoding).convert(ops)
+    playback = simulator.simulate(keys)
+    return len(keys), len(compress.compress(keys)), playback
+
+
+def main():
+    scripts = sys.argv[1:] or sorted(
+        glob.glob(os.path.join(SCRIPTS_PATH, '*.txt')))
+    print(f'{"script":<14} {"encoding":<9} {"bytes":>7} {"compressed":>10} '
+          f'{"reports":>8} {"typing s":>9} {"total s":>8}')
+    for script in scripts:
+        name = os.path.splitext(os.path.basename(script))[0]
+        for encoding in sorted(dth.TEXT_ENCODINGS):
+            size, compressed, playback = measure(script, encoding)
+            print(f'{name:<14} {encoding:<9} {size:>7} {compressed:>10} '
+                  f'{len(playback.reports):>8} '
+                  f'{playback.typing_ms / 1000:>9.3f} '
+                  f'{playback.seconds:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Generates synthetic DuckyScript that looks like real payloads - open a
+prompt, type commands, wait, repeat - for benchmarking the parser and the
+converter at any size.
+
+The mix of line types is tunable, e.g. a payload that is mostly text:
+
+    python benchmarks/corpus.py 100000 --mix STRING=80,DELAY=10,CHORD=10
+
+Usage: python benchmarks/corpus.py LINES [--mix TYPE=WEIGHT,...] [--seed N]
+                                   [--output PATH]
+'''
+from typing import Dict, Iterator, Optional
+import argparse
+import random
+import sys
+
+# Line type -> weight
+MIX: Dict[str, int] = {
+    'STRING': 50,
+    'DELAY': 15,
+    'CHORD': 15,
+    'KEY': 12,
+    'REPEAT': 5,
+    'REM': 3,
+}
+
+WORDS = ['powershell', '-NoProfile', 'Get-Process', 'Invoke-WebRequest',
+         'http://example.com/a.ps1', 'cmd', '/c', 'echo', 'Hello', 'World!',
+         'notepad', 'C:\\Users\\Public\\out.txt', '$env:TEMP', '|', '>',
+         'Out-File', '-Encoding', 'utf8', 'ipconfig', '/all', 'whoami',
+         'sudo', 'apt-get', 'install', '-y', 'curl', 'ls', '-la', '~/.ssh',
+         '&&', 'cat', '/etc/hosts', 'python3', '-c', '"print(42)"',
+         'README.TXT', 'Done.', '{0}', '[x]', 'a_b', '#', '100%']
+CHORDS = ['GUI r', 'GUI', 'WINDOWS d', 'CTRL c', 'CTRL v', 'CTRL ESC',
+          'CONTROL-SHIFT ESC', 'CTRL-ALT t', 'ALT F4', 'ALT TAB',
+          'SHIFT TAB', 'SHIFT DELETE', 'MENU']
+KEYS = ['ENTER', 'SPACE', 'DELETE', 'HOME', 'END', 'INSERT', 'UP',
+        'DOWNARROW', 'LEFT', 'RIGHTARROW', 'CAPSLOCK']
+DELAYS = [0, 10, 50, 100, 200, 250, 500, 750, 1000, 1500, 2000, 3000]
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    '''
+    Parses TYPE=WEIGHT,... - types that are not given keep no weight
+    '''
+    result = dict.fromkeys(MIX, 0)
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip().upper()
+        if name not in MIX:
+            raise ValueError(f'Unknown line type: {name}, expected one of '
+                             f'{sorted(MIX)}')
+        result[name] = int(weight)
+    return result
+
+
+def generate(lines: int, mix: Optional[Dict[str, int]] = None,
+             seed: int = 0) -> Iterator[str]:
+    '''
+    Yields `lines` lines of DuckyScript. The same seed gives the same
+    script.
+    '''
+    mix = mix or MIX
+    rng = random.Random(seed)
+    types = [x for x in mix if mix[x] > 0]
+    weights = [mix[x] for x in types]
+    if not types:
+        raise ValueError('The mix has no line type with a weight')
+    typed = False
+    for _ in range(lines):
+        kind = rng.choices(types, weights)[0]
+        if kind == 'REPEAT' and not typed:
+            # there is nothing to repeat yet
+            kind = 'KEY'
+        if kind == 'STRING':
+            count = rng.randint(1, 12)
+            yield 'STRING ' + ' '.join(rng.choice(WORDS)
+                                       for _ in range(count))
+        elif kind == 'DELAY':
+            yield f'DELAY {rng.choice(DELAYS)}'
+        elif kind == 'CHORD':
+            yield rng.choice(CHORDS)
+        elif kind == 'KEY':
+            yield rng.choice(KEYS)
+        elif kind == 'REPEAT':
+            yield f'REPEAT {rng.randint(1, 20)}'
+        else:
+            yield f'REM step {rng.randint(0, 999)}'
+            continue
+        typed = True
+
+
+def write(path: str, lines: int, mix: Optional[Dict[str, int]] = None,
+          seed: int = 0) -> int:
+    '''
+    Writes a generated script to `path`. Returns its size in bytes.
+    '''
+    size = 0
+    with open(path, 'w') as f:
+        for line in generate(lines, mix, seed):
+            size += f.write(line + '\n')
+    return size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('lines', type=int)
+    default_mix = ','.join(f'{k}={v}' for k, v in MIX.items())
+    parser.add_argument('--mix', type=parse_mix,
+                        help=f'weights of the line types (default: '
+                             f'{default_mix})')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='PATH',
+                        help='where to write the script (default: stdout)')
+    args = parser.parse_args(argv)
+    if args.output:
+        write(args.output, args.lines, args.mix, args.seed)
+    else:
+        for line in generate(args.lines, args.mix, args.seed):
+            sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Content addressed cache around the firmware build.
+
+The cache key is a hash of every firmware source file, keyboard_task.c (and
+so the generated usb_keys array) included. A payload that was built before
+is returned straight from the cache; otherwise make rebuilds only what
+changed and the resulting .hex is stored under its key.
+'''
+from typing import List, Optional, Tuple
+import hashlib
+import os
+import shutil
+import time
+import utilities
+
+SOURCE_SUFFIXES = ('.c', '.h', '.s', '.mk')
+SOURCE_NAMES = ('Makefile',)
+BUILD_DIRS = ('default',)
+
+
+class BuildReport(object):
+    '''
+    What a build did and how long each step took
+    '''
+    def __init__(self, key: str):
+        self.key = key
+        self.cache_hit = False
+        self.payload_size: Optional[int] = None
+        self.steps: List[Tuple[str, float]] = []
+
+    def __str__(self):
+        steps = ', '.join(f'{name} {seconds:.3f}s'
+                          for name, seconds in self.steps)
+        status = 'hit' if self.cache_hit else 'miss'
+        return f'build cache {status} ({self.key[:12]}): {steps}'
+
+
+class BuildCache(object):
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.hex')
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def put(self, key: str, hex_path: str) -> str:
+        '''
+        Stores a copy of `hex_path`. The copy is renamed into place so
+        concurrent builds never see a partially written entry.
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(hex_path, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+
+def source_files(firmware_root: str) -> List[str]:
+    result = []
+    for root, dirs, files in os.walk(firmware_root):
+        dirs[:] = sorted(x for x in dirs if x not in BUILD_DIRS)
+        for name in sorted(files):
+            if name.endswith(SOURCE_SUFFIXES) or name in SOURCE_NAMES:
+                result.append(os.path.join(root, name))
+    return result
+
+
+def source_hash(firmware_root: str) -> str:
+    digest = hashlib.sha256()
+    for path in source_files(firmware_root):
+        digest.update(os.path.relpath(path, firmware_root).encode())
+        digest.update(b'\0')
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def build(firmware_root: str, makefile_path: str, hex_path: str,
+          output_path: str, cache: BuildCache,
+          jobs: Optional[int] = None,
+          quiet: bool = False) -> BuildReport:
+    '''
+    Copies the .hex of the current sources to `output_path`, running make
+    in `makefile_path` only when the cache does not have it yet.
+    '''
+    start = time.perf_counter()
+    report = BuildReport(source_hash(firmware_root))
+    report.steps.append(('hash', time.perf_counter() - start))
+
+    cached = cache.get(report.key)
+    if cached is not None:
+        report.cache_hit = True
+        start = time.perf_counter()
+        shutil.copyfile(cached, output_path)
+        report.steps.append(('copy', time.perf_counter() - start))
+        return report
+
+    start = time.perf_counter()
+    utilities.make(makefile_path, jobs, quiet)
+    report.steps.append(('make', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    cache.put(report.key, hex_path)
+    shutil.copyfile(hex_path, output_path)
+    report.steps.append(('store', time.perf_counter() - start))
+    return report
@@ -0,0 +1,257 @@
+'''
+LZ compression of the usb_keys payload, decompressed by read_usb_key in
+keyboard_task.c while typing.
+
+The firmware has too little RAM to keep what it typed, so matches do not
+copy earlier output but bytes stored verbatim elsewhere in flash - every
+literal byte of the compressed payload doubles as dictionary. The
+compressed keys are a sequence of tokens:
+
+    0x00-0x7F, n - 1 literal bytes   the next n bytes are keys
+    0x80-0xFF, offset (16 bit LE)   (control & 0x7F) + MIN_MATCH keys are
+                                    read from the keys at offset
+
+REPEAT_KEY and CALL_KEY rewind the flash themselves, so their instructions
+are stored as tokens of their own and the blocks they type again start and
+end at a token. Their operands are rewritten to the compressed offsets.
+'''
+from typing import Dict, Iterator, List, Optional, Tuple
+import re
+import hid_keys
+
+MATCH = 0x80
+# A match token takes 3 bytes and the keys after it need a new literal token.
+# Keys that are matched are not literal bytes in flash either, so they are
+# no dictionary for later keys - short matches cost more than they save.
+MIN_MATCH = 6
+MAX_MATCH = MIN_MATCH + 0x7F
+MAX_LITERAL = 0x80
+MAX_OFFSET = 2**16 - 1
+# candidates looked at for every match
+MAX_CHAIN = 32
+
+
+def _fixed_instruction() -> 're.Pattern[bytes]':
+    '''
+    Returns the regular expression of an instruction whose length does not
+    depend on a length byte - anything but a REPORT_KEY or STRING_KEY run
+    '''
+    reserved = (hid_keys.SLEEP_KEY, hid_keys.DELAY_KEY, hid_keys.REPEAT_KEY,
+                hid_keys.CALL_KEY, hid_keys.REPORT_KEY, hid_keys.STRING_KEY)
+    single = bytes(x for x in range(hid_keys.ESCAPE_KEY_START + 1)
+                   if x not in reserved)
+    alternatives = [
+        b'[' + re.escape(single) + b']',
+        re.escape(bytes([hid_keys.SLEEP_KEY])) + b'.',
+        re.escape(bytes([hid_keys.DELAY_KEY])) + b'[\x80-\xff]*[\x00-\x7f]',
+        re.escape(bytes([hid_keys.REPEAT_KEY]))
+        + b'.{%d}' % (hid_keys.REPEAT_HEADER_SIZE - 1),
+        re.escape(bytes([hid_keys.CALL_KEY]))
+        + b'.{%d}' % (hid_keys.CALL_SIZE - 1),
+    ]
+    for key in range(hid_keys.ESCAPE_KEY_START + 1, 256):
+        alternatives.append(re.escape(bytes([key]))
+                            + b'.{%d}' % (key - hid_keys.ESCAPE_KEY_START + 1))
+    return re.compile(b'|'.join(alternatives), re.DOTALL)
+
+
+FIXED_INSTRUCTION = _fixed_instruction()
+
+
+def instructions(keys: bytes) -> Iterator[Tuple[int, int]]:
+    '''
+    Splits the keys into the instructions process_key reads and yields the
+    (start, end) of each
+    '''
+    i = 0
+    while i < len(keys):
+        key = keys[i]
+        if key == hid_keys.SLEEP_KEY:
+            end = i + 2
+        elif key == hid_keys.DELAY_KEY:
+            # the delay is a varint, its last byte has the top bit clear
+            end = i + 1
+            while end < len(keys) and keys[end] & 0x80:
+                end += 1
+            end += 1
+        elif key > hid_keys.ESCAPE_KEY_START:
+            # the modifiers followed by the key
+            end = i + key - hid_keys.ESCAPE_KEY_START + 2
+        elif key == hid_keys.REPEAT_KEY:
+            end = i + hid_keys.REPEAT_HEADER_SIZE
+        elif key == hid_keys.CALL_KEY:
+            end = i + hid_keys.CALL_SIZE
+        elif key == hid_keys.REPORT_KEY and i + 2 < len(keys):
+            end = i + 3 + keys[i + 2]
+        elif key == hid_keys.STRING_KEY and i + 1 < len(keys):
+            end = i + 2 + keys[i + 1]
+        else:
+            end = i + 1
+        if end > len(keys):
+            raise ValueError(f'Truncated instruction at byte {i}')
+        yield i, end
+        i = end
+
+
+def split_instructions(keys: bytes) -> List[bytes]:
+    '''
+    Returns the instructions of the keys, see `instructions`. Keys without
+    REPORT_KEY and STRING_KEY bytes are split by FIXED_INSTRUCTION, which
+    is much faster.
+    '''
+    if hid_keys.REPORT_KEY not in keys and hid_keys.STRING_KEY not in keys:
+        result = FIXED_INSTRUCTION.findall(keys)
+        # a truncated instruction is skipped by findall
+        if sum(map(len, result)) == len(keys):
+            return result
+    return [keys[start:end] for start, end in instructions(keys)]
+
+
+class Compressor(object):
+    def __init__(self):
+        self.result = bytearray()
+        # MIN_MATCH bytes -> (offset, control byte of the token) of the
+        # literal bytes in result starting with them
+        self.dictionary: Dict[bytes, List[Tuple[int, int]]] = {}
+        # control byte offset -> end of every written literal token
+        self.ends: Dict[int, int] = {}
+        # control byte offset of the literal token being written
+        self.pending: Optional[int] = None
+
+    def write_key(self, key: int) -> None:
+        '''
+        Writes a literal key. The key can be matched right away.
+        '''
+        if self.pending is None:
+            self.pending = len(self.result)
+            self.result.append(0)  # set by flush
+        self.result.append(key)
+        start = len(self.result) - MIN_MATCH
+        if start > self.pending:
+            self.dictionary.setdefault(bytes(self.result[start:]), []).append(
+                (start, self.pending))
+        if len(self.result) - self.pending - 1 == MAX_LITERAL:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending is not None:
+            self.result[self.pending] = len(self.result) - self.pending - 2
+            self.ends[self.pending] = len(self.result)
+            self.pending = None
+
+    def write_instruction(self, data: bytes) -> None:
+        '''
+        Writes data as a literal token of its own
+        '''
+        self.flush()
+        for key in data:
+            self.write_key(key)
+        self.flush()
+
+    def find_match(self, data: bytes, i: int) -> Tuple[int, int]:
+        '''
+        Returns the (offset, length) of the longest match for data[i:]
+        '''
+        best = (0, 0)
+        candidates = self.dictionary.get(data[i:i + MIN_MATCH], ())
+        for offset, token in reversed(candidates[-MAX_CHAIN:]):
+            if offset > MAX_OFFSET:
+                continue
+            # matches are copied from one token, they cannot span control
+            # bytes
+            end = self.ends.get(token, len(self.result))
+            length = MIN_MATCH
+            limit = min(MAX_MATCH, len(data) - i, end - offset)
+            while length < limit \
+                    and self.result[offset + length] == data[i + length]:
+                length += 1
+            if length > best[1]:
+                best = (offset, length)
+                if length == limit:
+                    break
+        return best
+
+    def write_run(self, data: bytes) -> None:
+        '''
+        Compresses keys which contain no REPEAT header
+        '''
+        i = 0
+        while i < len(data):
+            offset, length = (0, 0)
+            if i + MIN_MATCH <= len(data):
+                offset, length = self.find_match(data, i)
+            if length >= MIN_MATCH:
+                self.flush()
+                self.result.append(MATCH | (length - MIN_MATCH))
+                self.result += offset.to_bytes(2, 'little')
+                i += length
+            else:
+                self.write_key(data[i])
+                i += 1
+        self.flush()
+
+
+def compress(keys: bytes) -> bytes:
+    '''
+    Returns the compressed keys, which are typed exactly like `keys`
+    '''
+    compressor = Compressor()
+    result = compressor.result
+    rewinds = (hid_keys.REPEAT_KEY, hid_keys.CALL_KEY)
+    boundaries = set()
+    instructions_list = list(instructions(keys))
+    for start, end in instructions_list:
+        if keys[start] == hid_keys.REPEAT_KEY:
+            length = int.from_bytes(keys[end - 2:end], 'little')
+            if length > start:
+                raise ValueError(f'REPEAT block at byte {start} starts before '
+                                 f'the keys')
+            boundaries.add(start - length)
+        elif keys[start] == hid_keys.CALL_KEY:
+            back = int.from_bytes(keys[start + 1:start + 3], 'little')
+            length = int.from_bytes(keys[start + 3:end], 'little')
+            if back > start or length > back:
+                raise ValueError(f'CALL block at byte {start} is not before '
+                                 f'the call')
+            boundaries.add(start - back)
+            boundaries.add(start - back + length)
+
+    # raw offset -> compressed offset of the instructions starting or ending
+    # a block
+    starts: Dict[int, int] = {}
+    run_start = 0
+    for start, end in instructions_list:
+        if start in boundaries or keys[start] in rewinds:
+            compressor.write_run(keys[run_start:start])
+            run_start = start
+        if start in boundaries:
+            starts[start] = len(result)
+        if keys[start] not in rewinds:
+            continue
+        if keys[start] == hid_keys.REPEAT_KEY:
+            block = starts.get(start - int.from_bytes(keys[end - 2:end],
+                                                      'little'))
+            block_end = len(result)
+        else:
+            back = int.from_bytes(keys[start + 1:start + 3], 'little')
+            length = int.from_bytes(keys[start + 3:end], 'little')
+            block = starts.get(start - back)
+            block_end = starts.get(start - back + length)
+        if block is None or block_end is None:
+            raise ValueError(f'Block of the instruction at byte {start} does '
+                             f'not start and end at an instruction')
+        # the block is rewound to after reading the instruction, from right
+        # after the control byte of its token
+        back = len(result) + 1 - block
+        if back > MAX_OFFSET:
+            raise ValueError(f'Compressed block at byte {start} is too far '
+                             f'back: {back} bytes')
+        if keys[start] == hid_keys.REPEAT_KEY:
+            data = keys[start:end - 2] + back.to_bytes(2, 'little')
+        else:
+            data = bytes([hid_keys.CALL_KEY]) + back.to_bytes(2, 'little') \
+                + (block_end - block).to_bytes(2, 'little')
+        compressor.write_instruction(data)
+        run_start = end
+    compressor.write_run(keys[run_start:])
+    return bytes(result)
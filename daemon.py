@@ -0,0 +1,229 @@
+'''
+Long running compile server, so editing a script does not pay for starting
+Python, importing and copying the firmware tree on every build.
+
+The server keeps a pool of batch.py workers alive - each with its imports,
+parser, its own firmware tree (with the objects make built before) and the
+build cache - and compiles scripts on it:
+
+    * when asked to over a Unix socket, one JSON object per line:
+
+        {"script": "duckyScript.txt", "output": "payload.hex",
+         "compress": true}
+
+      names the script, the .hex to write (default: the script's name in the
+      current directory of the server) and any of the options of
+      batch.compile_script, and is answered with the manifest entry of the
+      build (see batch.py). Relative paths are relative to the server.
+    * whenever one of the --watch scripts changes, into --output-dir.
+
+Requests are served concurrently, up to one build per worker. Changes to the
+firmware sources are only picked up by restarting the server.
+
+Usage: python daemon.py [--socket PATH] [--jobs N] [--watch SCRIPT...]
+                        [--output-dir DIR]
+       python daemon.py --send SCRIPT [--output PATH] [--socket PATH]
+'''
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import functools
+import json
+import os
+import shutil
+import socket
+import tempfile
+import batch
+import ducky
+import ducky_to_hid as dth
+import optimizer
+
+SOCKET_NAME = '.ducky.sock'
+# Options of batch.compile_script a request may set
+OPTIONS = ('reserve', 'text_encoding', 'compress', 'opt_level')
+# Seconds between looking at the mtimes of the watched scripts
+POLL_INTERVAL = 0.5
+
+
+class CompileServer(object):
+    '''
+    Compiles scripts on a pool of warm batch.py workers
+    '''
+    def __init__(self, jobs: Optional[int] = None,
+                 firmware_path: str = ducky.FIRMWARE_PATH,
+                 cache_path: str = ducky.BUILD_CACHE_PATH):
+        self.workspaces_path = tempfile.mkdtemp(prefix='ducky-daemon-')
+        self.executor = ProcessPoolExecutor(
+            max_workers=jobs, initializer=batch.init_worker,
+            initargs=(firmware_path, self.workspaces_path, cache_path))
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        shutil.rmtree(self.workspaces_path, ignore_errors=True)
+
+    async def compile(self, script_path: str, output_path: str,
+                      **options) -> Dict:
+        '''
+        Builds `script_path` into `output_path` on the next free worker and
+        returns its manifest entry
+        '''
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(
+                batch.compile_script, script_path, output_path, **options))
+
+    async def handle(self, request: Dict) -> Dict:
+        script_path = request['script']
+        output_path = request.get('output') or batch.output_name(script_path)
+        unknown = set(request) - set(OPTIONS) - {'script', 'output'}
+        if unknown:
+            raise ValueError(f'Unknown request keys: {sorted(unknown)}')
+        return await self.compile(script_path, output_path,
+                                  **{x: request[x] for x in OPTIONS
+                                     if x in request})
+
+    async def serve_client(self, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter) -> None:
+        '''
+        Answers the requests of one connection in order
+        '''
+        try:
+            async for line in reader:
+                try:
+                    response = await self.handle(json.loads(line))
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {'status': 'error',
+                                'error': f'{type(e).__name__}: {e}'}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str) -> None:
+        if os.path.exists(socket_path):
+            # left behind by a server that did not shut down cleanly
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.serve_client,
+                                                 socket_path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+    async def watch(self, script_paths: List[str], output_dir: str,
+                    **options) -> None:
+        '''
+        Builds each of `script_paths` into `output_dir` now and again every
+        time its mtime changes
+        '''
+        os.makedirs(output_dir, exist_ok=True)
+        mtimes: Dict[str, int] = {}
+        while True:
+            changed = []
+            for path in script_paths:
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    # an editor replacing the file, seen next time
+                    continue
+                if mtimes.get(path) != mtime:
+                    mtimes[path] = mtime
+                    changed.append(path)
+            entries = await asyncio.gather(*(
+                self.compile(x, os.path.join(output_dir,
+                                             batch.output_name(x)),
+                             **options)
+                for x in changed))
+            for entry in entries:
+                print(describe(entry), flush=True)
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+def describe(entry: Dict) -> str:
+    if entry['status'] != 'ok':
+        return f'{entry["script"]}: {entry["error"]}'
+    cache = 'cached' if entry['cache_hit'] else 'built'
+    return (f'{entry["script"]} -> {entry["output"]} ({cache}, '
+            f'{entry["payload_bytes"]} bytes, {entry["seconds"]:.2f}s)')
+
+
+def send(request: Dict, socket_path: str = SOCKET_NAME) -> Dict:
+    '''
+    Sends a request to the server at `socket_path` and returns its answer.
+    Paths are made absolute, so the server finds them wherever it runs.
+    '''
+    request = dict(request)
+    for key in ('script', 'output'):
+        if request.get(key):
+            request[key] = os.path.abspath(request[key])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile('rwb') as f:
+            f.write(json.dumps(request).encode() + b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+
+async def run(server: CompileServer, args: argparse.Namespace) -> None:
+    tasks = [server.serve(args.socket)]
+    if args.watch:
+        tasks.append(server.watch(args.watch, args.output_dir,
+                                  text_encoding=args.text_encoding,
+                                  compress=args.compress,
+                                  opt_level=args.opt_level))
+    await asyncio.gather(*tasks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=SOCKET_NAME,
+                        help='Unix socket to serve on (default: '
+                             '%(default)s)')
+    parser.add_argument('--jobs', type=int,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('--watch', nargs='+', metavar='SCRIPT',
+                        help='rebuild these scripts whenever they change')
+    parser.add_argument('--output-dir', default='payloads',
+                        help='where the .hex files of the watched scripts '
+                             'are written (default: %(default)s)')
+    parser.add_argument('--text-encoding', default='keys',
+                        choices=sorted(dth.TEXT_ENCODINGS),
+                        help='for the watched scripts, see '
+                             'rubber_ducky_to_hex.py --text-encoding')
+    parser.add_argument('--compress', action='store_true',
+                        help='for the watched scripts, see '
+                             'rubber_ducky_to_hex.py --compress')
+    parser.add_argument('--opt-level', metavar='N', type=int,
+                        default=optimizer.DEFAULT_LEVEL,
+                        choices=range(optimizer.MAX_LEVEL + 1),
+                        help='for the watched scripts, see '
+                             'rubber_ducky_to_hex.py --opt-level')
+    parser.add_argument('--send', metavar='SCRIPT',
+                        help='ask the running server to build SCRIPT and '
+                             'print the manifest entry')
+    parser.add_argument('--output', metavar='PATH',
+                        help='.hex to write with --send')
+    args = parser.parse_args(argv)
+
+    if args.send:
+        entry = send({'script': args.send, 'output': args.output},
+                     args.socket)
+        print(json.dumps(entry, indent=2))
+        return 0 if entry['status'] == 'ok' else 1
+
+    server = CompileServer(args.jobs)
+    try:
+        asyncio.run(run(server, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
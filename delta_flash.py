@@ -0,0 +1,212 @@
+'''
+Flashes only the flash pages of a .hex that changed since the last flash.
+
+`dfu-programmer erase` followed by `flash` rewrites every page of the
+image, although a new payload only changes the pages of usb_keys - which
+starts at a page and fills whole pages (see payload.PAGE_SIZE), so nothing
+else moves when the firmware was built with --reserve and payloads are
+replaced with --patch. This compares the new .hex with the last flashed one
+page by page and writes
+
+    * an update .hex holding just the pages that differ, whole pages so the
+      bootloader rewrites each of them completely (bytes the new image does
+      not define are written erased, 0xFF)
+    * the flash plan: the pages, how much of the image they are and the
+      dfu-programmer commands that flash them
+
+Flashing the update without erasing the chip (`flash --force`) relies on
+the bootloader erasing every page before programming it, which was not
+verified on a board yet - so the plan only does that with --no-erase and
+otherwise erases and flashes the whole image, like it does when nothing is
+known about the flash (no image was recorded). Everything but --flash
+works offline.
+
+Usage: python delta_flash.py NEW_HEX [--last HEX] [--output HEX]
+                             [--plan JSON] [--no-erase] [--flash | --record]
+'''
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import ducky
+import intel_hex
+import payload
+
+MCU = 'at90usb1286'
+PAGE_SIZE = payload.PAGE_SIZE
+ERASED = 0xFF
+# Copy of the image flashed last, kept with the build cache
+LAST_FLASHED_PATH = os.path.join(ducky.BUILD_CACHE_PATH, 'flashed.hex')
+
+
+class FlashPlan(NamedTuple):
+    '''
+    The pages (start addresses) to write and the pages of the whole image.
+    `full` plans erase the chip and flash the whole image.
+    '''
+    pages: List[int]
+    image_pages: int
+    full: bool
+
+    @property
+    def ratio(self) -> float:
+        '''
+        Part of the image that is written, flashing takes about as long
+        '''
+        return len(self.pages) / self.image_pages if self.image_pages else 0.0
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        '''
+        Returns the pages as [start, end) ranges of adjacent pages
+        '''
+        result: List[Tuple[int, int]] = []
+        for page in self.pages:
+            if result and result[-1][1] == page:
+                result[-1] = (result[-1][0], page + PAGE_SIZE)
+            else:
+                result.append((page, page + PAGE_SIZE))
+        return result
+
+
+def read_image(path: str) -> bytearray:
+    '''
+    Returns the flash contents of a .hex, erased where it defines nothing,
+    up to a whole page
+    '''
+    with open(path, 'r') as f:
+        memory, _ = intel_hex.read_memory(f.read().splitlines())
+    return pad(memory, len(memory))
+
+
+def pad(memory: bytearray, size: int) -> bytearray:
+    '''
+    Returns `memory` erased up to `size` rounded up to a whole page
+    '''
+    size = -(-size // PAGE_SIZE) * PAGE_SIZE
+    return memory + bytes([ERASED]) * (size - len(memory))
+
+
+def changed_pages(old: bytes, new: bytes) -> List[int]:
+    '''
+    Returns the start of every page whose bytes differ between the flash
+    contents `old` and `new`
+    '''
+    size = max(len(old), len(new))
+    old, new = pad(bytearray(old), size), pad(bytearray(new), size)
+    return [x for x in range(0, size, PAGE_SIZE)
+            if old[x:x + PAGE_SIZE] != new[x:x + PAGE_SIZE]]
+
+
+def used_pages(memory: bytes) -> List[int]:
+    '''
+    Returns the start of every page that is not erased
+    '''
+    erased = bytes([ERASED]) * PAGE_SIZE
+    return [x for x in range(0, len(memory), PAGE_SIZE)
+            if memory[x:x + PAGE_SIZE] != erased]
+
+
+def plan(new: bytes, old: Optional[bytes] = None) -> FlashPlan:
+    '''
+    Returns what to flash to turn the flash contents `old` (unknown if None)
+    into `new`
+    '''
+    image_pages = len(used_pages(new))
+    if old is None:
+        return FlashPlan(used_pages(new), image_pages, True)
+    return FlashPlan(changed_pages(old, new), image_pages, False)
+
+
+def update_lines(new: bytes, flash_plan: FlashPlan) -> List[str]:
+    '''
+    Returns the .hex lines writing the pages of the plan
+    '''
+    size = max([len(new)] + [x + PAGE_SIZE for x in flash_plan.pages])
+    return intel_hex.format_memory(pad(bytearray(new), size),
+                                   flash_plan.ranges())
+
+
+def commands(flash_plan: FlashPlan, new_path: str, update_path: str,
+             erase: bool = True) -> List[List[str]]:
+    '''
+    Returns the dfu-programmer commands of the plan. Unless `erase` is
+    False, the chip is erased and the whole image flashed even if only some
+    pages changed.
+    '''
+    if not flash_plan.full and not flash_plan.pages:
+        return []
+    if flash_plan.full or erase:
+        return [['dfu-programmer', MCU, 'erase'],
+                ['dfu-programmer', MCU, 'flash', new_path]]
+    return [['dfu-programmer', MCU, 'flash', '--force', update_path]]
+
+
+def describe(flash_plan: FlashPlan, steps: List[List[str]]) -> Dict:
+    return {
+        'mcu': MCU,
+        'page_size': PAGE_SIZE,
+        'full': flash_plan.full,
+        'pages': len(flash_plan.pages),
+        'image_pages': flash_plan.image_pages,
+        'bytes': len(flash_plan.pages) * PAGE_SIZE,
+        'ratio': flash_plan.ratio,
+        'ranges': [[f'0x{start:05x}', f'0x{end:05x}']
+                   for start, end in flash_plan.ranges()],
+        'commands': steps,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('new', metavar='NEW_HEX', help='the image to flash')
+    parser.add_argument('--last', metavar='HEX', default=LAST_FLASHED_PATH,
+                        help='the image flashed last (default: the one '
+                             'recorded by --flash or --record)')
+    parser.add_argument('--output', metavar='HEX', default='update.hex',
+                        help='where the pages that changed are written '
+                             '(default: %(default)s)')
+    parser.add_argument('--plan', metavar='JSON',
+                        help='write the flash plan to JSON instead of '
+                             'printing it')
+    parser.add_argument('--no-erase', action='store_true',
+                        help='flash only the pages that changed, without '
+                             'erasing the chip (not verified on a board '
+                             'yet)')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--flash', action='store_true',
+                        help='run the commands of the plan and record '
+                             'NEW_HEX as flashed')
+    action.add_argument('--record', action='store_true',
+                        help='record NEW_HEX as flashed (after flashing it '
+                             'some other way)')
+    args = parser.parse_args(argv)
+
+    new = read_image(args.new)
+    old = read_image(args.last) if os.path.exists(args.last) else None
+    flash_plan = plan(new, old)
+    with open(args.output, 'w') as f:
+        f.write('\n'.join(update_lines(new, flash_plan)) + '\n')
+    steps = commands(flash_plan, args.new, args.output, not args.no_erase)
+    description = describe(flash_plan, steps)
+    if args.plan:
+        with open(args.plan, 'w') as f:
+            json.dump(description, f, indent=2)
+    else:
+        print(json.dumps(description, indent=2))
+
+    if args.flash:
+        for step in steps:
+            subprocess.run(step, check=True)
+    if args.flash or args.record:
+        os.makedirs(os.path.dirname(os.path.abspath(args.last)),
+                    exist_ok=True)
+        shutil.copyfile(args.new, args.last)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
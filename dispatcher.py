@@ -0,0 +1,58 @@
+'''
+Keyword dispatch used by both the DuckyScript parser and the HID converter.
+
+Instead of walking a chain of handlers and asking each of them whether it
+wants a line, the leading keyword of the line is extracted once and its
+handler is found with a single dictionary lookup.
+'''
+from typing import Dict, Optional
+
+
+class KeywordDispatcher(object):
+    '''
+    Maps DuckyScript keywords to the handler responsible for them.
+
+    Handlers are registered as a unit - every keyword in the handler's
+    `line_startings` set is routed to it.
+    Lines whose keyword is unknown go to the `default` handler if there is one.
+    '''
+    def __init__(self, default=None):
+        self.handlers: Dict[str, object] = {}
+        self.default = default
+
+    def register(self, handler):
+        for keyword in handler.line_startings:
+            if keyword in self.handlers:
+                raise Exception(
+                    f'Keyword "{keyword}" is already handled by '
+                    f'{type(self.handlers[keyword]).__name__}')
+            self.handlers[keyword] = handler
+        return self
+
+    def set_default(self, handler):
+        self.default = handler
+        return self
+
+    def lookup(self, line: str) -> Optional[object]:
+        '''
+        Returns the handler for `line` or the default handler.
+        Compound keywords such as "CONTROL-ALT" fall back to their first part.
+        '''
+        keyword = self.keyword(line)
+        handler = self.handlers.get(keyword)
+        if handler is None and '-' in keyword:
+            handler = self.handlers.get(keyword.split('-', 1)[0])
+        if handler is None:
+            handler = self.default
+        return handler
+
+    def handle(self, line: str):
+        handler = self.lookup(line)
+        if handler is None:
+            raise Exception(f'No available handler found for: {line}')
+        return handler.handle(line)
+
+    @staticmethod
+    def keyword(line: str) -> str:
+        splitted = line.split(None, 1)
+        return splitted[0] if splitted else ''
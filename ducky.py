@@ -0,0 +1,270 @@
+'''
+Library API of the compiler: DuckyScript in, payload bytes, the usb_keys C
+array or a .hex out.
+
+    import ducky
+    keys = ducky.compile_script('GUI r\nSTRING notepad\nENTER\n')
+    keys.keys                                # the bytes of the payload
+    ducky.c_array([keys])                    # the usb_keys line
+    ducky.patch_hex('template.hex', [keys])  # a .hex built with --reserve
+    ducky.build_hex([keys], 'payload.hex')   # compiles the firmware
+
+A script is DuckyScript text or an iterable of lines (an open file works).
+Nothing here prints or depends on the working directory - the firmware tree
+and the build cache are found next to this file unless they are given.
+The compiler modules are imported by the first function that needs them,
+the optimizer only when it runs, the profiler only when a profile is given
+and the firmware build only by the functions that build, so importing this
+module (and rubber_ducky_to_hex.py --help) takes no time.
+'''
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, \
+    Tuple, TypeVar, Union
+import io
+import os
+import time
+import lru
+import payload
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_PATH = os.path.join(ROOT_PATH, 'USB Keyboard',
+                             'USBKEY_STK525-series6-hidkbd-2_0_3-doc')
+BUILD_CACHE_PATH = os.path.join(ROOT_PATH, '.build_cache')
+# Paths inside the firmware tree
+DEMO_PATH = os.path.join('at90usb128', 'demo', 'USBKEY_STK525-series6-hidkbd')
+KEYBOARD_TASK = os.path.join(DEMO_PATH, 'keyboard_task.c')
+MAKEFILE_DIR = os.path.join(DEMO_PATH, 'gcc')
+HEX = os.path.join(MAKEFILE_DIR, 'USBKEY_STK525-series6-hidkbd.hex')
+
+# The names of ducky_to_hid.TEXT_ENCODINGS, optimizer.MAX_LEVEL and
+# optimizer.DEFAULT_LEVEL, so options can be checked without importing the
+# compiler
+TEXT_ENCODINGS = ('ascii', 'keys', 'packed')
+MAX_OPT_LEVEL = 3
+DEFAULT_OPT_LEVEL = 2
+
+Script = Union[str, Iterable[str]]
+T = TypeVar('T')
+
+
+def iter_script(script: Script) -> Iterator[str]:
+    '''
+    Yields the lines of `script` without their line endings
+    '''
+    if isinstance(script, str):
+        return iter(script.splitlines())
+    return (x.rstrip('\r\n') for x in script)
+
+
+class NullProfile(object):
+    '''
+    A disabled profiler.Profile, without importing profiler and tracemalloc:
+    every stage passes through untouched
+    '''
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        yield info
+
+    def run(self, name: str, items: Iterable[T],
+            info: Callable[[], dict] = dict) -> Iterable[T]:
+        return items
+
+    def count_lines(self, lines: Iterable[str]) -> Iterable[str]:
+        return lines
+
+    def track_ops(self, ops: Iterable[T]) -> Iterable[T]:
+        return ops
+
+    def count_bytes(self, converted: Iterable[bytes]) -> Iterable[bytes]:
+        return converted
+
+
+def convert_script(script: Script, converter,
+                   opt_level: int = DEFAULT_OPT_LEVEL,
+                   compress: bool = False, profile=None,
+                   log: Optional[Callable[[str], object]] = None,
+                   parser=None) -> Tuple[Iterable[bytes], int]:
+    '''
+    Returns the keys `converter` (a ducky_to_hid.DuckyScriptConverter)
+    converts the script to, as chunks, and the header flags for them.
+    The script is parsed by `parser` (a new
+    ducky_script_parser.DuckyScriptParser by default), the stages are
+    recorded in the profiler.Profile `profile` (none by default) and what
+    they did is passed to `log` - once the chunks were read, as they are
+    streamed.
+    '''
+    import ducky_script_parser as dsp
+    if profile is None:
+        profile = NullProfile()
+    if parser is None:
+        parser = dsp.DuckyScriptParser()
+    # what the optimizer did is only counted when it is shown
+    report = log is not None or profile.enabled
+    if log is None:
+        log = _ignore
+
+    # Every stage is a generator so the script is streamed line by line
+    # from the script into keyboard_task.c (unless profiling)
+    ducky_script_lines = profile.run('read', iter_script(script))
+    ops = profile.run('parse', profile.track_ops(
+        parser.iter_parse(profile.count_lines(ducky_script_lines))))
+    converted = profile.run('convert', profile.count_bytes(
+        converter.iter_convert(ops)))
+
+    if opt_level:
+        import optimizer
+        keys_optimizer = optimizer.Optimizer(opt_level, report)
+        converted = profile.run(
+            'optimize', keys_optimizer.iter_optimize(converted),
+            lambda: {'passes': [x._asdict() for x in keys_optimizer.passes]})
+        converted = _then(converted, lambda: [
+            log(f'optimizer: {x}') for x in keys_optimizer.passes])
+
+    flags = 0
+    if compress:
+        with profile.stage('compress') as info:
+            keys, flags, ratio = compress_keys(converted)
+            converted = [keys]
+            info['ratio'] = ratio
+        log(f'compression ratio: {ratio:.2f}'
+            + ('' if flags else ' (stored uncompressed)'))
+    return converted, flags
+
+
+def _ignore(*_) -> None:
+    pass
+
+
+def _then(chunks: Iterable[bytes], done: Callable[[], object]
+          ) -> Iterator[bytes]:
+    '''
+    Yields the chunks, then calls `done`
+    '''
+    yield from chunks
+    done()
+
+
+def compile_script(script: Script, text_encoding: str = 'keys',
+                   opt_level: int = DEFAULT_OPT_LEVEL,
+                   compress: bool = False,
+                   cache_size: int = lru.DEFAULT_SIZE) -> payload.Payload:
+    '''
+    Returns the payload of a script, see rubber_ducky_to_hex.py for the
+    options. `cache_size` lines and ops are cached while parsing and
+    converting, 0 disables the caches.
+    '''
+    import ducky_script_parser as dsp
+    import ducky_to_hid as dth
+    chunks, flags = convert_script(
+        script, dth.DuckyScriptConverter(text_encoding, cache_size),
+        opt_level, compress, parser=dsp.DuckyScriptParser(cache_size))
+    return payload.Payload(b''.join(chunks), flags)
+
+
+def compress_keys(converted: Iterable[bytes]) -> Tuple[bytes, int, float]:
+    '''
+    Returns the keys to store, the header flags for them and the size of the
+    compressed keys relative to the keys. Keys that compression does not
+    make smaller are returned as they are.
+    '''
+    import compress
+    keys = b''.join(converted)
+    compressed = compress.compress(keys)
+    ratio = len(compressed) / len(keys) if keys else 1.0
+    if len(compressed) < len(keys):
+        return compressed, payload.COMPRESSED, ratio
+    return keys, 0, ratio
+
+
+def c_array(payloads: Sequence[payload.Payload],
+            capacity: Optional[int] = None) -> str:
+    '''
+    Returns the usb_keys line of keyboard_task.c holding `payloads`
+    '''
+    f = io.StringIO()
+    payload.write_c_array(f, [([x.keys], x.flags) for x in payloads],
+                          capacity)
+    return f.getvalue()
+
+
+def patch_hex(template: Union[str, List[str]],
+              payloads: Sequence[payload.Payload]) -> str:
+    '''
+    Returns the .hex at the path `template` (or with the lines `template`),
+    built with --reserve, with its payloads replaced by `payloads`
+    '''
+    import intel_hex
+    if isinstance(template, str):
+        with open(template, 'r') as f:
+            template = f.read().splitlines()
+    return '\n'.join(intel_hex.patch(template, payloads)) + '\n'
+
+
+def build_hex(payloads: Sequence[payload.Payload], output_path: str,
+              firmware_path: str = FIRMWARE_PATH,
+              cache_path: str = BUILD_CACHE_PATH,
+              reserve: Optional[int] = None, jobs: Optional[int] = None,
+              quiet: bool = True):
+    '''
+    Builds the firmware typing `payloads` into `output_path` and returns
+    the build.BuildReport, see `compile_payload`
+    '''
+    import build
+    return compile_payload([([x.keys], x.flags) for x in payloads],
+                           firmware_path, output_path,
+                           build.BuildCache(cache_path), reserve, jobs, quiet)
+
+
+def compile_payload(payloads: Sequence[Tuple[Iterable[bytes], int]],
+                    firmware_path: str, output_path: str,
+                    cache, reserve: Optional[int] = None,
+                    jobs: Optional[int] = None,
+                    quiet: bool = False):
+    '''
+    Writes the (keys, header flags) `payloads` into keyboard_task.c of the
+    firmware tree at `firmware_path` and builds it into `output_path` using
+    the build.BuildCache `cache`. `quiet` hides the output of make.
+    Returns the build.BuildReport, whose `payload_size` is the number of
+    keys of all payloads.
+    The reserved codes and keycodes #defined by the firmware are checked
+    against the ones the keys were encoded with before anything is written.
+    '''
+    import build
+    import hid_keys
+    import symbols
+    import utilities
+    problems = symbols.check(symbols.load(
+        firmware_path, os.path.join(cache.cache_dir, symbols.CACHE_NAME)))
+    if problems:
+        raise ValueError('The firmware does not match the encoded keys: '
+                         + '; '.join(problems))
+    # overwrite the usb_keys line of keyboard_task.c
+    sizes = []
+    start = time.perf_counter()
+    # the table STRING_KEY characters are typed with, kept in step with
+    # hid_keys.CHARACTERS
+    utilities.rewrite_line(
+        os.path.join(firmware_path, KEYBOARD_TASK), 'const U8 code ascii_keys',
+        lambda f: f.write(utilities.create_array_string(
+            'const U8 code', 'ascii_keys',
+            ', '.join(map(str, hid_keys.ascii_table())))))
+    utilities.rewrite_line(
+        os.path.join(firmware_path, KEYBOARD_TASK), 'const U8 code usb_keys',
+        lambda f: sizes.extend(payload.write_c_array(f, payloads, reserve)))
+    codegen_time = time.perf_counter() - start
+    # run make unless this exact firmware was built before
+    report = build.build(firmware_path,
+                         os.path.join(firmware_path, MAKEFILE_DIR),
+                         os.path.join(firmware_path, HEX), output_path,
+                         cache, jobs, quiet)
+    report.steps.insert(0, ('codegen', codegen_time))
+    report.payload_size = sum(sizes)
+    return report
@@ -0,0 +1,89 @@
+'''
+Intermediate representation shared by `ducky_script_parser` and
+`ducky_to_hid`.
+
+The parser validates each DuckyScript line and emits one op; the converter
+turns ops into the bytes of the `usb_keys` array without looking at the
+script text again.
+All keycodes and modifiers are integers (see `hid_keys`).
+'''
+
+
+class Op(object):
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __hash__(self):
+        return hash((type(self),) +
+                    tuple(getattr(self, x) for x in self.__slots__))
+
+    def __repr__(self):
+        values = ', '.join(repr(getattr(self, x)) for x in self.__slots__)
+        return f'{type(self).__name__}({values})'
+
+
+class Key(Op):
+    '''
+    A single key press
+    '''
+    __slots__ = ('keycode',)
+
+    def __init__(self, keycode: int):
+        self.keycode = keycode
+
+
+class Chord(Op):
+    '''
+    A key pressed while holding `modifiers` (a HID modifier bit mask).
+    keycode 0 presses the modifiers alone.
+    '''
+    __slots__ = ('modifiers', 'keycode')
+
+    def __init__(self, modifiers: int, keycode: int = 0):
+        self.modifiers = modifiers
+        self.keycode = keycode
+
+
+class Text(Op):
+    '''
+    Text typed character by character
+    '''
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class Delay(Op):
+    '''
+    Pause for `ms` milliseconds
+    '''
+    __slots__ = ('ms',)
+
+    def __init__(self, ms: int):
+        self.ms = ms
+
+
+class Repeat(Op):
+    '''
+    Run `op` another `count` times
+    '''
+    __slots__ = ('op', 'count')
+
+    def __init__(self, op: Op, count: int):
+        self.op = op
+        self.count = count
+
+
+class Call(Op):
+    '''
+    The ops of the FUNCTION `name`, typed where it is called
+    '''
+    __slots__ = ('name', 'ops')
+
+    def __init__(self, name: str, ops: tuple = ()):
+        self.name = name
+        self.ops = ops
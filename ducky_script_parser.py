@@ -1,78 +1,146 @@
 from abc import ABC, abstractmethod
-from typing import List, Set
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import re
+from dispatcher import KeywordDispatcher
+from ducky_ir import Op, Key, Chord, Text, Delay, Repeat, Call
+import hid_keys
+import lru
 
-last_typed = ''
+# Directives whose op depends on the lines before them, never cached
+UNCACHED_KEYWORDS = frozenset(['REPEAT', 'CALL', 'FUNCTION', 'END_FUNCTION'])
+
+
+def normalize(line: str) -> str:
+    '''
+    Returns the line without the whitespace around it and with single spaces
+    between its words. The text of a STRING is kept as it is.
+    '''
+    line = line.lstrip()
+    if KeywordDispatcher.keyword(line) == 'STRING':
+        return line
+    return ' '.join(line.split())
 
 
 class DuckyScriptParser(object):
     '''
     Use this class to parse DuckyScript.
-    It implements chain of responsibility pattern to match each type of line
-    that can be found in the DuckyScript language
+    Each type of line that can be found in the DuckyScript language has its
+    own LineParser, looked up by the line's leading keyword
+
+    Lines are parsed as `normalize` returns them. The ops of the last
+    `cache_size` distinct normalized lines are cached (0 disables the
+    cache), so a line that was parsed before - with any whitespace around
+    its words - costs a single lookup.
+    Lines whose keyword is in `uncached` are always parsed.
     '''
-    def __init__(self):
-        self.first_parser = CommentParser(set(['REM']))
-
-        # Create chain of responsibility
-        self.first_parser.set_next(StringParser(set(['STRING'])))\
-                         .set_next(WindowsParser(set(['WINDOWS', 'GUI'])))\
-                         .set_next(MenuParser(set(['MENU', 'APP'])))\
-                         .set_next(ShiftParser(set(['SHIFT'])))\
-                         .set_next(AltParser(set(['ALT'])))\
-                         .set_next(ControlParser(set(['CONTROL', 'CTRL'])))\
-                         .set_next(ArrorParser(set(['DOWNARROW', 'DOWN',
-                                                    'LEFTARROW', 'LEFT',
-                                                    'RIGHTARROW', 'RIGHT',
-                                                    'UPARROW', 'UP'])))\
-                         .set_next(
-                             ExtendedParser(set(ExtendedParser.allowed)))\
-                         .set_next(RepeatParser(set('REPEAT')))\
-                         .set_next(DelayParser(set('DELAY')))
-
-    def parse(self, lines: List[str]) -> str:
-        global last_typed
-        result = ''
+    def __init__(self, cache_size: int = lru.DEFAULT_SIZE):
+        self.cache = lru.create(cache_size)
+        self.uncached = set(UNCACHED_KEYWORDS)
+        self.dispatcher = KeywordDispatcher()
+
+        # Register every handler under the keywords it parses
+        self.dispatcher.register(CommentParser(set(['REM'])))\
+                       .register(StringParser(set(['STRING'])))\
+                       .register(WindowsParser(set(['WINDOWS', 'GUI'])))\
+                       .register(MenuParser(set(['MENU', 'APP'])))\
+                       .register(ShiftParser(set(['SHIFT'])))\
+                       .register(AltParser(set(['ALT'])))\
+                       .register(ControlParser(set(['CONTROL', 'CTRL'])))\
+                       .register(ArrorParser(set(['DOWNARROW', 'DOWN',
+                                                  'LEFTARROW', 'LEFT',
+                                                  'RIGHTARROW', 'RIGHT',
+                                                  'UPARROW', 'UP'])))\
+                       .register(
+                           ExtendedParser(set(ExtendedParser.allowed)))\
+                       .register(RepeatParser(set(['REPEAT'])))\
+                       .register(DelayParser(set(['DELAY'])))\
+                       .register(FunctionParser(set(['FUNCTION',
+                                                     'END_FUNCTION'])))\
+                       .register(CallParser(set(['CALL'])))
+
+    def parse(self, lines: Iterable[str]) -> List[Op]:
+        return list(self.iter_parse(lines))
+
+    def parse_line(self, line: str) -> Optional[Op]:
+        '''
+        Returns the op of a line, from the cache if it was parsed before.
+        Cached ops are shared, they must not be changed.
+        '''
+        line = normalize(line)
+        if self.cache is None:
+            return self.dispatcher.handle(line)
+        parsed = self.cache.get(line, lru.MISSING)
+        if parsed is lru.MISSING:
+            parsed = self.dispatcher.handle(line)
+            # lines that failed to parse raised and are not stored either
+            if KeywordDispatcher.keyword(line) not in self.uncached:
+                self.cache.put(line, parsed)
+        return parsed
+
+    def iter_parse(self, lines: Iterable[str]) -> Iterator[Op]:
+        '''
+        Parses the lines lazily, yielding one op per line that types something
+        '''
+        # state of this parse only, so one parser can run many parses at once
+        last_typed = None
+        functions: Dict[str, Tuple[Op, ...]] = {}
+        # the FUNCTION being defined and what was typed before it
+        function: Optional[FunctionStart] = None
+        typed_before = None
         for line in lines:
-            parsed = self.first_parser.handle(line)
-            result += parsed + '\n'
+            parsed = self.parse_line(line)
+            if parsed is None:
+                # comments produce nothing to type
+                continue
+            if isinstance(parsed, FunctionStart):
+                if function is not None:
+                    raise Exception(f'FUNCTION {function.name} is not ended '
+                                    f'before: {line}')
+                if parsed.name in functions:
+                    raise Exception(f'FUNCTION {parsed.name} is already '
+                                    f'defined: {line}')
+                function, typed_before, last_typed = parsed, last_typed, None
+                continue
+            if isinstance(parsed, FunctionEnd):
+                if function is None:
+                    raise Exception(f'END_FUNCTION without FUNCTION: {line}')
+                functions[function.name] = tuple(function.ops)
+                function, last_typed = None, typed_before
+                continue
+            if isinstance(parsed, Call):
+                # a FUNCTION cannot call itself as it is defined at its end
+                if parsed.name not in functions:
+                    raise Exception(f'FUNCTION {parsed.name} is not defined '
+                                    f'before: {line}')
+                parsed.ops = functions[parsed.name]
+            if isinstance(parsed, Repeat):
+                if last_typed is None:
+                    raise Exception(f'Nothing to repeat before: {line}')
+                parsed.op = last_typed
             last_typed = parsed
-        # Generate c code here instead of printing
-        print(result)
-
-        return result
+            if function is not None:
+                function.ops.append(parsed)
+            else:
+                yield parsed
+        if function is not None:
+            raise Exception(f'FUNCTION {function.name} has no END_FUNCTION')
 
 
 class LineParser(ABC):
     def __init__(self, line_start: Set[str]):
         self.line_startings = line_start
-        self.next_parser = None
 
-    def set_next(self, parser):
-        self.next_parser = parser
-        return self.next_parser
-
-    def handle(self, line: str) -> str:
-        if self.__should_parse(line):
-            parsed = self._parse(line)
-            return parsed
-        else:
-            if self.next_parser is not None:
-                return self.next_parser.handle(line)
-            raise Exception(f'No available parser found to parse: {line}')
+    def handle(self, line: str) -> Optional[Op]:
+        return self._parse(line)
 
     @abstractmethod
-    def _parse(self, line) -> str:
+    def _parse(self, line) -> Optional[Op]:
         '''
-        This method parses the line and returns a string which has to be send
-        from the keyboard device and ready to be converted to HID values.
+        This method validates the line and returns the op describing what has
+        to be sent from the keyboard device.
         '''
         pass
 
-    def __should_parse(self, line: str) -> bool:
-        return any(
-         [line.startswith(start) for start in self.line_startings]
-        )
-
 
 class CommentParser(LineParser):
     def _parse(self, line):
@@ -83,16 +151,16 @@ class CommentParser(LineParser):
 
 
 class StringParser(LineParser):
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Text:
         '''
         This method creates parses the "STRING" directive
         '''
-        result = line.split(' ', 1)[1]
+        result = Text(line.split(' ', 1)[1])
         return result
 
 
 class WindowsParser(LineParser):
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Chord:
         '''
         This method parses "GUI" and "WINDOWS" directives.
         The DuckyScript specification allows only a single char to be send with
@@ -101,10 +169,14 @@ class WindowsParser(LineParser):
         splitted = line.split()
         if len(splitted) == 1:
             # just keyword
-            result = 'GUI'
+            result = Chord(hid_keys.MODIFIER_LEFT_GUI)
         elif len(splitted) == 2:
             # keyword and char
-            result = 'GUI ' + splitted[1]
+            if len(splitted[1]) != 1:
+                raise Exception(f'GUI button can be pressed with a single '
+                                f'char, got {line}')
+            result = Chord(hid_keys.MODIFIER_LEFT_GUI,
+                           hid_keys.keycode(splitted[1]))
         else:
             # disallow GUI and multiple buttons
             raise Exception(
@@ -114,12 +186,12 @@ class WindowsParser(LineParser):
 
 
 class MenuParser(LineParser):
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Chord:
         '''
         This method parses "APP" and "MENU" directives.
         Returns a "SHIFT-F10" key combo
         '''
-        result = 'SHIFT F10'
+        result = Chord(hid_keys.MODIFIER_LEFT_SHIFT, hid_keys.keycode('F10'))
 
         return result
 
@@ -129,7 +201,7 @@ class ShiftParser(LineParser):
                'WINDOWS', 'GUI', 'UPARROW', 'DOWNARROW', 'LEFTARROW',
                'RIGHTARROW', 'TAB']
 
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Chord:
         '''
         This method parses "SHIFT" directive.
         Capital letters are not written using shift but with caps lock.
@@ -138,7 +210,7 @@ class ShiftParser(LineParser):
         splitted = line.split()
         if len(splitted) == 1:
             # only shift
-            result = 'SHIFT'
+            result = Chord(hid_keys.MODIFIER_LEFT_SHIFT)
 
             return result
         elif len(splitted) == 2:
@@ -149,7 +221,13 @@ class ShiftParser(LineParser):
                     f'"SHIFT" is allowed only in combination with: \
                     {self.allowed}')
 
-            result = 'SHIFT' + splitted[1]
+            if splitted[1] in ('WINDOWS', 'GUI'):
+                # GUI is a modifier rather than a key
+                result = Chord(hid_keys.MODIFIER_LEFT_SHIFT
+                               | hid_keys.MODIFIER_LEFT_GUI)
+            else:
+                result = Chord(hid_keys.MODIFIER_LEFT_SHIFT,
+                               hid_keys.keycode(splitted[1]))
 
             return result  # return checked line
         else:
@@ -161,7 +239,7 @@ class AltParser(LineParser):
     allowed = ['END', 'ESC', 'ESCAPE', 'F1', 'F2', 'F3', 'F4', 'F5', 'F6',
                'F7', 'F8', 'F9', 'F10', 'F11', 'F12', 'SPACE', 'TAB']
 
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Chord:
         '''
         This method parses "ALT" directive.
         A single optional parameter is allowed
@@ -169,7 +247,7 @@ class AltParser(LineParser):
         splitted = line.split()
         if len(splitted) == 1:
             # only alt
-            result = 'ALT'
+            result = Chord(hid_keys.MODIFIER_LEFT_ALT)
 
             return result
         elif len(splitted) == 2:
@@ -181,10 +259,8 @@ class AltParser(LineParser):
                     f'"ALT" is allowed only in combination with: \
                     {self.allowed} and any single chars')
 
-            # quick fix escape
-            if splitted[1] == 'ESC':
-                splitted[1] = 'ESCAPE'
-            result = 'ALT' + splitted[1]
+            result = Chord(hid_keys.MODIFIER_LEFT_ALT,
+                           hid_keys.keycode(splitted[1]))
 
             return result  # return checked line
         else:
@@ -195,9 +271,10 @@ class AltParser(LineParser):
 class ControlParser(LineParser):
     allowed = ['ENTER', 'BREAK', 'ESC', 'ESCAPE', 'F1', 'F2', 'F3', 'F4',
                'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12', 'PAUSE']
-    allowed_modifiers = ['ALT', 'SHIFT']
+    allowed_modifiers = {'ALT': hid_keys.MODIFIER_LEFT_ALT,
+                         'SHIFT': hid_keys.MODIFIER_LEFT_SHIFT}
 
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Chord:
         '''
         This method parses "Control" directive.
         A single optional parameter is allowed
@@ -217,19 +294,21 @@ class ControlParser(LineParser):
             raise Exception(
                 f'"CONTROL" can be used with at most 1 argument, got: {line}')
 
+        modifiers = hid_keys.MODIFIER_LEFT_CTRL
         # check for 'CONTROL-MODIFIER' combo
         control_combo = splitted[0].split('-')
         if len(control_combo) > 1:
             # check if second key is allowed
             if control_combo[1] not in self.allowed_modifiers:
                 raise Exception(f'You can use control with another modifier\
-from the list: {self.allowed_modifiers},\
+from the list: {list(self.allowed_modifiers)},\
 got: {line}')
-        return line  # return checked line
+            modifiers |= self.allowed_modifiers[control_combo[1]]
+        return Chord(modifiers, hid_keys.keycode(splitted[1]))
 
 
 class ArrorParser(LineParser):
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Key:
         '''
         This method parses arrow directives.
         Trims the "ARROR" suffix
@@ -239,7 +318,7 @@ class ArrorParser(LineParser):
                 (splitted[0] not in {'LEFT', 'RIGHT', 'UP', 'DOWN'}):
             raise Exception(f'Invalid input: {line}. Allowed arrow inputs\
  are (UP|DOWN|LEFT|RIGHT)[ARROW]')
-        result = splitted[0]
+        result = Key(hid_keys.keycode(splitted[0]))
 
         return result
 
@@ -248,51 +327,49 @@ class ExtendedParser(LineParser):
     allowed = ['SPACE', 'INSERT', 'ENTER', 'CAPSLOCK',
                'DELETE', 'END', 'HOME', 'INSERT', 'ESCAPE']
 
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Key:
         '''
         This method handles some additional special keys that are not typeable.
         '''
-        # For now just return the pressed key and deal with it elsewhere
-        if line.replace('\n', '') in self.allowed:  # if line is only 1 keyword
-            return line
+        line = line.replace('\n', '')
+        if line in self.allowed:  # if line is only 1 keyword
+            return Key(hid_keys.keycode(line))
         else:
-            breakpoint()
             raise Exception(f'One keyword per statement, got: "{line}"')
 
 
 class RepeatParser(LineParser):
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Repeat:
         '''
         This method parses the "REPEAT" directive.
-        It repeats the last_typed n times.
-        Does so by parsing is again and again n times
+        It repeats the last typed op n times. The op to repeat is filled in
+        by DuckyScriptParser which knows what was typed last.
         '''
-        global last_typed
         splitted = line.split()
-        if len(splitted) != 2:
-            breakpoint()
+        if len(splitted) != 2 or not splitted[1].isdigit():
             raise Exception(
-                f'"REPEAT" directive takes 1 int argument, got: {line}')
+                f'"REPEAT" directive takes 1 positive int argument, got: '
+                f'{line}')
         # try parse argument as int
         times = int(splitted[1])
 
-        # re-parse last command `times` times
-        result = (last_typed + '\n') * times
+        result = Repeat(None, times)
         return result
 
 
 class DelayParser(LineParser):
-    def _parse(self, line: str) -> str:
+    def _parse(self, line: str) -> Delay:
         '''
         This method parses the "DELAY" directive.
         Sleeping is done in C code so just check everything is okay here.
 
-        Directive format is: DELAY <int>
+        Directive format is: DELAY <positive int>
         '''
         splitted = line.split()
-        if len(splitted) != 2 or not self.try_parse(splitted[1], int):
-            raise ValueError('DELAY format is: DELAY <int>')
-        return line
+        if len(splitted) != 2 or not self.try_parse(splitted[1], int)\
+                or int(splitted[1]) < 0:
+            raise ValueError('DELAY format is: DELAY <positive int>')
+        return Delay(int(splitted[1]))
 
     def try_parse(self, val: str, t: type) -> bool:
         try:
@@ -300,3 +377,57 @@ class DelayParser(LineParser):
             return True
         except ValueError:
             return False
+
+
+class FunctionStart(Op):
+    '''
+    Starts the definition of a FUNCTION, the ops up to its FunctionEnd are
+    its body. Never leaves the parser.
+    '''
+    __slots__ = ('name', 'ops')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.ops: List[Op] = []
+
+
+class FunctionEnd(Op):
+    __slots__ = ()
+
+
+# FUNCTION names, DuckyScript 3 style parentheses are allowed
+FUNCTION_NAME = re.compile(r'(\w+)(?:\(\))?')
+
+
+def function_name(line: str) -> str:
+    splitted = line.split()
+    match = FUNCTION_NAME.fullmatch(splitted[1]) if len(splitted) == 2 \
+        else None
+    if match is None:
+        raise Exception(f'"{splitted[0]}" takes a function name, got: {line}')
+    return match.group(1)
+
+
+class FunctionParser(LineParser):
+    def _parse(self, line: str) -> Op:
+        '''
+        This method parses the "FUNCTION" and "END_FUNCTION" directives.
+        The lines between them are the body of the function, which is typed
+        where the function is called. DuckyScriptParser collects the body.
+        '''
+        if line.split()[0] == 'END_FUNCTION':
+            if len(line.split()) != 1:
+                raise Exception(f'"END_FUNCTION" takes no argument, got: '
+                                f'{line}')
+            return FunctionEnd()
+        return FunctionStart(function_name(line))
+
+
+class CallParser(LineParser):
+    def _parse(self, line: str) -> Call:
+        '''
+        This method parses the "CALL" directive. The body of the function is
+        filled in by DuckyScriptParser which knows the functions defined so
+        far.
+        '''
+        return Call(function_name(line))
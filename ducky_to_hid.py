@@ -1,362 +1,367 @@
 '''
-This script converts ducky script output from
-'ducky_script_parser.DuckyScriptConverter'
-and produces a valid c array containing all the HID_keys
+This script converts the ops produced by
+'ducky_script_parser.DuckyScriptParser'
+and produces the HID values for the usb_keys c array
 '''
 from abc import ABC, abstractmethod
-from typing import List, Set
+from typing import Dict, Iterable, Iterator, List
+import re
 import string
+import warnings
+from ducky_ir import Op, Key, Chord, Text, Delay, Repeat, Call
+from compress import instructions
+import hid_keys
+import lru
+
+# REPEAT_KEY operands are 16 bit
+MAX_REPEAT = 2**16 - 1
+# The REPORT_KEY key count is 8 bit
+MAX_PACKED = 2**8 - 1
+# The STRING_KEY length is 8 bit
+MAX_STRING = 2**8 - 1
+# Ops made of other ops, never cached - their parts are cached anyway
+UNCACHED_OPS = frozenset([Repeat, Call])
 
 
 class DuckyScriptConverter(object):
     '''
-    Use this class to parse DuckyScript.
-    It implements chain of responsibility pattern to match each type of line
-    that can be found in the DuckyScript language
+    Use this class to convert parsed DuckyScript.
+    Each type of op has its own OpConverter, looked up by the op's type.
+    The parser has already validated every line so ops are converted as is.
+
+    `text_encoding` selects how STRING text is typed - 'keys' sends a report
+    and an empty report per key, 'packed' uses REPORT_KEY runs which need
+    about half as many reports, 'ascii' stores the text itself - about a
+    byte per character.
+
+    The keys of the last `cache_size` ops converted are cached (0 disables
+    the cache), so an op that was converted before costs a single lookup.
+    Ops are looked up by identity - DuckyScriptParser returns the same op
+    for every line its cache hit, and hashing ops is slower than
+    converting most of them. Ops whose type is in `uncached` are always
+    converted.
     '''
-    def __init__(self):
-        self.first_parser = WindowsConverter(set(['GUI']))
-
-        # Create chain of responsibility
-        # StringConverter MUST be last!
-        self.first_parser.set_next(MenuConverter(set(['MENU', 'APP'])))\
-                         .set_next(ShiftConverter(set(['SHIFT'])))\
-                         .set_next(AltConverter(set(['ALT'])))\
-                         .set_next(ControlConverter(set(['CONTROL', 'CTRL'])))\
-                         .set_next(ArrorConverter(set(['DOWN', 'LEFT', 'RIGHT',
-                                                       'UP'])))\
-                         .set_next(ExtendedConverter(
-                             set(ExtendedConverter.allowed)))\
-                         .set_next(DelayConverter(set('DELAY')))\
-                         .set_next(StringConverter(set(
-                             [x for x in string.printable])))
-
-    def convert(self, lines: List[str]) -> str:
-        result = ['HID_ENTER']  # LaFortuna misses first key for some reason
-        for line in lines:
-            if not line:
-                continue
-            parsed = self.first_parser.handle(line)
-            result.append(parsed)
-        # Generate c code here instead of printing
-        return ', '.join(result)
-
-
-class LineConverter(ABC):
-    def __init__(self, line_start: Set[str]):
-        self.line_startings = line_start
-        self.next_parser = None
-
-    def set_next(self, parser):
-        self.next_parser = parser
-        return self.next_parser
-
-    def handle(self, line: str) -> str:
-        if self.__should_parse(line):
-            parsed = self._convert(line)
-            return parsed
-        else:
-            if self.next_parser is not None:
-                return self.next_parser.handle(line)
-            raise Exception(f'No available converter found to convert: {line}')
-
-    @abstractmethod
-    def _convert(self, line) -> str:
+    def __init__(self, text_encoding: str = 'keys',
+                 cache_size: int = lru.DEFAULT_SIZE):
+        if text_encoding not in TEXT_ENCODINGS:
+            raise ValueError(f'Unknown text encoding: {text_encoding}')
+        self.cache = lru.create(cache_size)
+        self.uncached = set(UNCACHED_OPS)
+        self.converters: Dict[type, OpConverter] = {}
+
+        # Register every converter under the op type it converts
+        self.register(KeyConverter(Key))\
+            .register(ChordConverter(Chord))\
+            .register(TEXT_ENCODINGS[text_encoding](Text))\
+            .register(DelayConverter(Delay))\
+            .register(RepeatConverter(Repeat, self))\
+            .register(CallConverter(Call, self))
+
+    def register(self, converter):
+        self.converters[converter.op_type] = converter
+        return self
+
+    @property
+    def keystrokes_saved(self) -> int:
         '''
-        This method parses the line and returns a string which has to be send
-        from the keyboard device and ready to be converted to HID values.
+        Keystrokes saved so far by not toggling caps lock around every capital
         '''
-        pass
-
-    def __should_parse(self, line: str) -> bool:
-        return any(
-         [line.startswith(start) for start in self.line_startings]
-        )
+        return self.converters[Text].keystrokes_saved
 
+    def convert(self, ops: Iterable[Op]) -> bytes:
+        return b''.join(self.iter_convert(ops))
 
-class StringConverter(LineConverter):
-    def _convert(self, line: str) -> str:
-        '''
-        This method creates parses plain strings
-        For each character it converts it to its HID value
-        '''
-        result = []
-        for char in line:
-            if char.isdigit():
-                result.append('HID_' + char)
-            elif char.isalpha() and char.islower():
-                result.append('HID_' + char.upper())
-            elif char.isalpha() and char.isupper():
-                result.append('HID_CAPS_LOCK, ' + 'HID_' + char
-                              + ', HID_CAPS_LOCK')
-            else:
-                result.append(self.convert_special(char))
-        return ', '.join(result)
-
-    def convert_special(self, char: str) -> str:
-        if len(char) != 1:
-            raise ValueError(
-                f'This method converts single chars only, got {char}')
-        result = ''
-        if char == '"':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, '\
-                + 'HID_SINGLEQUOTE'
-        elif char == "'":
-            result = 'HID_SINGLEQUOTE'
-        elif char == '(':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_9'
-        elif char == ')':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_0'
-        elif char == '*':
-            result = 'HID_KEYPAD_MULTIPLY'
-        elif char == '+':
-            result = 'HID_KEYPAD_PLUS'
-        elif char == '-':
-            result = 'HID_KEYPAD_MINUS'
-        elif char == '/':
-            result = 'HID_KEYPAD_DIVIDE'
-        elif char == ',':
-            result = 'HID_COMMA'
-        elif char == '.':
-            result = 'HID_DOT'
-        elif char == ';':
-            result = 'HID_SEMICOLON'
-        elif char == ':':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_SEMICOLON'
-        elif char == '<':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_COMMA'
-        elif char == '>':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_DOT'
-        elif char == '=':
-            result = 'HID_KEYPAD_EQUAL'
-        elif char == '?':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_SLASH'
-        elif char == '@':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_2'
-        elif char == '[':
-            result = 'HID_LEFT_SQUARE_BRACKET'
-        elif char == ']':
-            result = 'HID_RIGHT_SQUARE_BRACKET'
-        elif char == ' ':
-            result = 'HID_SPACEBAR'
-        elif char == '!':
-            result = 'ESCAPE_KEY_START + 1, ' + 'HID_MODIFIER_LEFT_SHIFT, ' \
-                + 'HID_1'
-        # TODO: implemente all string.printable
-        else:
-            raise ValueError(f'Char not implemented as HID: {char}')
-        return result
-
-
-class WindowsConverter(LineConverter):
-    def _convert(self, line: str) -> str:
+    def iter_convert(self, ops: Iterable[Op]) -> Iterator[bytes]:
         '''
-        This method converts the "GUI" key press to HID_VALUE
-        If another key is pressed with it, the GUI button is passed as modifier
+        Converts the ops lazily, yielding the bytes of one op at a time
         '''
-        splitted = line.split()
-        if len(splitted) == 1:
-            # just keyword
-            result = 'HID_MODIFIER_LEFT_GUI'
-        elif len(splitted) == 2:
-            # keyword and char
-            if len(splitted[1]) != 1:
-                raise Exception(f'GUI button can be pressed with a single char,\
-got {line}')
-            # splitted[1].upper() may not be the best, but should work for now
-            result = 'ESCAPE_KEY_START + 1, HID_MODIFIER_LEFT_GUI, '\
-                + 'HID_' + splitted[1].upper()
-        else:
-            # disallow GUI and multiple buttons
-            raise Exception(
-                f'DuckyScript allows GUI button and maximum 1 char: {line}')
-
-        return result
-
-
-class MenuConverter(LineConverter):
-    def _convert(self, line: str) -> str:
+        # LaFortuna misses first key for some reason
+        yield bytes([hid_keys.KEYCODES['ENTER']])
+        for op in ops:
+            yield self.convert_op(op)
+
+    def convert_op(self, op: Op) -> bytes:
+        if self.cache is None or type(op) in self.uncached:
+            return self.converters[type(op)].convert(op)
+        # the op, its keys and the keystrokes saved converting them. The op
+        # is kept so its id is not reused while it is cached.
+        hit = self.cache.get(id(op))
+        if hit is not None and hit[0] is op:
+            if hit[2]:
+                self.converters[Text].keystrokes_saved += hit[2]
+            return hit[1]
+        saved = self.keystrokes_saved
+        keys = self.converters[type(op)].convert(op)
+        self.cache.put(id(op), (op, keys, self.keystrokes_saved - saved))
+        return keys
+
+
+class OpConverter(ABC):
+    def __init__(self, op_type: type):
+        self.op_type = op_type
+
+    def convert(self, op: Op) -> bytes:
+        return self._convert(op)
+
+    @abstractmethod
+    def _convert(self, op) -> bytes:
         '''
-        This method parses "APP" and "MENU" directives.
-        Returns a "SHIFT-F10" key combo
+        This method converts the op to the bytes which have to be put in the
+        usb_keys array.
         '''
-        result = 'ESCAPE_KEY_START + 1, HID_MODIFIER_LEFT_SHIFT, HID_F10'
+        pass
 
-        return result
 
+class KeyConverter(OpConverter):
+    def _convert(self, op: Key) -> bytes:
+        '''
+        This method converts a single key press
+        '''
+        return bytes([op.keycode])
 
-class ShiftConverter(LineConverter):
-    allowed = ['DELETE', 'HOME', 'INSERT', 'PAGEUP', 'PAGEDOWN',
-               'WINDOWS', 'GUI', 'UP', 'DOWN', 'LEFT',
-               'RIGHT', 'TAB']
 
-    def _convert(self, line: str) -> str:
+class ChordConverter(OpConverter):
+    def _convert(self, op: Chord) -> bytes:
         '''
-        This method parses "SHIFT" directive.
-        Capital letters are not written using shift but with caps lock.
-        Shift is used for special combos - shift arrow, shift delete, etc...
+        This method converts a key pressed together with modifiers.
+        The modifiers are sent after an escape key (see keyboard_task.c)
         '''
-        splitted = line.split()
-        if len(splitted) == 1:
-            # only shift
-            result = 'HID_MODIFIER_LEFT_SHIFT'
-            return result
-        elif len(splitted) == 2:
-            # shift + special key
-            # check if key is in allowed
-            if not (splitted[1] in self.allowed):
-                raise Exception(
-                    f'"SHIFT" is allowed only in combination with: \
-                    {self.allowed}')
-
-            result = 'ESCAPE_KEY_START + 1, HID_MODIFIER_LEFT_SHIFT, '\
-                + 'HID_' + splitted[1]
-
-            return result  # return checked line
-        else:
-            raise Exception(
-                f'"SHIFT" can be used with at most 1 argument, got: {line}')
-
-
-class AltConverter(LineConverter):
-    allowed = ['END', 'ESCAPE', 'F1', 'F2', 'F3', 'F4', 'F5', 'F6',
-               'F7', 'F8', 'F9', 'F10', 'F11', 'F12', 'SPACE', 'TAB']
-
-    def _convert(self, line: str) -> str:
+        return bytes([hid_keys.ESCAPE_KEY_START + 1, op.modifiers,
+                      op.keycode])
+
+
+def encode_char(keycode: int, shift: bool) -> bytes:
+    '''
+    Returns the keys typing a character. Shifted characters are sent after an
+    escape key with the shift modifier.
+    '''
+    if not shift:
+        return bytes([keycode])
+    return bytes([hid_keys.ESCAPE_KEY_START + 1,
+                  hid_keys.MODIFIER_LEFT_SHIFT, keycode])
+
+
+# Character -> its keys, as latin-1 text so a whole string is converted by a
+# single str.translate
+CHARACTER_KEYS: Dict[str, bytes] = {
+    char: encode_char(keycode, shift)
+    for char, (keycode, shift) in hid_keys.CHARACTERS.items()}
+TRANSLATION = str.maketrans(
+    {char: keys.decode('latin-1') for char, keys in CHARACTER_KEYS.items()})
+# The same with caps lock on - capitals are typed without shift
+CAPS_LOCK_TRANSLATION = dict(TRANSLATION)
+CAPS_LOCK_TRANSLATION.update(
+    (ord(char), chr(hid_keys.KEYCODES[char]))
+    for char in string.ascii_uppercase)
+CAPS_LOCK = chr(hid_keys.KEYCODES['CAPS_LOCK'])
+
+# Every byte read by keyboard_task.c is followed by an empty report and every
+# key byte sends a report of its own. A capital typed with shift is 3 bytes
+# and 4 reports, so k capitals cost 4k reports, while a caps lock bracket
+# around them costs 2k + 4 - as much for two capitals and less for more.
+# Capitals two or more of which are only separated by characters caps lock
+# does not change are therefore typed with caps lock on.
+CAPS_RUN = re.compile('([A-Z][^a-z]*[A-Z])')
+CAPITAL = re.compile('[A-Z]')
+# Keystrokes a capital took when each was typed between two caps locks
+OLD_CAPITAL_KEYSTROKES = 3
+
+
+class StringConverter(OpConverter):
+    def __init__(self, op_type: type):
+        super().__init__(op_type)
+        self.keystrokes_saved = 0
+
+    def _convert(self, op: Text) -> bytes:
         '''
-        This method parses "ALT" directive.
-        A single optional parameter is allowed
+        This method converts plain strings using the precomputed keys of
+        every character. Capitals use the cheapest of shift and caps lock.
         '''
-        splitted = line.split()
-        if len(splitted) == 1:
-            # only alt
-            result = 'HID_MODIFIER_LEFT_ALT'
-
-            return result
-        elif len(splitted) == 2:
-            # alt + special key or single char
-            # if key is not in allowed, and (is not a letter, or has len > 1
-            if splitted[1] not in self.allowed and\
-                 (len(splitted[1]) != 1 or not splitted[1].isalpha()):
-                raise Exception(
-                    f'"ALT" is allowed only in combination with: \
-                    {self.allowed} and any single chars')
-
-            # quick fix space
-            if splitted[1] == 'SPACE':
-                splitted[1] = 'SPACEBAR'
-
-            result = 'ESCAPE_KEY_START + 1, HID_MODIFIER_LEFT_ALT, '\
-                + 'HID_' + splitted[1]
-
-            return result  # return checked line
-        else:
-            raise Exception(
-                f'"ALT" can be used with at most 1 argument, got: {line}')
-
-
-class ControlConverter(LineConverter):
-    allowed = ['ENTER', 'BREAK', 'ESC', 'ESCAPE', 'F1', 'F2', 'F3', 'F4',
-               'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12', 'PAUSE']
-    allowed_modifiers = ['ALT', 'SHIFT']
-
-    def _convert(self, line: str) -> str:
+        text = op.text
+        if not CHARACTER_KEYS.keys() >= set(text):
+            char = next(x for x in text if x not in CHARACTER_KEYS)
+            raise ValueError(f'Char not implemented as HID: {char!r}')
+
+        # the text between the caps lock runs alternates with the runs
+        parts = CAPS_RUN.split(text)
+        result = [None] * len(parts)
+        result[::2] = [x.translate(TRANSLATION) for x in parts[::2]]
+        result[1::2] = [CAPS_LOCK + x.translate(CAPS_LOCK_TRANSLATION)
+                        + CAPS_LOCK for x in parts[1::2]]
+
+        # a keystroke per capital and two caps locks per run
+        capitals = len(CAPITAL.findall(text))
+        keystrokes = capitals + 2 * (len(parts) // 2)
+        self.keystrokes_saved += OLD_CAPITAL_KEYSTROKES * capitals - keystrokes
+        return ''.join(result).encode('latin-1')
+
+
+class PackedStringConverter(OpConverter):
+    def __init__(self, op_type: type):
+        super().__init__(op_type)
+        self.keystrokes_saved = 0
+
+    def _convert(self, op: Text) -> bytes:
         '''
-        This method parses "Control" directive.
-        A single optional parameter is allowed
+        This method converts plain strings to REPORT_KEY runs (see
+        keyboard_task.c). A run ends when the modifier changes, when a key
+        would be pressed again while it is still held or when it is full.
         '''
-        raise Exception(f'Not implemented yet: {line}')
-        splitted = line.split()
-        if len(splitted) == 2:
-            # control + special key or single char
-            # if key is not in allowed, and (is not a letter, or has len > 1)
-            if splitted[1] not in self.allowed and\
-                 (len(splitted[1]) != 1 or not splitted[1].isalpha()):
-                raise Exception(
-                    f'"CONTROL" is allowed only in combination with: \
-{self.allowed} and any single chars, got: {line}')
-
-            # result = 'CONTROL ' + splitted[1]
-        else:
-            raise Exception(
-                f'"CONTROL" can be used with at most 1 argument, got: {line}')
-
-        # check for 'CONTROL-MODIFIER' combo
-        control_combo = splitted[0].split('-')
-        if len(control_combo) > 1:
-            # check if second key is allowed
-            if control_combo[1] not in self.allowed_modifiers:
-                raise Exception(f'You can use control with another modifier\
-from the list: {self.allowed_modifiers},\
-got: {line}')
-        return line  # return checked line
-
-
-class ArrorConverter(LineConverter):
-    def _convert(self, line: str) -> str:
+        result = bytearray()
+        modifier = None
+        run: List[int] = []
+        for char in op.text:
+            try:
+                keycode, shift = hid_keys.CHARACTERS[char]
+            except KeyError:
+                raise ValueError(
+                    f'Char not implemented as HID: {char!r}') from None
+            char_modifier = hid_keys.MODIFIER_LEFT_SHIFT if shift \
+                else hid_keys.MODIFIER_NONE
+            if char_modifier != modifier or len(run) == MAX_PACKED \
+                    or keycode in run[-hid_keys.REPORT_ROLLOVER:]:
+                result += self.encode_run(modifier, run)
+                modifier = char_modifier
+                run = []
+            run.append(keycode)
+            # shift is part of the report, not keystrokes of its own
+            if char.isupper():
+                self.keystrokes_saved += OLD_CAPITAL_KEYSTROKES - 1
+        result += self.encode_run(modifier, run)
+        return bytes(result)
+
+    def encode_run(self, modifier: int, run: List[int]) -> bytes:
+        if not run:
+            return b''
+        # a single key takes as many reports either way but fewer bytes
+        if len(run) == 1 and modifier == hid_keys.MODIFIER_NONE:
+            return bytes(run)
+        return bytes([hid_keys.REPORT_KEY, modifier, len(run)] + run)
+
+
+class AsciiStringConverter(OpConverter):
+    def __init__(self, op_type: type):
+        super().__init__(op_type)
+        self.keystrokes_saved = 0
+
+    def _convert(self, op: Text) -> bytes:
         '''
-        This method parses arrow directives.
-        Trims the "ARROR" suffix
+        This method stores plain strings as ASCII after a STRING_KEY and
+        their length. keyboard_task.c looks the keys of every character up
+        in its ascii_keys table (see hid_keys.ascii_table).
         '''
-        splitted = line.split('ARROW')
-        if len(splitted) != 2 and\
-                (splitted[0] not in {'LEFT', 'RIGHT', 'UP', 'DOWN'}):
-            raise Exception(f'Invalid input: {line}. Allowed arrow inputs\
- are (UP|DOWN|LEFT|RIGHT)[ARROW]')
-        result = 'HID_' + splitted[0]
-
-        return result
-
+        text = op.text
+        if not CHARACTER_KEYS.keys() >= set(text):
+            char = next(x for x in text if x not in CHARACTER_KEYS)
+            raise ValueError(f'Char not implemented as HID: {char!r}')
+        # shift is part of the report, not keystrokes of its own
+        self.keystrokes_saved += (OLD_CAPITAL_KEYSTROKES - 1) \
+            * len(CAPITAL.findall(text))
+        # a single key takes as many reports either way but fewer bytes
+        if len(text) == 1 and not hid_keys.CHARACTERS[text][1]:
+            return CHARACTER_KEYS[text]
+
+        result = bytearray()
+        for start in range(0, len(text), MAX_STRING):
+            chunk = text[start:start + MAX_STRING]
+            result += bytes([hid_keys.STRING_KEY, len(chunk)])
+            result += chunk.encode('ascii')
+        return bytes(result)
+
+
+# STRING converters selectable with DuckyScriptConverter(text_encoding=...)
+TEXT_ENCODINGS = {
+    'keys': StringConverter,
+    'packed': PackedStringConverter,
+    'ascii': AsciiStringConverter,
+}
+
+
+def encode_varint(value: int) -> bytes:
+    '''
+    Returns `value` 7 bits per byte, least significant first. The top bit of
+    every byte but the last is set.
+    '''
+    result = bytearray()
+    while value > 0x7F:
+        result.append(value & 0x7F | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
 
-class ExtendedConverter(LineConverter):
-    allowed = ['SPACE', 'INSERT', 'ENTER', 'CAPSLOCK',
-               'DELETE', 'END', 'HOME', 'INSERT', 'ESCAPE']
 
-    def _convert(self, line: str) -> str:
+class DelayConverter(OpConverter):
+    def _convert(self, op: Delay) -> bytes:
         '''
-        This method handles some additional special keys that are not typeable.
+        This method converts the "DELAY" directive.
+        Sleeping is done in C code by DELAY_KEY followed by the delay in ms
+        as a varint.
         '''
-        if line in self.allowed:  # if line is only 1 keyword
-            # quickfix space
-            if line is 'SPACE':
-                line = 'SPACEBAR'
-            return 'HID_' + line
-        else:
-            raise Exception(f'One keyword per statement, got: "{line}"')
-
-
-class DelayConverter(LineConverter):
-    def _convert(self, line: str) -> str:
+        if op.ms == 0:
+            return b''
+        delay = op.ms
+        if delay > hid_keys.MAX_DELAY_MS:
+            warnings.warn(f'DELAY {op.ms} is longer than the longest delay '
+                          f'and was shortened to {hid_keys.MAX_DELAY_MS} ms')
+            delay = hid_keys.MAX_DELAY_MS
+        return bytes([hid_keys.DELAY_KEY]) + encode_varint(delay)
+
+
+class RepeatConverter(OpConverter):
+    def __init__(self, op_type: type, converter: DuckyScriptConverter):
+        super().__init__(op_type)
+        self.converter = converter
+
+    def _convert(self, op: Repeat) -> bytes:
         '''
-        This method parses the "DELAY" directive.
-        Sleeping is done in C code so just check everything is okay here.
-
-        Directive format is: DELAY <int>
+        This method converts the "REPEAT" directive to a REPEAT_KEY loop over
+        the bytes of the repeated op (see keyboard_task.c).
+        The size of the result does not depend on the number of repetitions.
+        '''
+        target, count = op.op, op.count
+        # The loop repeats the bytes right before it. Those are the bytes of
+        # the repeated op unless it is a REPEAT itself, then the block has to
+        # be typed once more before looping over it.
+        inline = isinstance(target, Repeat)
+        while isinstance(target, Repeat):
+            count *= target.count
+            target = target.op
+        block = self.converter.convert_op(target)
+        if not block:
+            return b''
+        if any(block[i] == hid_keys.REPEAT_KEY
+               for i, _ in instructions(block)):
+            # keyboard_task.c cannot run a REPEAT_KEY loop inside another one
+            # (a CALL of a function with a REPEAT), the copies are stored
+            return block * (count + inline)
+        if len(block) > MAX_REPEAT:
+            raise ValueError(
+                f'REPEAT block is too long: {len(block)} > {MAX_REPEAT} bytes')
+
+        result = bytearray()
+        while count > 0:
+            if inline:
+                result += block
+                count -= 1
+            loops = min(count, MAX_REPEAT)
+            if loops:
+                result += bytes([hid_keys.REPEAT_KEY])
+                result += loops.to_bytes(2, 'little')
+                result += len(block).to_bytes(2, 'little')
+            count -= loops
+            inline = True
+        return bytes(result)
+
+
+class CallConverter(OpConverter):
+    def __init__(self, op_type: type, converter: DuckyScriptConverter):
+        super().__init__(op_type)
+        self.converter = converter
+
+    def _convert(self, op: Call) -> bytes:
+        '''
+        This method converts a "CALL" to the keys of the function body.
+        Every call is typed in full here, the optimizer turns the copies
+        into CALL_KEYs of the first one (see optimizer.Deduplicate).
         '''
-        splitted = line.split()
-        if len(splitted) != 2 or not self.try_parse(splitted[1], int)\
-                or int(splitted[1]) < 0:
-            raise ValueError('DELAY format is: DELAY <positive int>')
-
-        # C code support delays multiple of 100(ms) and up to 8bit multiples
-        # This means max delay supported currently is 100 * (2**8)
-        delay = int(splitted[1])
-        delay //= 100  # 100 is the current single delay
-        if delay > 2**8:
-            delay = 2**8 - 1  # max sleep is 2**8 - 1
-        result = f'SLEEP_KEY, {delay}'
-        return result
-
-    def try_parse(self, val: str, t: type) -> bool:
-        try:
-            t(val)
-            return True
-        except ValueError:
-            return False
+        return b''.join(self.converter.convert_op(x) for x in op.ops)
@@ -0,0 +1,129 @@
+'''
+Integer HID values shared by the parser and the converter.
+
+The key and modifier values mirror `usb_commun_hid.h` and the reserved codes
+mirror the #defines at the top of `keyboard_task.c` - `symbols.py` checks
+that they still do before every build.
+'''
+from typing import Dict, Tuple
+import string
+
+# Reserved codes interpreted by process_key in keyboard_task.c
+ESCAPE_KEY_START = 251
+SLEEP_KEY = 249
+SLEEP_MS = 100
+DELAY_KEY = 247
+MAX_DELAY_MS = 2**32 - 1  # DELAY_KEY operand, a varint of up to 32 bits
+REPEAT_KEY = 250
+REPEAT_HEADER_SIZE = 5  # REPEAT_KEY, 16 bit count, 16 bit length
+REPORT_KEY = 248
+REPORT_ROLLOVER = 6  # keycodes in a HID report
+STRING_KEY = 246  # followed by an 8 bit length and ASCII characters
+CALL_KEY = 245
+CALL_SIZE = 5  # CALL_KEY, 16 bit distance back, 16 bit length
+MAX_CALL_DEPTH = 4  # blocks called from called blocks
+ASCII_SHIFT = 0x80  # set in the ascii_keys entries of shifted characters
+
+MODIFIER_NONE = 0x00
+MODIFIER_LEFT_CTRL = 0x01
+MODIFIER_LEFT_SHIFT = 0x02
+MODIFIER_LEFT_ALT = 0x04
+MODIFIER_LEFT_GUI = 0x08
+
+KEYCODES: Dict[str, int] = {
+    'A': 4, 'B': 5, 'C': 6, 'D': 7, 'E': 8, 'F': 9, 'G': 10, 'H': 11,
+    'I': 12, 'J': 13, 'K': 14, 'L': 15, 'M': 16, 'N': 17, 'O': 18, 'P': 19,
+    'Q': 20, 'R': 21, 'S': 22, 'T': 23, 'U': 24, 'V': 25, 'W': 26, 'X': 27,
+    'Y': 28, 'Z': 29,
+    '1': 30, '2': 31, '3': 32, '4': 33, '5': 34, '6': 35, '7': 36, '8': 37,
+    '9': 38, '0': 39,
+    'ENTER': 40, 'ESCAPE': 41, 'BACKSPACE': 42, 'TAB': 43, 'SPACEBAR': 44,
+    'UNDERSCORE': 45, 'PLUS': 46, 'LEFT_SQUARE_BRACKET': 47,
+    'RIGHT_SQUARE_BRACKET': 48, 'BACKSLASH': 49, 'SEMICOLON': 51,
+    'SINGLEQUOTE': 52, 'TILDE': 53, 'COMMA': 54, 'DOT': 55, 'SLASH': 56,
+    'CAPS_LOCK': 57,
+    'F1': 58, 'F2': 59, 'F3': 60, 'F4': 61, 'F5': 62, 'F6': 63, 'F7': 64,
+    'F8': 65, 'F9': 66, 'F10': 67, 'F11': 68, 'F12': 69,
+    'PRINTSCREEN': 70, 'PAUSE': 72, 'INSERT': 73, 'HOME': 74, 'PAGEUP': 75,
+    'DELETE': 76, 'END': 77, 'PAGEDOWN': 78,
+    'RIGHT': 79, 'LEFT': 80, 'DOWN': 81, 'UP': 82,
+    'KEYPAD_NUM_LOCK': 83, 'KEYPAD_DIVIDE': 84, 'KEYPAD_MULTIPLY': 85,
+    'KEYPAD_MINUS': 86, 'KEYPAD_PLUS': 87, 'KEYPAD_ENTER': 88,
+    'KEYPAD_EQUAL': 103,
+}
+
+# DuckyScript spellings of keys whose HID name differs
+ALIASES: Dict[str, str] = {
+    'ESC': 'ESCAPE',
+    'SPACE': 'SPACEBAR',
+    'CAPSLOCK': 'CAPS_LOCK',
+    'BREAK': 'PAUSE',
+    'UPARROW': 'UP',
+    'DOWNARROW': 'DOWN',
+    'LEFTARROW': 'LEFT',
+    'RIGHTARROW': 'RIGHT',
+}
+
+
+def _characters() -> Dict[str, Tuple[int, bool]]:
+    result = {}
+    for char in string.ascii_lowercase + string.digits:
+        result[char] = (KEYCODES[char.upper()], False)
+    for char in string.ascii_uppercase:
+        result[char] = (KEYCODES[char], True)
+    # shifted digit row, * is typed on the keypad below
+    for char, digit in zip('!@#$%^&()', '123456790'):
+        result[char] = (KEYCODES[digit], True)
+    # arithmetic operators are typed on the keypad, which does not depend on
+    # the keyboard layout
+    for char, name in (('*', 'KEYPAD_MULTIPLY'), ('+', 'KEYPAD_PLUS'),
+                       ('-', 'KEYPAD_MINUS'), ('/', 'KEYPAD_DIVIDE'),
+                       ('=', 'KEYPAD_EQUAL')):
+        result[char] = (KEYCODES[name], False)
+    for name, plain, shifted in (('UNDERSCORE', None, '_'),
+                                 ('LEFT_SQUARE_BRACKET', '[', '{'),
+                                 ('RIGHT_SQUARE_BRACKET', ']', '}'),
+                                 ('BACKSLASH', '\\', '|'),
+                                 ('SEMICOLON', ';', ':'),
+                                 ('SINGLEQUOTE', "'", '"'),
+                                 ('TILDE', '`', '~'),
+                                 ('COMMA', ',', '<'),
+                                 ('DOT', '.', '>'),
+                                 ('SLASH', None, '?')):
+        if plain is not None:
+            result[plain] = (KEYCODES[name], False)
+        result[shifted] = (KEYCODES[name], True)
+    for char, name in ((' ', 'SPACEBAR'), ('\t', 'TAB'), ('\n', 'ENTER'),
+                       ('\r', 'ENTER')):
+        result[char] = (KEYCODES[name], False)
+    # vertical tab and form feed are the only printable characters left and
+    # no key types them
+    return result
+
+
+# Every typeable character of string.printable -> (keycode, needs shift)
+CHARACTERS: Dict[str, Tuple[int, bool]] = _characters()
+
+
+def ascii_table() -> bytes:
+    '''
+    Returns the ascii_keys table of keyboard_task.c: the keycode of every
+    ASCII character, or-ed with ASCII_SHIFT if it needs shift. Characters
+    no key types are 0.
+    '''
+    result = bytearray(128)
+    for char, (code, shift) in CHARACTERS.items():
+        result[ord(char)] = code | (ASCII_SHIFT if shift else 0)
+    return bytes(result)
+
+
+def keycode(name: str) -> int:
+    '''
+    Returns the HID keycode of a DuckyScript key name or single character
+    '''
+    name = name.upper()
+    name = ALIASES.get(name, name)
+    try:
+        return KEYCODES[name]
+    except KeyError:
+        raise ValueError(f'Unknown key: {name}') from None
@@ -0,0 +1,173 @@
+'''
+Patches the usb_keys payloads of an already built Intel HEX firmware image.
+
+The firmware only has to be compiled once with enough room reserved for the
+payload (`python rubber_ducky_to_hex.py --reserve <bytes>`); afterwards new
+payloads are written straight into the image and the checksums of the
+changed records are fixed up.
+'''
+from typing import Dict, Iterable, List, Sequence, Tuple
+import payload
+
+DATA = 0x00
+END_OF_FILE = 0x01
+EXTENDED_SEGMENT_ADDRESS = 0x02
+EXTENDED_LINEAR_ADDRESS = 0x04
+# Data bytes per record written by format_memory, as avr-objcopy does
+RECORD_SIZE = 16
+
+
+def checksum(record: bytes) -> int:
+    return -sum(record) & 0xFF
+
+
+def parse_record(line: str) -> bytes:
+    '''
+    Returns the bytes of a record line (count, address, type, data, checksum)
+    '''
+    line = line.strip()
+    if not line.startswith(':'):
+        raise ValueError(f'Not an Intel HEX record: {line}')
+    record = bytes.fromhex(line[1:])
+    if len(record) < 5 or len(record) != record[0] + 5:
+        raise ValueError(f'Invalid record length: {line}')
+    if checksum(record[:-1]) != record[-1]:
+        raise ValueError(f'Invalid record checksum: {line}')
+    return record
+
+
+def format_record(address: int, record_type: int, data: bytes) -> str:
+    record = bytes([len(data)]) + address.to_bytes(2, 'big') \
+        + bytes([record_type]) + data
+    return ':' + (record + bytes([checksum(record)])).hex().upper()
+
+
+def format_memory(memory: bytes,
+                  ranges: Iterable[Tuple[int, int]]) -> List[str]:
+    '''
+    Returns the records of the bytes of `memory` in the [start, end)
+    `ranges`, in order, followed by the end of file record
+    '''
+    result = []
+    base = 0
+    for start, end in ranges:
+        for address in range(start, end, RECORD_SIZE):
+            if address >> 16 != base:
+                base = address >> 16
+                result.append(format_record(0, EXTENDED_LINEAR_ADDRESS,
+                                            base.to_bytes(2, 'big')))
+            data = bytes(memory[address:min(address + RECORD_SIZE, end)])
+            result.append(format_record(address & 0xFFFF, DATA, data))
+    result.append(format_record(0, END_OF_FILE, b''))
+    return result
+
+
+def read_data(lines: List[str]) -> Dict[int, Tuple[int, int]]:
+    '''
+    Maps the absolute address of every data record to
+    (line index, address field of the record)
+    '''
+    result = {}
+    base = 0
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        record = parse_record(line)
+        record_type = record[3]
+        if record_type == DATA:
+            address = int.from_bytes(record[1:3], 'big')
+            result[base + address] = (i, address)
+        elif record_type == EXTENDED_SEGMENT_ADDRESS:
+            base = int.from_bytes(record[4:6], 'big') << 4
+        elif record_type == EXTENDED_LINEAR_ADDRESS:
+            base = int.from_bytes(record[4:6], 'big') << 16
+    return result
+
+
+def read_memory(lines: List[str]) -> Tuple[bytearray, bytearray]:
+    '''
+    Returns the flash contents and a mask of which bytes the image defines
+    '''
+    data = read_data(lines)
+    size = max((address + parse_record(lines[i])[0]
+                for address, (i, _) in data.items()), default=0)
+    memory = bytearray(b'\xff' * size)
+    defined = bytearray(size)
+    for address, (i, _) in data.items():
+        record = parse_record(lines[i])
+        memory[address:address + record[0]] = record[4:-1]
+        defined[address:address + record[0]] = b'\x01' * record[0]
+    return memory, defined
+
+
+def is_header(memory: bytes, address: int) -> bool:
+    '''
+    Returns whether the MAGIC at `address` starts a usb_keys header: the
+    capacity fits the image and the index entries hold consecutive keys
+    within it, the way payload.header writes them
+    '''
+    sizes = address + payload.CAPACITY_OFFSET
+    capacity = int.from_bytes(memory[sizes:sizes + 2], 'little')
+    end = payload.HEADER_SIZE + capacity
+    count = memory[address + payload.COUNT_OFFSET] \
+        if address + payload.HEADER_SIZE <= len(memory) else 0
+    if not 0 < count <= payload.MAX_PAYLOADS \
+            or address + end > len(memory):
+        return False
+    offset = payload.HEADER_SIZE + payload.ENTRY_SIZE * count
+    entry = address + payload.HEADER_SIZE
+    for _ in range(count):
+        start = int.from_bytes(memory[entry:entry + 2], 'little')
+        length = int.from_bytes(memory[entry + 2:entry + 4], 'little')
+        if start != offset or start + length > end:
+            return False
+        offset += length
+        entry += payload.ENTRY_SIZE
+    return True
+
+
+def find_payload(memory: bytes) -> int:
+    '''
+    Returns the address of the usb_keys header. Keys stored as text may
+    contain MAGIC as well, the first copy that starts a header is taken.
+    '''
+    address = memory.find(payload.MAGIC)
+    if address < 0:
+        raise ValueError('No usb_keys payload found in the image')
+    while address >= 0:
+        if is_header(memory, address):
+            return address
+        address = memory.find(payload.MAGIC, address + 1)
+    raise ValueError('No valid usb_keys header found in the image')
+
+
+def patch(lines: List[str], payloads: Sequence[payload.Payload]
+          ) -> List[str]:
+    '''
+    Returns the lines of the image with the payloads of usb_keys replaced by
+    `payloads`. Records outside usb_keys are left untouched.
+    '''
+    memory, defined = read_memory(lines)
+    start = find_payload(memory)
+    sizes = start + payload.CAPACITY_OFFSET
+    capacity = int.from_bytes(memory[sizes:sizes + 2], 'little')
+    end = start + payload.HEADER_SIZE + capacity
+    if end > len(defined) or not all(defined[start:end]):
+        raise ValueError('The image does not contain the whole usb_keys array')
+    memory[start:end] = payload.build_image(payloads, capacity)
+
+    result = list(lines)
+    for address, (i, field) in read_data(lines).items():
+        length = parse_record(lines[i])[0]
+        if address < end and address + length > start:
+            result[i] = format_record(field, DATA,
+                                      bytes(memory[address:address + length]))
+    return result
+
+
+def patch_file(template_path: str, output_path: str,
+               payloads: Sequence[payload.Payload]) -> None:
+    with open(template_path, 'r') as f:
+        lines = f.read().splitlines()
+    with open(output_path, 'w') as f:
+        f.write('\n'.join(patch(lines, payloads)) + '\n')
@@ -0,0 +1,83 @@
+'''
+Bounded least recently used cache, used by the parser to map lines to ops
+and by the converter to map ops to keys.
+
+Generated scripts repeat a few lines (DELAY 500, ENTER, GUI r, the same
+commands) over and over, so most lines are parsed and converted by a single
+lookup. Callers decide what is stored: results that depend on the lines
+around them (REPEAT, CALL, ...) must never be put in.
+A cache is not shared between threads.
+'''
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Default of get for values that may be None
+MISSING = object()
+# Entries kept by default - far more than the distinct lines of a payload
+DEFAULT_SIZE = 1024
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return (f'{self.hit_rate:.0%} hits ({self.hits}/'
+                f'{self.hits + self.misses}), {self.size}/{self.maxsize} '
+                f'entries')
+
+
+class LRUCache(object):
+    def __init__(self, maxsize: int = DEFAULT_SIZE):
+        if maxsize < 1:
+            raise ValueError(f'Cache size must be positive, got {maxsize}')
+        self.maxsize = maxsize
+        self.data: 'OrderedDict[Hashable, object]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Optional[T] = None):
+        '''
+        Returns the value of `key`, making it the most recently used entry,
+        or `default`
+        '''
+        value = self.data.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value) -> None:
+        '''
+        Stores `value`, dropping the least recently used entry when full
+        '''
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(self.hits, self.misses, len(self.data),
+                          self.maxsize)
+
+
+def create(size: int) -> Optional[LRUCache]:
+    '''
+    Returns a cache of `size` entries, or None when `size` is 0 (disabled)
+    '''
+    return LRUCache(size) if size else None
@@ -0,0 +1,626 @@
+'''
+Peephole optimization of the keys produced by `ducky_to_hid`.
+
+The converter emits exactly what the script says. The passes here remove
+what keyboard_task.c would spend flash and HID reports on for nothing:
+
+    drop-delays     DELAYs of 0 ms
+    merge-delays    adjacent DELAYs (and old style SLEEP_KEYs) become one
+    cancel-caps     a caps lock right after a caps lock
+    dedup           instructions that were stored before become a CALL_KEY
+                    of the earlier copy, so every CALL of a FUNCTION but the
+                    first one and any other repeated block takes 5 bytes
+
+Modifiers need no pass - the converter already sends every chord as a single
+escape with its modifiers or-ed together.
+
+A REPEAT block and its header are barriers - nothing is moved into or out of
+a block, and the length of every block is updated after the passes ran.
+
+Up to opt level 2 the keys are optimized while they stream through, a piece
+at a time, holding back no more than a REPEAT block can reach. Dedup needs
+all the keys. The bytes and reports before and after every pass are only
+counted when they are asked for.
+'''
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, \
+    Optional, Tuple, Union
+import hid_keys
+from compress import split_instructions
+from ducky_to_hid import MAX_REPEAT, encode_varint
+
+# Highest opt level
+MAX_LEVEL = 3
+# Opt level used unless one is given - dedup (level 3) is opt-in as it
+# needs all keys at once
+DEFAULT_LEVEL = 2
+# CALL_KEY operands are 16 bit
+MAX_CALL = 2**16 - 1
+# Chunks whose instructions iter_split remembers, and their longest
+MAX_SPLIT_CHUNKS = 1024
+MAX_SPLIT_CHUNK = 256
+DELAY_KEYS = frozenset([hid_keys.DELAY_KEY, hid_keys.SLEEP_KEY])
+DELAY_NEEDLES = tuple(bytes([x]) for x in DELAY_KEYS)
+
+
+class PassReport(NamedTuple):
+    name: str
+    bytes_before: int
+    bytes_after: int
+    reports_before: int
+    reports_after: int
+
+    def __str__(self):
+        return (f'{self.name} {self.bytes_before}->{self.bytes_after} bytes '
+                f'{self.reports_before}->{self.reports_after} reports')
+
+
+class Repeat(NamedTuple):
+    '''
+    A REPEAT header; the block is the pieces from `block` up to the header
+    '''
+    count: int
+    block: int
+
+
+class Call(NamedTuple):
+    '''
+    A CALL_KEY typing the instructions from `start` up to `end` again,
+    counted over the instructions of all pieces
+    '''
+    start: int
+    end: int
+
+
+# A list of instructions, or a REPEAT header
+Piece = Union[List[Union[bytes, Call]], Repeat]
+
+
+def is_barrier(instruction: bytes) -> bool:
+    '''
+    Returns whether no pass combines `instruction` with the instructions
+    after it - it is no delay and cannot become a caps lock
+    '''
+    return delay_ms(instruction) is None \
+        and instruction[-1] != hid_keys.KEYCODES['CAPS_LOCK']
+
+
+def iter_split(chunks: Iterable[bytes],
+               window: Optional[int] = MAX_REPEAT) -> Iterator[Piece]:
+    '''
+    Splits keys, read in chunks of whole instructions, into lists of
+    instructions. A new list starts at every REPEAT block and after every
+    REPEAT header, so the block of a header is the list right before it.
+    A block reaches at most MAX_REPEAT bytes back. Once a list is longer
+    than twice `window` bytes the instructions up to `window` bytes before
+    the end are yielded as a list of their own, ending at a barrier so that
+    only dedup can tell the lists apart. None holds every list until its
+    end.
+    '''
+    piece: List[bytes] = []
+    # bytes of the piece, and pieces yielded
+    size = 0
+    count = 0
+    # the instructions of recent chunks - the converter returns the same
+    # chunk for the same line - and whether any of them is a REPEAT
+    split_chunks: Dict[bytes, Tuple[List[bytes], bool]] = {}
+    for chunk in chunks:
+        parts, repeats = split_chunks.get(chunk, (None, False))
+        if parts is None:
+            parts = split_instructions(chunk)
+            repeats = (hid_keys.REPEAT_KEY in chunk
+                       or hid_keys.CALL_KEY in chunk) and any(
+                x[0] in (hid_keys.REPEAT_KEY, hid_keys.CALL_KEY)
+                for x in parts)
+            if len(chunk) <= MAX_SPLIT_CHUNK:
+                if len(split_chunks) >= MAX_SPLIT_CHUNKS:
+                    split_chunks.clear()
+                split_chunks[chunk] = (parts, repeats)
+        if not repeats:
+            piece.extend(parts)
+            size += len(chunk)
+        for instruction in parts if repeats else ():
+            if instruction[0] == hid_keys.CALL_KEY:
+                raise ValueError('CALL_KEY in the keys, they were optimized '
+                                 'before')
+            if instruction[0] != hid_keys.REPEAT_KEY:
+                piece.append(instruction)
+                size += len(instruction)
+                continue
+            # the block ends right before the header
+            block = int.from_bytes(instruction[3:5], 'little')
+            i = len(piece)
+            while block > 0 and i > 0:
+                i -= 1
+                block -= len(piece[i])
+            if block != 0:
+                raise ValueError(f'REPEAT block of {instruction.hex()} does '
+                                 f'not start at an instruction')
+            if i:
+                yield piece[:i]
+                count += 1
+            yield piece[i:]
+            yield Repeat(int.from_bytes(instruction[1:3], 'little'), count)
+            count += 2
+            piece, size = [], 0
+
+        if window is not None and size > 2 * window:
+            # the instructions no block can start at any more, up to a
+            # barrier
+            i = len(piece)
+            back = 0
+            while back < window:
+                i -= 1
+                back += len(piece[i])
+            while i > 0 and not is_barrier(piece[i - 1]):
+                i -= 1
+            if i > 0:
+                yield piece[:i]
+                count += 1
+                size -= sum(map(len, piece[:i]))
+                piece = piece[i:]
+    yield piece
+
+
+def split(keys: bytes) -> List[Piece]:
+    '''
+    Splits the keys into lists of instructions, see `iter_split`
+    '''
+    return list(iter_split([keys], None))
+
+
+def repeat_header(count: int, length: int) -> bytes:
+    return bytes([hid_keys.REPEAT_KEY]) + count.to_bytes(2, 'little') \
+        + length.to_bytes(2, 'little')
+
+
+def iter_join(pieces: Iterable[Piece]) -> Iterator[bytes]:
+    '''
+    Joins pieces without Calls as they stream in, a chunk per piece
+    '''
+    # the block of a REPEAT header is the piece before it
+    block = b''
+    for piece in pieces:
+        if isinstance(piece, Repeat):
+            if block:
+                yield repeat_header(piece.count, len(block))
+            block = b''
+        else:
+            block = b''.join(piece)
+            yield block
+
+
+def join(pieces: List[Piece]) -> bytes:
+    result = bytearray()
+    offsets = []
+    # offset of every instruction and of the byte after it
+    starts: List[int] = []
+    ends: List[int] = []
+    for piece in pieces:
+        offsets.append(len(result))
+        if isinstance(piece, Repeat):
+            length = len(result) - offsets[piece.block]
+            if length:
+                result += repeat_header(piece.count, length)
+            continue
+        for instruction in piece:
+            starts.append(len(result))
+            if isinstance(instruction, Call):
+                block = starts[instruction.start]
+                result.append(hid_keys.CALL_KEY)
+                result += (len(result) - 1 - block).to_bytes(2, 'little')
+                # the block ends with its last instruction, which may be
+                # followed by a REPEAT header
+                result += (ends[instruction.end - 1] - block).to_bytes(
+                    2, 'little')
+            else:
+                result += instruction
+            ends.append(len(result))
+    return bytes(result)
+
+
+def instruction_reports(instruction: bytes) -> int:
+    '''
+    Returns the number of HID reports keyboard_task.c sends for an
+    instruction
+    '''
+    key = instruction[0]
+    if key == hid_keys.DELAY_KEY:
+        return 0
+    if key == hid_keys.REPORT_KEY:
+        # a report per key and the release
+        return instruction[2] + 1
+    if key == hid_keys.STRING_KEY:
+        # a report per character and its release
+        return 2 * instruction[1]
+    # every byte is followed by an empty report, keys send a report as well
+    if key == hid_keys.SLEEP_KEY:
+        return 2
+    return len(instruction) + 1
+
+
+class Tally(object):
+    '''
+    Counts the bytes and HID reports of pieces without Calls as they stream
+    through `count`
+    '''
+    def __init__(self):
+        self.bytes = 0
+        self.reports = 0
+        # of the last piece, the block of a REPEAT header after it
+        self.block = (0, 0)
+
+    def count(self, pieces: Iterable[Piece]) -> Iterator[Piece]:
+        for piece in pieces:
+            if isinstance(piece, Repeat):
+                size, reports = self.block
+                if size:
+                    self.bytes += hid_keys.REPEAT_HEADER_SIZE
+                self.reports += piece.count * reports
+                self.block = (0, 0)
+            else:
+                self.block = (sum(map(len, piece)),
+                              sum(map(instruction_reports, piece)))
+                self.bytes += self.block[0]
+                self.reports += self.block[1]
+            yield piece
+
+
+def count_reports(pieces: List[Piece]) -> int:
+    reports = []
+    # reports sent before every instruction, of the pieces without REPEATs
+    sums = [0]
+    for piece in pieces:
+        if isinstance(piece, Repeat):
+            reports.append(piece.count * sum(reports[piece.block:]))
+            continue
+        for instruction in piece:
+            if isinstance(instruction, Call):
+                count = sums[instruction.end] - sums[instruction.start]
+            else:
+                count = instruction_reports(instruction)
+            sums.append(sums[-1] + count)
+        reports.append(sums[-1] - sums[-1 - len(piece)])
+    return sum(reports)
+
+
+def delay_ms(instruction: bytes) -> Optional[int]:
+    '''
+    Returns how long a DELAY_KEY or SLEEP_KEY instruction waits, None for
+    other instructions
+    '''
+    if instruction[0] == hid_keys.SLEEP_KEY:
+        return instruction[1] * hid_keys.SLEEP_MS
+    if instruction[0] == hid_keys.DELAY_KEY:
+        value = 0
+        for i, key in enumerate(instruction[1:]):
+            value |= (key & 0x7F) << 7 * i
+        return value
+    return None
+
+
+def may_contain(piece: List[bytes], needles: Tuple[bytes, ...]) -> bool:
+    '''
+    Returns whether any of `needles` is found in the bytes of the piece - a
+    quick check that lets a pass skip pieces it has nothing to do in
+    '''
+    joined = b''.join(piece)
+    return any(x in joined for x in needles)
+
+
+class Pass(ABC):
+    name = ''
+    level = MAX_LEVEL
+    # passes that need all pieces at once run after the streamed ones
+    streamed = True
+
+    @abstractmethod
+    def run(self, piece: List[bytes]) -> List[bytes]:
+        '''
+        Returns the optimized instructions of a piece
+        '''
+        pass
+
+    def run_pieces(self, pieces: Iterable[Piece]) -> Iterable[Piece]:
+        '''
+        Returns the optimized pieces, lazily unless the pass is not
+        `streamed`
+        '''
+        return (x if isinstance(x, Repeat) else self.run(x) for x in pieces)
+
+
+class DropDelays(Pass):
+    name = 'drop-delays'
+    level = 1
+
+    def run(self, piece: List[bytes]) -> List[bytes]:
+        if not may_contain(piece, DELAY_NEEDLES):
+            return piece
+        return [x for x in piece
+                if x[0] not in DELAY_KEYS or delay_ms(x) != 0]
+
+
+class MergeDelays(Pass):
+    name = 'merge-delays'
+    level = 1
+
+    def run(self, piece: List[bytes]) -> List[bytes]:
+        if not may_contain(piece, DELAY_NEEDLES):
+            return piece
+        result: List[bytes] = []
+        last = None
+        for instruction in piece:
+            ms = delay_ms(instruction) if instruction[0] in DELAY_KEYS \
+                else None
+            if ms is not None and last is not None \
+                    and last + ms <= hid_keys.MAX_DELAY_MS:
+                last += ms
+                result[-1] = bytes([hid_keys.DELAY_KEY]) + encode_varint(last)
+                continue
+            last = ms
+            result.append(instruction)
+        return result
+
+
+class CancelCaps(Pass):
+    name = 'cancel-caps'
+    level = 2
+    CAPS_LOCK = bytes([hid_keys.KEYCODES['CAPS_LOCK']])
+
+    def run(self, piece: List[bytes]) -> List[bytes]:
+        if piece.count(self.CAPS_LOCK) < 2:
+            return piece
+        result: List[bytes] = []
+        for instruction in piece:
+            if instruction == self.CAPS_LOCK and result \
+                    and result[-1] == self.CAPS_LOCK:
+                result.pop()
+            else:
+                result.append(instruction)
+        return result
+
+
+class Copies(object):
+    '''
+    The instructions seen by Deduplicate, to find earlier copies in.
+
+    Copies are indexed by their prefix: the fewest instructions that are
+    longer than a CALL_KEY, at most CALL_SIZE + 1 of them. A Call of fewer
+    instructions saves nothing, so every copy worth calling shares the
+    prefix of the instructions it replaces. Only copies a CALL_KEY can reach
+    are kept, at most BUCKET_SIZE of them per prefix.
+    '''
+    # most recent copies kept, and looked at, for every prefix
+    BUCKET_SIZE = 8
+    # instructions compared while looking for the copies of an instruction
+    MAX_COMPARED = 512
+
+    def __init__(self):
+        # the given instructions of all pieces
+        self.keys: List[bytes] = []
+        # offset of every given instruction, counting the REPEAT headers
+        # between pieces, and the piece it is in
+        self.offsets = [0]
+        self.piece_of: List[int] = []
+        # index of every given instruction in the result, None inside a Call
+        self.index_of: List[Optional[int]] = []
+        # call depth of every instruction of the result
+        self.depths: List[int] = []
+        # prefix -> the given instructions starting a result instruction
+        # with it, and the prefixes in the order they were added
+        self.copies: Dict[bytes, List[int]] = {}
+        self.added: Deque[Tuple[int, bytes]] = deque()
+
+    def skip(self, size: int) -> None:
+        '''
+        Skips `size` bytes which are not instructions - a REPEAT header
+        '''
+        self.offsets[-1] += size
+
+    def add(self, number: int,
+            piece: List[bytes]) -> List[Union[bytes, Call]]:
+        '''
+        Returns piece `number` with the instructions that were seen before
+        replaced by Calls
+        '''
+        i = len(self.keys)
+        for instruction in piece:
+            self.keys.append(instruction)
+            self.offsets.append(self.offsets[-1] + len(instruction))
+            self.piece_of.append(number)
+            self.index_of.append(None)
+        result: List[Union[bytes, Call]] = []
+        while i < len(self.keys):
+            self.index_of[i] = len(self.depths)
+            prefix = self.prefix(i)
+            start, length, depth = self.find(i, prefix) if prefix \
+                else (0, 0, 0)
+            if length:
+                result.append(Call(self.index_of[start],
+                                   self.index_of[start + length]))
+                self.depths.append(depth + 1)
+            else:
+                result.append(self.keys[i])
+                self.depths.append(0)
+                length = 1
+            if prefix and self.depths[-1] < hid_keys.MAX_CALL_DEPTH:
+                # a Call of anything starting with it would be too deep
+                self.add_copy(i, prefix)
+            i += length
+        return result
+
+    def prefix(self, i: int) -> Optional[bytes]:
+        '''
+        Returns the prefix of the instructions at `i`, None if the piece
+        ends before they are longer than a CALL_KEY
+        '''
+        end = i
+        size = 0
+        while size <= hid_keys.CALL_SIZE:
+            if end == len(self.keys):
+                return None
+            size += len(self.keys[end])
+            end += 1
+        return b''.join(self.keys[i:end])
+
+    def add_copy(self, i: int, prefix: bytes) -> None:
+        '''
+        Indexes the copy at `i`, forgetting the copies no CALL_KEY after it
+        can reach
+        '''
+        bucket = self.copies.setdefault(prefix, [])
+        bucket.append(i)
+        if len(bucket) > self.BUCKET_SIZE:
+            del bucket[0]
+        self.added.append((i, prefix))
+        while self.offsets[i] - self.offsets[self.added[0][0]] > MAX_CALL:
+            start, old = self.added.popleft()
+            bucket = self.copies[old]
+            if bucket and bucket[0] == start:
+                del bucket[0]
+            if not bucket:
+                del self.copies[old]
+
+    def find(self, i: int, prefix: bytes) -> Tuple[int, int, int]:
+        '''
+        Returns the start, the number of instructions and the call depth of
+        the earlier copy of the instructions at `i` whose Call saves the
+        most bytes, comparing at most MAX_COMPARED instructions. The number
+        is 0 if no Call saves any.
+        '''
+        best = (0, 0, 0)
+        best_size = hid_keys.CALL_SIZE
+        keys, offsets, index_of, depths, piece_of = \
+            self.keys, self.offsets, self.index_of, self.depths, self.piece_of
+        compared = 0
+        for start in reversed(self.copies.get(prefix, ())):
+            if offsets[i] - offsets[start] > MAX_CALL \
+                    or compared >= self.MAX_COMPARED:
+                break
+            length = 0
+            limit = min(i - start, len(keys) - i,
+                        self.MAX_COMPARED - compared)
+            while length < limit \
+                    and keys[start + length] == keys[i + length] \
+                    and piece_of[start + length] == piece_of[start]:
+                length += 1
+            compared += length + 1
+            # the longest Call of them that is not too deep and ends after
+            # a result instruction
+            first = index_of[start]
+            try:
+                deep = depths.index(hid_keys.MAX_CALL_DEPTH, first,
+                                    first + length)
+            except ValueError:
+                deep = first + length
+            while length and (index_of[start + length] is None
+                              or index_of[start + length] > deep
+                              or self.size(start, length) > MAX_CALL):
+                length -= 1
+            size = self.size(start, length) if length else 0
+            if size > best_size:
+                best, best_size = (start, length, max(
+                    depths[first:index_of[start + length]])), size
+        return best
+
+    def size(self, start: int, length: int) -> int:
+        '''
+        Returns the bytes of `length` instructions from `start` in a piece
+        '''
+        last = start + length - 1
+        return self.offsets[last] + len(self.keys[last]) - self.offsets[start]
+
+
+class Deduplicate(Pass):
+    '''
+    Replaces instructions by a Call of the same instructions stored earlier,
+    longest first - LZ77 over instructions instead of bytes. The earlier
+    copy may contain Calls itself, up to MAX_CALL_DEPTH deep. Calls never
+    reach across pieces, so no REPEAT header is ever called.
+    Runs last, the other passes do not know Calls.
+    '''
+    name = 'dedup'
+    level = 3
+    streamed = False
+
+    def run(self, piece: List[bytes]) -> List[bytes]:
+        return self.run_pieces([piece])[0]
+
+    def run_pieces(self, pieces: Iterable[Piece]) -> List[Piece]:
+        copies = Copies()
+        result: List[Piece] = []
+        for i, piece in enumerate(pieces):
+            if isinstance(piece, Repeat):
+                copies.skip(hid_keys.REPEAT_HEADER_SIZE)
+                result.append(piece)
+            else:
+                result.append(copies.add(i, piece))
+        return result
+
+
+# In the order they run - dropping delays first lets the delays around
+# them merge
+PASSES: List[Pass] = [DropDelays(), MergeDelays(), CancelCaps(),
+                      Deduplicate()]
+
+
+class Optimizer(object):
+    '''
+    Runs the passes up to opt `level` over keys streamed through
+    `iter_optimize`. With `report` the bytes and HID reports before and
+    after every pass are counted, `passes` holds them once all keys were
+    read.
+    '''
+    def __init__(self, level: int = DEFAULT_LEVEL, report: bool = False):
+        self.level = level
+        self.report = report
+        self.passes: List[PassReport] = []
+
+    def iter_optimize(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        '''
+        Optimizes keys read in chunks of whole instructions (the chunks of
+        DuckyScriptConverter.iter_convert), yielding the optimized keys
+        '''
+        passes = [x for x in PASSES if x.level <= self.level]
+        streamed = [x for x in passes if x.streamed]
+        rest = passes[len(streamed):]
+        tallies: List[Tally] = []
+        pieces = self.count(iter_split(chunks, None if rest else MAX_REPEAT),
+                            tallies)
+        for optimization in streamed:
+            pieces = self.count(optimization.run_pieces(pieces), tallies)
+        figures = []
+        if rest:
+            pieces = list(pieces)
+            for optimization in rest:
+                pieces = optimization.run_pieces(pieces)
+                if self.report:
+                    figures.append((len(join(pieces)),
+                                    count_reports(pieces)))
+            yield join(pieces)
+        else:
+            yield from iter_join(pieces)
+        figures = [(x.bytes, x.reports) for x in tallies] + figures
+        if self.report:
+            self.passes = [
+                PassReport(x.name, before[0], after[0], before[1], after[1])
+                for x, before, after in zip(passes, figures, figures[1:])]
+
+    def count(self, pieces: Iterable[Piece],
+              tallies: List[Tally]) -> Iterable[Piece]:
+        if not self.report:
+            return pieces
+        tallies.append(Tally())
+        return tallies[-1].count(pieces)
+
+
+def optimize(keys: bytes, level: int = DEFAULT_LEVEL, report: bool = False
+             ) -> Tuple[bytes, List[PassReport]]:
+    '''
+    Runs the passes up to opt `level` and returns the optimized keys and,
+    with `report`, what each pass did
+    '''
+    optimizer = Optimizer(level, report)
+    keys = b''.join(optimizer.iter_optimize([keys]))
+    return keys, optimizer.passes
@@ -0,0 +1,162 @@
+'''
+Layout of the usb_keys array in keyboard_task.c.
+
+The array starts with a header so the payloads of an already built firmware
+image can be found and replaced without recompiling (see `intel_hex.py`):
+
+    8 byte MAGIC, 16 bit capacity (little endian), number of payloads n,
+    n index entries: 16 bit offset, 16 bit length, flags
+
+followed by the keys of every payload, one after the other, and zero
+padding. `capacity` is the number of bytes after the header - the index and
+the keys - and the offset of a payload counts from the start of usb_keys.
+The array written into keyboard_task.c starts at a flash page and is padded
+to whole pages (`page_capacity`), so replacing its payloads never changes a
+page holding code (see `delta_flash.py`).
+With the COMPRESSED flag the keys of a payload are compressed (see
+`compress.py`).
+
+The firmware types the payload selected by the button held when the board is
+plugged in - SELECT_BUTTONS[i] selects payload i - and types it again when
+the center button is pressed, or another one when a direction is pressed.
+'''
+from typing import Iterable, List, NamedTuple, Optional, Sequence, TextIO, \
+    Tuple
+
+MAGIC = b'DuckyPL3'
+CAPACITY_OFFSET = len(MAGIC)
+COUNT_OFFSET = len(MAGIC) + 2  # USB_KEYS_COUNT_OFFSET in keyboard_task.c
+HEADER_SIZE = len(MAGIC) + 3
+ENTRY_SIZE = 5  # 16 bit offset, 16 bit length, flags
+COMPRESSED = 0x01
+# offsets are 16 bit
+MAX_SIZE = 2**16 - 1 - HEADER_SIZE
+# SPM_PAGESIZE of the AT90USB1286, USB_KEYS_PAGE_SIZE in keyboard_task.c
+PAGE_SIZE = 256
+# BUTTON_* codes of keyboard_task.c, by payload index
+SELECT_BUTTONS = ['NONE', 'NORTH', 'EAST', 'SOUTH', 'WEST']
+MAX_PAYLOADS = len(SELECT_BUTTONS)
+
+
+class Payload(NamedTuple):
+    keys: bytes
+    flags: int = 0
+
+
+def header(entries: Sequence[Tuple[int, int]],
+           capacity: Optional[int] = None) -> bytes:
+    '''
+    Returns the header and the index of payloads with the (length, flags)
+    `entries`. `capacity` defaults to the size of the index and the keys.
+    '''
+    if not 0 < len(entries) <= MAX_PAYLOADS:
+        raise ValueError(f'An image holds 1 to {MAX_PAYLOADS} payloads, got '
+                         f'{len(entries)}')
+    size = ENTRY_SIZE * len(entries) + sum(x[0] for x in entries)
+    if capacity is None:
+        capacity = size
+    if size > capacity:
+        raise ValueError(
+            f'Payloads of {size} bytes do not fit in {capacity} bytes')
+    if capacity > MAX_SIZE:
+        raise ValueError(
+            f'Payload capacity is at most {MAX_SIZE} bytes, got {capacity}')
+    result = MAGIC + capacity.to_bytes(2, 'little') + bytes([len(entries)])
+    offset = HEADER_SIZE + ENTRY_SIZE * len(entries)
+    for length, flags in entries:
+        result += offset.to_bytes(2, 'little') \
+            + length.to_bytes(2, 'little') + bytes([flags])
+        offset += length
+    return result
+
+
+def page_capacity(capacity: int) -> int:
+    '''
+    Returns `capacity` grown so the header and capacity fill whole flash
+    pages, up to MAX_SIZE
+    '''
+    pages = -(-(HEADER_SIZE + capacity) // PAGE_SIZE)
+    return min(pages * PAGE_SIZE - HEADER_SIZE, MAX_SIZE)
+
+
+def build_image(payloads: Sequence[Payload],
+                capacity: Optional[int] = None) -> bytes:
+    '''
+    Returns the complete usb_keys array - header, index, keys and zero
+    padding up to `capacity` (no padding by default)
+    '''
+    result = header([(len(x.keys), x.flags) for x in payloads], capacity) \
+        + b''.join(x.keys for x in payloads)
+    if capacity is None:
+        return result
+    return result + bytes(HEADER_SIZE + capacity - len(result))
+
+
+def build(keys: bytes, capacity: Optional[int] = None,
+          flags: int = 0) -> bytes:
+    '''
+    Returns the usb_keys array of a single payload, see `build_image`
+    '''
+    return build_image([Payload(keys, flags)], capacity)
+
+
+def write_c_array(f: TextIO,
+                  payloads: Sequence[Tuple[Iterable[bytes], int]],
+                  capacity: Optional[int] = None) -> List[int]:
+    '''
+    Writes the usb_keys array of the (chunks of keys, flags) `payloads` to
+    `f`, one chunk of keys at a time.
+    The lengths in the index are only known at the end, so fixed width
+    placeholders are written first and filled in afterwards - `f` has to be
+    seekable. The capacity (by default the size of the payloads) is padded
+    to whole flash pages. Payloads that do not fit fail as soon as the keys
+    written so far do not. Returns the number of keys of every payload.
+    '''
+    # fail before anything is written
+    header([(0, 0)] * len(payloads))
+    limit = MAX_SIZE if capacity is None else page_capacity(capacity)
+    size = ENTRY_SIZE * len(payloads)
+    f.write('const U8 code usb_keys[] USB_KEYS_ALIGN = {')
+    f.write(', '.join(f"'{chr(x)}'" for x in MAGIC) + ', ')
+    sizes_at = f.tell()
+    f.write(', '.join(['0x00'] * (HEADER_SIZE - len(MAGIC)
+                                  + ENTRY_SIZE * len(payloads))))
+    lengths = []
+    for chunks, _ in payloads:
+        length = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            size += len(chunk)
+            if size > limit:
+                raise ValueError(f'Payloads of at least {size} bytes do '
+                                 f'not fit in {limit} bytes')
+            f.write(', ' + ', '.join(map(str, chunk)))
+            length += len(chunk)
+        lengths.append(length)
+    if capacity is None:
+        capacity = ENTRY_SIZE * len(payloads) + sum(lengths)
+    capacity = page_capacity(capacity)
+    sizes = header([(x, flags) for x, (_, flags) in zip(lengths, payloads)],
+                   capacity)[len(MAGIC):]
+    f.write(', 0' * (capacity - ENTRY_SIZE * len(payloads) - sum(lengths)))
+    f.write('};')
+
+    end = f.tell()
+    f.seek(sizes_at)
+    f.write(', '.join(f'0x{x:02x}' for x in sizes))
+    f.seek(end)
+    return lengths
+
+
+def write_binary(path: str, chunks: Iterable[bytes]) -> int:
+    '''
+    Writes the raw keys to `path` one chunk at a time.
+    Returns the number of bytes written.
+    '''
+    length = 0
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            length += len(chunk)
+    return length
@@ -0,0 +1,147 @@
+'''
+Per stage instrumentation of the compile pipeline, written as JSON by
+rubber_ducky_to_hex.py --profile.
+
+Normally every stage is a generator and the script is streamed through all
+of them at once, so their times cannot be told apart. While profiling each
+stage runs to completion before the next one starts and records its wall
+time and the peak of the memory it allocated (tracemalloc). The lines of
+every directive (the leading keyword of a line) and the keys emitted for
+them are counted as well.
+
+A disabled Profile passes everything through untouched.
+'''
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, TypeVar
+import json
+import platform
+import time
+import tracemalloc
+from dispatcher import KeywordDispatcher
+
+T = TypeVar('T')
+
+# Directive of the bytes the converter emits before the first op
+PREFIX = '(prefix)'
+BLANK = '(blank)'
+
+
+class Profile(object):
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: List[Dict] = []
+        self.lines: Dict[str, int] = {}
+        self.bytes: Dict[str, int] = {}
+        # directive of the line being parsed, and of every parsed op whose
+        # bytes were not counted yet
+        self.directive = PREFIX
+        self.op_directives: Deque[str] = deque()
+        self.start = 0.0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        if self.enabled:
+            tracemalloc.start()
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            self.seconds = time.perf_counter() - self.start
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        '''
+        Records the time and peak memory of the with block as stage `name`.
+        `info` is stored with the stage and can be updated in the block.
+        '''
+        if not self.enabled:
+            yield info
+            return
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - before
+            self.stages.append(dict(name=name, seconds=seconds,
+                                    peak_bytes=peak, **info))
+            # the peak of the whole run is lost by reset_peak
+            self.peak_bytes = max(self.peak_bytes, peak + before)
+
+    def run(self, name: str, items: Iterable[T],
+            info: Callable[[], Dict] = dict) -> Iterable[T]:
+        '''
+        Runs a generator stage to completion. What `info` returns once it
+        ran is stored with the stage. Disabled, the generator is returned as
+        it is.
+        '''
+        if not self.enabled:
+            return items
+        with self.stage(name) as stage_info:
+            result = list(items)
+            stage_info['items'] = len(result)
+            stage_info.update(info())
+        return result
+
+    def count_lines(self, lines: Iterable[str]) -> Iterable[str]:
+        if not self.enabled:
+            return lines
+        return self._count_lines(lines)
+
+    def _count_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        for line in lines:
+            self.directive = KeywordDispatcher.keyword(line).upper() or BLANK
+            self.lines[self.directive] = self.lines.get(self.directive, 0) + 1
+            yield line
+
+    def track_ops(self, ops: Iterable[T]) -> Iterable[T]:
+        '''
+        Remembers the directive of every op; ops are yielded by the parser
+        right after their line was read
+        '''
+        if not self.enabled:
+            return ops
+        return self._track_ops(ops)
+
+    def _track_ops(self, ops: Iterable[T]) -> Iterator[T]:
+        for op in ops:
+            self.op_directives.append(self.directive)
+            yield op
+
+    def count_bytes(self, converted: Iterable[bytes]) -> Iterable[bytes]:
+        '''
+        Counts the bytes of every directive in the output of iter_convert,
+        which is one chunk before the first op and then one chunk per op
+        '''
+        if not self.enabled:
+            return converted
+        return self._count_bytes(converted)
+
+    def _count_bytes(self, converted: Iterable[bytes]) -> Iterator[bytes]:
+        for i, chunk in enumerate(converted):
+            directive = self.op_directives.popleft() if i else PREFIX
+            self.bytes[directive] = self.bytes.get(directive, 0) + len(chunk)
+            yield chunk
+
+    def as_dict(self) -> Dict:
+        directives = sorted(set(self.lines) | set(self.bytes))
+        return {
+            'python': platform.python_version(),
+            'seconds': self.seconds,
+            'peak_bytes': self.peak_bytes,
+            'stages': self.stages,
+            'directives': {x: {'lines': self.lines.get(x, 0),
+                               'bytes': self.bytes.get(x, 0)}
+                           for x in directives},
+        }
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
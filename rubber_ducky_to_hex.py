@@ -6,48 +6,218 @@ This script does the following:
         send the appropriate keys
     3. Make-s the demo code with the updated keyboard task
     4. Produces a .hex file ready to be flashed on the LaFortuna board
+
+With --patch the payload is written into a .hex built earlier with --reserve
+instead, which needs neither keyboard_task.c nor the avr-gcc toolchain.
+With --compress the keys are stored compressed (see compress.py) when that
+makes them smaller. --opt-level sets how much optimizer.py may rewrite the
+keys before that.
+Several scripts are packed into one image; the board types the one selected
+by the button held when it is plugged in (see payload.py).
+A script given as - is read from stdin and the .hex, --bin and --c-array
+are written to stdout when given as -. The same steps can be run from
+Python with the functions of ducky.py.
+Nothing is printed unless --verbose is given (to stderr). --profile writes
+the time and memory of every stage and what each directive emitted as JSON
+(see profiler.py).
 '''
 
-import utilities
-import ducky_script_parser as dsp
-import ducky_to_hid as dth
+import argparse
 import os
+import sys
+import ducky
+import lru
+import payload
+
+DUCKY_SCRIPT_PATH = 'duckyScript.txt'
+# Scripts and outputs given as - are read from stdin and written to stdout
+STDIO = '-'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scripts', nargs='*', metavar='SCRIPT',
+                        default=[DUCKY_SCRIPT_PATH],
+                        help='scripts to pack into one image, selected by '
+                             'the button held when plugging the board in: '
+                             'none, north, east, south, west; - reads '
+                             'stdin (default: duckyScript.txt)')
+    parser.add_argument('--bin', metavar='PATH',
+                        help='write the raw payload bytes to PATH instead '
+                             'of building the firmware')
+    parser.add_argument('--c-array', metavar='PATH',
+                        help='write the usb_keys line of keyboard_task.c '
+                             'to PATH instead of building the firmware')
+    parser.add_argument('--patch', metavar='TEMPLATE_HEX',
+                        help='write the payload into a .hex built with '
+                             '--reserve instead of compiling')
+    parser.add_argument('--output', metavar='PATH', default='payload.hex',
+                        help='.hex to write (default: %(default)s)')
+    parser.add_argument('--reserve', metavar='BYTES', type=int,
+                        help='reserve room for payloads of up to BYTES in '
+                             'the firmware so it can be used with --patch '
+                             '(including %d bytes of index per payload)'
+                             % payload.ENTRY_SIZE)
+    parser.add_argument('--jobs', metavar='N', type=int,
+                        help='parallel make jobs (default: one per cpu)')
+    parser.add_argument('--text-encoding', default='keys',
+                        choices=ducky.TEXT_ENCODINGS,
+                        help='how STRING text is typed; packed presses '
+                             'several keys per HID report, ascii stores the '
+                             'text itself (default: %(default)s)')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the keys when that makes them smaller '
+                             '(--bin then writes the compressed keys)')
+    parser.add_argument('--opt-level', metavar='N', type=int,
+                        default=ducky.DEFAULT_OPT_LEVEL,
+                        choices=range(ducky.MAX_OPT_LEVEL + 1),
+                        help='0 keeps the keys as converted, 1 merges and '
+                             'drops delays, 2 also cancels caps lock '
+                             'toggles, 3 also types repeated blocks '
+                             'with a CALL_KEY of the first copy (default: '
+                             '%(default)s)')
+    parser.add_argument('--line-cache', metavar='N', type=int,
+                        default=lru.DEFAULT_SIZE,
+                        help='cache the ops and keys of the last N distinct '
+                             'lines, 0 parses and converts every line '
+                             '(default: %(default)s)')
+    parser.add_argument('--profile', metavar='JSON',
+                        help='write the time and peak memory of every stage '
+                             'and the lines and bytes of every directive to '
+                             'JSON')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print what every stage did and the make output')
+    args = parser.parse_args(argv)
+    if len(args.scripts) > payload.MAX_PAYLOADS:
+        parser.error(f'at most {payload.MAX_PAYLOADS} scripts fit in an image')
+    if args.scripts.count(STDIO) > 1:
+        parser.error('stdin can only be read once')
+    if args.line_cache < 0:
+        parser.error('--line-cache cannot be negative')
+    if args.bin and len(args.scripts) > 1:
+        parser.error('--bin writes the keys of a single script')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # stdout may be an output
+    log = (lambda *x: print(*x, file=sys.stderr)) if args.verbose \
+        else lambda *_: None
+    import ducky_script_parser as dsp
+    import ducky_to_hid as dth
+    if args.profile:
+        import profiler
+        profile = profiler.Profile()
+    else:
+        profile = ducky.NullProfile()
+    with profile:
+        payloads = []
+        converters = []
+        parser = dsp.DuckyScriptParser(args.line_cache)
+        for script_path in args.scripts:
+            converter = dth.DuckyScriptConverter(args.text_encoding,
+                                                 args.line_cache)
+            chunks, flags = ducky.convert_script(
+                read_script(script_path), converter, args.opt_level,
+                args.compress, profile, log if args.verbose else None,
+                parser)
+            payloads.append((chunks, flags))
+            converters.append(converter)
+
+        if args.bin:
+            with profile.stage('write'):
+                if args.bin == STDIO:
+                    for chunk in payloads[0][0]:
+                        sys.stdout.buffer.write(chunk)
+                    sys.stdout.flush()
+                else:
+                    payload.write_binary(args.bin, payloads[0][0])
+        elif args.c_array:
+            with profile.stage('write'):
+                write_c_array(args.c_array, payloads, args.reserve)
+        elif args.patch:
+            with profile.stage('patch'):
+                # no compiling, just replace the payloads of the prebuilt
+                # image
+                write_output(args.output, ducky.patch_hex(
+                    args.patch, [payload.Payload(b''.join(x), flags)
+                                 for x, flags in payloads]))
+        else:
+            with profile.stage('build') as info:
+                report = build_hex(payloads, args)
+                info.update(cache_hit=report.cache_hit,
+                            payload_bytes=report.payload_size,
+                            steps=dict(report.steps))
+            log(report)
+    saved = sum(x.keystrokes_saved for x in converters)
+    log(f'capitals: {saved} keystrokes saved')
+    if parser.cache is not None:
+        log(f'parse cache: {parser.cache.stats()}')
+        for i, converter in enumerate(converters):
+            log(f'convert cache of script {i + 1}: {converter.cache.stats()}')
+    if args.profile:
+        profile.write(args.profile)
+
+
+def read_script(script_path: str):
+    if script_path == STDIO:
+        return sys.stdin
+    # the lines are read while converting
+    import utilities
+    return utilities.iter_lines(script_path)
+
+
+def write_output(path: str, text: str) -> None:
+    if path == STDIO:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def write_c_array(path: str, payloads, capacity) -> None:
+    '''
+    Streams the usb_keys array of the converted payloads into path, failing
+    as soon as they outgrow the capacity
+    '''
+    if path == STDIO:
+        # stdout is not seekable, the array is bounded by the capacity
+        import io
+        f = io.StringIO()
+        payload.write_c_array(f, payloads, capacity)
+        write_output(path, f.getvalue() + '\n')
+        return
+    with open(path, 'w') as f:
+        payload.write_c_array(f, payloads, capacity)
+        f.write('\n')
+
 
-DUCKY_SCRIPT_PATH = os.path.join(os.getcwd(), 'duckyScript.txt')
-KEYBOARD_TASK_PATH = os.path.join(os.getcwd(), 'USB Keyboard',
-                                  'USBKEY_STK525-series6-hidkbd-2_0_3-doc',
-                                  'at90usb128', 'demo',
-                                  'USBKEY_STK525-series6-hidkbd',
-                                  'keyboard_task.c')
-MAKEFILE_PATH = os.path.join(os.getcwd(), 'USB Keyboard',
-                                          'USBKEY_STK525-series6-hidkbd-2_0_3-doc',
-                                          'at90usb128', 'demo',
-                                          'USBKEY_STK525-series6-hidkbd',
-                                          'gcc')
-
-
-def main():
-    ducky_script_lines = utilities.get_lines(DUCKY_SCRIPT_PATH)
-    # print(ducky_script_lines)
-    parser = dsp.DuckyScriptParser()
-    parsed = parser.parse(ducky_script_lines)
-
-    converter = dth.DuckyScriptConverter()
-    converted = converter.convert(parsed.split('\n'))
-
-    array_str = utilities.create_array_string('const U8 code', 'usb_keys',
-                                              converted)
-
-    keyboard_task_lines = utilities.get_lines(KEYBOARD_TASK_PATH)
-    changed_lines = utilities.replace_line(keyboard_task_lines,
-                                           'const U8 code usb_keys',
-                                           array_str)
-    new_keyboard_task_file = '\n'.join(changed_lines)
-
-    # overwrite file
-    utilities.write_file(KEYBOARD_TASK_PATH, new_keyboard_task_file)
-    # run make
-    utilities.make(MAKEFILE_PATH)
+def build_hex(payloads, args: argparse.Namespace):
+    '''
+    Builds the firmware into --output, returns the build.BuildReport
+    '''
+    import build
+    import shutil
+    import tempfile
+    cache = build.BuildCache(ducky.BUILD_CACHE_PATH)
+    if args.output != STDIO:
+        return ducky.compile_payload(payloads, ducky.FIRMWARE_PATH,
+                                     args.output, cache, args.reserve,
+                                     args.jobs, quiet=not args.verbose)
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = os.path.join(tmp, 'payload.hex')
+        # the output of make would end up in the .hex
+        report = ducky.compile_payload(payloads, ducky.FIRMWARE_PATH,
+                                       output_path, cache, args.reserve,
+                                       args.jobs, quiet=True)
+        with open(output_path, 'r') as f:
+            shutil.copyfileobj(f, sys.stdout)
+        sys.stdout.flush()
+    return report
 
 
 if __name__ == "__main__":
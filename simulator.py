@@ -0,0 +1,384 @@
+'''
+Replays a usb_keys payload the way keyboard_task.c does, without a board.
+
+`Firmware` mirrors the state machine of keyboard_task.c - keyboard_task,
+kbd_test_hit, process_key, sendNothing and the REPEAT_KEY/REPORT_KEY/
+STRING_KEY/CALL_KEY handlers - one call at a time. Time only passes where
+the firmware waits: the delays timed by the start of frames (the settle time
+after enumeration, SLEEP_KEY and DELAY_KEY) and the single bank IN endpoint,
+which can only take the next report once the host has polled the previous
+one every EP_INTERVAL_MS.
+
+Usage: python simulator.py [--text-encoding ENCODING] [--opt-level N]
+                           [--compress] [--settle-ms MS] [--button BUTTON]
+                           [SCRIPT...]
+'''
+from typing import List, NamedTuple, Tuple
+import argparse
+import compress
+import hid_keys
+import payload
+
+# usb_descriptors.h: EP_INTERVAL_1, the host polls the IN endpoint every 2 ms
+EP_INTERVAL_MS = 2
+# keyboard_task.c: ENUMERATION_SETTLE_MS, the wait before the first key
+SETTLE_MS = 1000
+
+
+class Report(NamedTuple):
+    '''
+    A HID report as received by the host at `time_ms`
+    '''
+    time_ms: float
+    modifier: int
+    keycodes: Tuple[int, ...]
+
+    @property
+    def empty(self) -> bool:
+        return self.modifier == 0 and not any(self.keycodes)
+
+
+class Playback(NamedTuple):
+    reports: List[Report]
+    # when the last report was received, settle time included
+    duration_ms: float
+    # the part of duration_ms spent settling after enumeration
+    startup_ms: float
+
+    @property
+    def seconds(self) -> float:
+        return self.duration_ms / 1000
+
+    @property
+    def typing_ms(self) -> float:
+        return self.duration_ms - self.startup_ms
+
+
+class Firmware(object):
+    '''
+    The keyboard task of keyboard_task.c, running on the usb_keys array
+    `image` (header included, see payload.py) and typing the payload selected
+    by the index of `button` in payload.SELECT_BUTTONS (held when the board
+    was plugged in)
+    '''
+    def __init__(self, image: bytes, interval_ms: float = EP_INTERVAL_MS,
+                 settle_ms: float = SETTLE_MS, button: int = 0):
+        self.image = image
+        self.interval_ms = interval_ms
+        self.settle_ms = settle_ms
+        self.selected_payload = button
+
+        self.time_ms = 0.0
+        self.startup_ms = 0.0
+        # when the host has taken the report in the endpoint bank
+        self.bank_free_at = 0.0
+        self.reports: List[Report] = []
+
+        self.transmit_no_key = False
+        self.key_hit = False
+        self.usb_key = 0
+        self.usb_kbd_state = 0
+        self.usb_data_to_send = 0
+        self.usb_key_pointer = 0
+        self.payload_pointer = 0
+        self.packing = False
+        self.packed_modifier = hid_keys.MODIFIER_NONE
+        self.packed_length = 0
+        self.packed_index = 0
+        self.packed_window: List[int] = []
+        self.string_left = 0
+        self.ascii_keys = hid_keys.ascii_table()
+        self.compressed = False
+        self.literal_left = 0
+        self.match_left = 0
+        self.match_pointer = 0
+        self.modifier_keys_to_read = 0
+        self.modifier = hid_keys.MODIFIER_NONE
+        self.should_sleep = False
+        self.is_first_message = True
+        self.settled = False
+        self.repeating = False
+        self.repeats_left = 0
+        # (usb_key_pointer, usb_data_to_send) to return to from a CALL_KEY
+        self.call_stack: List[Tuple[int, int]] = []
+
+    @property
+    def done(self) -> bool:
+        return not self.is_first_message and self.usb_kbd_state == 0 \
+            and not self.key_hit
+
+    def run(self) -> Playback:
+        while not self.done:
+            self.keyboard_task()
+        duration = self.reports[-1].time_ms if self.reports else 0.0
+        return Playback(self.reports, duration, self.startup_ms)
+
+    def delay_ms(self, ms: float) -> None:
+        self.time_ms += ms
+
+    def is_usb_write_enabled(self) -> bool:
+        if self.time_ms < self.bank_free_at:
+            # nothing else happens until the host polls the endpoint
+            self.time_ms = self.bank_free_at
+        return True
+
+    def send_in(self, modifier: int, keycodes: Tuple[int, ...]) -> None:
+        # the host polls at the next interval boundary
+        polled = (self.time_ms // self.interval_ms + 1) * self.interval_ms
+        self.bank_free_at = polled
+        self.reports.append(Report(polled, modifier, keycodes))
+
+    def read_flash_key(self) -> int:
+        self.usb_data_to_send -= 1
+        key = self.image[self.usb_key_pointer]
+        self.usb_key_pointer += 1
+        return key
+
+    def read_usb_key(self) -> int:
+        if not self.compressed:
+            return self.read_flash_key()
+        if self.literal_left == 0 and self.match_left == 0:
+            control = self.read_flash_key()
+            if control >= compress.MATCH:
+                offset = self.read_flash_key() | self.read_flash_key() << 8
+                self.match_left = control - compress.MATCH + compress.MIN_MATCH
+                self.match_pointer = self.payload_pointer + offset
+            else:
+                self.literal_left = control + 1
+        if self.match_left:
+            self.match_left -= 1
+            self.match_pointer += 1
+            return self.image[self.match_pointer - 1]
+        self.literal_left -= 1
+        return self.read_flash_key()
+
+    def keyboard_task(self) -> None:
+        # the device is enumerated at time 0
+        if not self.settled:
+            self.settled = True
+            self.delay_ms(self.settle_ms)
+            self.startup_ms += self.settle_ms
+        if not self.key_hit:
+            self.kbd_test_hit()
+        elif self.is_usb_write_enabled():
+            if self.packing:
+                self.send_packed_report()
+            elif not self.transmit_no_key:
+                self.process_key()
+            else:
+                self.send_nothing()
+
+    def send_nothing(self) -> None:
+        self.key_hit = False
+        self.transmit_no_key = False
+        self.send_in(0, (0,) * hid_keys.REPORT_ROLLOVER)
+
+    def process_key(self) -> None:
+        self.transmit_no_key = True
+        if self.should_sleep:
+            self.delay_ms(self.usb_key * hid_keys.SLEEP_MS)
+            self.should_sleep = False
+            return
+        elif self.usb_key == hid_keys.SLEEP_KEY:
+            self.should_sleep = True
+            return
+        if self.usb_key > hid_keys.ESCAPE_KEY_START:
+            self.modifier_keys_to_read = self.usb_key
+            self.modifier = hid_keys.MODIFIER_NONE
+            return
+        if self.modifier_keys_to_read > hid_keys.ESCAPE_KEY_START:
+            self.modifier |= self.usb_key
+            self.modifier_keys_to_read -= 1
+            return
+        self.send_in(self.modifier,
+                     (self.usb_key,) + (0,) * (hid_keys.REPORT_ROLLOVER - 1))
+        self.modifier = hid_keys.MODIFIER_NONE
+
+    def read_varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            key = self.read_usb_key()
+            value |= (key & 0x7F) << shift
+            shift += 7
+            if not key & 0x80:
+                return value
+
+    def repeat_block(self) -> None:
+        count = self.read_usb_key() | self.read_usb_key() << 8
+        length = self.read_usb_key() | self.read_usb_key() << 8
+        if not self.repeating:
+            self.repeating = True
+            self.repeats_left = count
+        if self.repeats_left == 0:
+            self.repeating = False
+            return
+        self.repeats_left -= 1
+        self.usb_key_pointer -= length + hid_keys.REPEAT_HEADER_SIZE
+        self.usb_data_to_send += length + hid_keys.REPEAT_HEADER_SIZE
+
+    def call_block(self) -> None:
+        back = self.read_usb_key() | self.read_usb_key() << 8
+        length = self.read_usb_key() | self.read_usb_key() << 8
+        if len(self.call_stack) == hid_keys.MAX_CALL_DEPTH:
+            # never written by the optimizer, the call is skipped
+            return
+        self.call_stack.append((self.usb_key_pointer, self.usb_data_to_send))
+        self.usb_key_pointer -= back + hid_keys.CALL_SIZE
+        self.usb_data_to_send = length
+
+    def start_packed_report(self) -> None:
+        self.packed_modifier = self.read_usb_key()
+        self.packed_length = self.read_usb_key()
+        self.packed_index = 0
+        self.packed_window = []
+        self.packing = True
+
+    def send_packed_report(self) -> None:
+        if self.packed_index == self.packed_length:
+            self.packing = False
+            self.send_nothing()
+            return
+        if len(self.packed_window) == hid_keys.REPORT_ROLLOVER:
+            del self.packed_window[0]
+        self.packed_window.append(self.read_usb_key())
+        keycodes = tuple(self.packed_window) \
+            + (0,) * (hid_keys.REPORT_ROLLOVER - len(self.packed_window))
+        self.send_in(self.packed_modifier, keycodes)
+        self.packed_index += 1
+
+    def next_string_key(self) -> None:
+        entry = self.ascii_keys[self.read_usb_key() & 0x7F]
+        self.usb_key = entry & ~hid_keys.ASCII_SHIFT
+        self.modifier = hid_keys.MODIFIER_LEFT_SHIFT \
+            if entry & hid_keys.ASCII_SHIFT else hid_keys.MODIFIER_NONE
+        self.string_left -= 1
+
+    def start_payload(self, index: int) -> None:
+        self.usb_key_pointer = payload.COUNT_OFFSET
+        if index >= self.read_flash_key():
+            return
+        self.usb_key_pointer = payload.HEADER_SIZE + index * payload.ENTRY_SIZE
+        offset = self.read_flash_key() | self.read_flash_key() << 8
+        length = self.read_flash_key() | self.read_flash_key() << 8
+        self.compressed = bool(self.read_flash_key() & payload.COMPRESSED)
+        self.payload_pointer = offset
+        self.usb_key_pointer = offset
+        self.usb_data_to_send = length
+        self.usb_kbd_state = 1
+
+    def kbd_test_hit(self) -> None:
+        if self.usb_kbd_state == 0:
+            # the buttons are not simulated, nothing is typed again
+            if not self.is_first_message:
+                return
+            self.is_first_message = False
+            self.start_payload(self.selected_payload)
+        elif self.usb_kbd_state == 1:
+            if self.usb_data_to_send == 0 and self.match_left == 0:
+                if self.call_stack:
+                    self.usb_key_pointer, self.usb_data_to_send = \
+                        self.call_stack.pop()
+                else:
+                    self.usb_kbd_state = 0
+            elif not self.key_hit and not self.transmit_no_key:
+                if self.string_left:
+                    self.next_string_key()
+                    self.key_hit = True
+                    return
+                self.usb_key = self.read_usb_key()
+                if not self.should_sleep and self.modifier_keys_to_read \
+                        <= hid_keys.ESCAPE_KEY_START:
+                    if self.usb_key == hid_keys.REPEAT_KEY:
+                        self.repeat_block()
+                        return
+                    if self.usb_key == hid_keys.CALL_KEY:
+                        self.call_block()
+                        return
+                    if self.usb_key == hid_keys.DELAY_KEY:
+                        self.delay_ms(self.read_varint())
+                        return
+                    if self.usb_key == hid_keys.REPORT_KEY:
+                        self.start_packed_report()
+                    if self.usb_key == hid_keys.STRING_KEY:
+                        self.string_left = self.read_usb_key()
+                        return
+                self.key_hit = True
+
+
+def simulate(keys: bytes, flags: int = 0, **kwargs) -> Playback:
+    '''
+    Returns the reports the firmware sends when typing `keys`
+    (the output of ducky_to_hid, or of compress with payload.COMPRESSED in
+    `flags`). Keyword arguments are passed to Firmware.
+    '''
+    return Firmware(payload.build(keys, flags=flags), **kwargs).run()
+
+
+def count_keys(reports: List[Report]) -> int:
+    '''
+    Returns the number of key presses - keycodes that were not held in the
+    report before
+    '''
+    result = 0
+    held: Tuple[int, ...] = ()
+    for report in reports:
+        result += sum(1 for x in report.keycodes if x and x not in held)
+        held = report.keycodes
+    return result
+
+
+def main(argv=None):
+    import ducky
+    import utilities
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scripts', nargs='*', metavar='SCRIPT',
+                        default=['duckyScript.txt'],
+                        help='payloads of the image, see '
+                             'rubber_ducky_to_hex.py')
+    parser.add_argument('--text-encoding', default='keys',
+                        choices=ducky.TEXT_ENCODINGS)
+    parser.add_argument('--opt-level', type=int,
+                        default=ducky.DEFAULT_OPT_LEVEL,
+                        choices=range(ducky.MAX_OPT_LEVEL + 1))
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the keys when that makes them '
+                             'smaller, like rubber_ducky_to_hex.py')
+    parser.add_argument('--settle-ms', type=float, default=SETTLE_MS,
+                        help='ENUMERATION_SETTLE_MS of keyboard_task.c '
+                             '(default: %(default)s)')
+    parser.add_argument('--button', default='none',
+                        choices=[x.lower() for x in payload.SELECT_BUTTONS],
+                        help='button held when plugging the board in, '
+                             'selects the payload (default: %(default)s)')
+    parser.add_argument('--reports', action='store_true',
+                        help='print every report')
+    args = parser.parse_args(argv)
+
+    # the payloads exactly as rubber_ducky_to_hex.py writes them
+    payloads = [ducky.compile_script(utilities.iter_lines(x),
+                                     args.text_encoding, args.opt_level,
+                                     args.compress)
+                for x in args.scripts]
+    button = payload.SELECT_BUTTONS.index(args.button.upper())
+    if button >= len(payloads):
+        parser.error(f'no payload is selected by {args.button}')
+    keys = payloads[button].keys
+    playback = Firmware(payload.build_image(payloads),
+                        settle_ms=args.settle_ms, button=button).run()
+    if args.reports:
+        for report in playback.reports:
+            keycodes = ' '.join(f'{x:3}' for x in report.keycodes)
+            print(f'{report.time_ms:10.0f} ms  {report.modifier:02x}  '
+                  f'{keycodes}')
+    print(f'{len(keys)} bytes, {len(playback.reports)} reports, '
+          f'{count_keys(playback.reports)} key presses, '
+          f'{playback.seconds:.3f}s ({playback.typing_ms / 1000:.3f}s after '
+          f'settling)')
+
+
+if __name__ == '__main__':
+    main()
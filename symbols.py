@@ -0,0 +1,210 @@
+'''
+Integer symbol table of the firmware's #defines.
+
+The keycodes of `modules/usb/usb_commun_hid.h` and the reserved codes and
+header layout #defined in keyboard_task.c are parsed into a name -> int
+dictionary, so the values hid_keys, payload and compress hard code can be
+checked against the C sources before anything is compiled (see `check`).
+
+Parsing is cached in a JSON file. A file whose mtime and size did not
+change is not read at all; one that was touched but whose content hash did
+not change is not parsed again.
+
+Usage: python symbols.py [NAME...]
+'''
+from typing import Dict, Iterable, List, Optional
+import hashlib
+import json
+import os
+import re
+import compress
+import hid_keys
+import payload
+
+# Paths inside the firmware tree
+HID_HEADER = os.path.join('at90usb128', 'modules', 'usb', 'usb_commun_hid.h')
+KEYBOARD_TASK = os.path.join('at90usb128', 'demo',
+                             'USBKEY_STK525-series6-hidkbd',
+                             'keyboard_task.c')
+SOURCES = (HID_HEADER, KEYBOARD_TASK)
+# Name of the cache file in the build cache directory
+CACHE_NAME = 'symbols.json'
+
+# An object like macro whose value is a number or a symbol, with an
+# optional trailing comment. Function like macros and expressions are
+# skipped.
+DEFINE = re.compile(r'\s*#define\s+(\w+)\s+(\w+)\s*(?://.*|/\*.*)?$')
+
+
+def parse(lines: Iterable[str],
+          known: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    '''
+    Returns the integer #defines of the lines. Symbols defined as another
+    symbol are resolved from earlier lines and `known`.
+    '''
+    known = dict(known or {})
+    result = {}
+    for line in lines:
+        match = DEFINE.match(line)
+        if match is None:
+            continue
+        name, value = match.groups()
+        try:
+            result[name] = known[name] = int(value, 0)
+        except ValueError:
+            if value in known:
+                result[name] = known[name] = known[value]
+    return result
+
+
+class SymbolCache(object):
+    '''
+    Symbols of parsed files. Without a path nothing is stored.
+    '''
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.data = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.data = json.load(f)
+            except ValueError:
+                # a corrupt cache is rebuilt
+                pass
+        # source path -> [mtime_ns, size, sha256]
+        self.data.setdefault('stats', {})
+        # sha256 -> symbols of a file with that content
+        self.data.setdefault('symbols', {})
+        self.changed = False
+
+    def file_symbols(self, path: str, known: Dict[str, int]) -> Dict[str, int]:
+        stat = os.stat(path)
+        cached = self.data['stats'].get(path)
+        if cached is not None and cached[:2] == [stat.st_mtime_ns,
+                                                 stat.st_size]:
+            symbols = self.data['symbols'].get(cached[2])
+            if symbols is not None:
+                return symbols
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        self.data['stats'][path] = [stat.st_mtime_ns, stat.st_size, digest]
+        self.changed = True
+        if digest not in self.data['symbols']:
+            self.data['symbols'][digest] = parse(
+                content.decode('latin-1').splitlines(), known)
+        return self.data['symbols'][digest]
+
+    def save(self) -> None:
+        '''
+        Writes the cache, forgetting sources that no longer exist. The file
+        is renamed into place so concurrent builds never read half of it.
+        '''
+        if self.path is None or not self.changed:
+            return
+        stats = {k: v for k, v in self.data['stats'].items()
+                 if os.path.exists(k)}
+        used = set(x[2] for x in stats.values())
+        self.data = {'stats': stats,
+                     'symbols': {k: v for k, v in self.data['symbols'].items()
+                                 if k in used}}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+def load(firmware_path: str, cache_path: Optional[str] = None
+         ) -> Dict[str, int]:
+    '''
+    Returns the symbols of SOURCES in the firmware tree at `firmware_path`,
+    using and updating the cache at `cache_path` if given
+    '''
+    cache = SymbolCache(cache_path)
+    result: Dict[str, int] = {}
+    for source in SOURCES:
+        path = os.path.abspath(os.path.join(firmware_path, source))
+        result.update(cache.file_symbols(path, result))
+    cache.save()
+    return result
+
+
+def expected() -> Dict[str, int]:
+    '''
+    Returns the values the Python side assumes, by C name
+    '''
+    result = {
+        'ESCAPE_KEY_START': hid_keys.ESCAPE_KEY_START,
+        'SLEEP_KEY': hid_keys.SLEEP_KEY,
+        'SLEEP_MS': hid_keys.SLEEP_MS,
+        'DELAY_KEY': hid_keys.DELAY_KEY,
+        'REPEAT_KEY': hid_keys.REPEAT_KEY,
+        'REPEAT_HEADER_SIZE': hid_keys.REPEAT_HEADER_SIZE,
+        'REPORT_KEY': hid_keys.REPORT_KEY,
+        'REPORT_ROLLOVER': hid_keys.REPORT_ROLLOVER,
+        'STRING_KEY': hid_keys.STRING_KEY,
+        'ASCII_SHIFT': hid_keys.ASCII_SHIFT,
+        'CALL_KEY': hid_keys.CALL_KEY,
+        'CALL_SIZE': hid_keys.CALL_SIZE,
+        'MAX_CALL_DEPTH': hid_keys.MAX_CALL_DEPTH,
+        'USB_KEYS_COUNT_OFFSET': payload.COUNT_OFFSET,
+        'USB_KEYS_HEADER_SIZE': payload.HEADER_SIZE,
+        'USB_KEYS_ENTRY_SIZE': payload.ENTRY_SIZE,
+        'USB_KEYS_PAGE_SIZE': payload.PAGE_SIZE,
+        'USB_KEYS_COMPRESSED': payload.COMPRESSED,
+        'MAX_PAYLOADS': payload.MAX_PAYLOADS,
+        'LZ_MATCH': compress.MATCH,
+        'LZ_MIN_MATCH': compress.MIN_MATCH,
+    }
+    for name in ('NONE', 'LEFT_CTRL', 'LEFT_SHIFT', 'LEFT_ALT', 'LEFT_GUI'):
+        result[f'HID_MODIFIER_{name}'] = getattr(hid_keys, f'MODIFIER_{name}')
+    for i, name in enumerate(payload.SELECT_BUTTONS):
+        result[f'BUTTON_{name}'] = i
+    for name, value in hid_keys.KEYCODES.items():
+        result[f'HID_{name}'] = value
+    return result
+
+
+def check(symbols: Dict[str, int]) -> List[str]:
+    '''
+    Returns a description of every value the Python side assumes that is
+    missing from or different in `symbols`
+    '''
+    result = []
+    for name, value in expected().items():
+        if name not in symbols:
+            result.append(f'{name} is not defined')
+        elif symbols[name] != value:
+            result.append(f'{name} is {symbols[name]}, expected {value}')
+    return result
+
+
+def main(argv=None):
+    import argparse
+    import ducky
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='symbols to print (default: all)')
+    args = parser.parse_args(argv)
+
+    symbols = load(ducky.FIRMWARE_PATH,
+                   os.path.join(ducky.BUILD_CACHE_PATH,
+                                CACHE_NAME))
+    for name in args.names or sorted(symbols):
+        print(f'{name} = {symbols[name]}' if name in symbols
+              else f'{name} is not defined')
+    problems = check(symbols)
+    for problem in problems:
+        print(f'mismatch: {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
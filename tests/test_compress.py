@@ -0,0 +1,118 @@
+import glob
+import os
+import random
+import pytest
+import compress
+import ducky
+import hid_keys
+import payload
+import simulator
+
+TYPING_SCRIPTS = sorted(glob.glob(os.path.join(
+    ducky.ROOT_PATH, 'benchmarks', 'typing', '*.txt')))
+REPEATS = 'STRING hello world, hello world\nREPEAT 3\nDELAY 100\nREPEAT 2\n'
+FUNCTIONS = ('FUNCTION greet\nSTRING Hello there, how are you\nENTER\n'
+             'END_FUNCTION\nCALL greet\nSTRING and again:\nCALL greet\n'
+             'CALL greet\nREPEAT 2\n')
+
+
+def reports(keys: bytes, flags: int = 0) -> list:
+    return [(x.modifier, x.keycodes)
+            for x in simulator.simulate(keys, flags).reports]
+
+
+def tokens(compressed: bytes) -> list:
+    '''
+    Returns the (offset, data) of every literal token and the (offset,
+    None) of every match token
+    '''
+    result = []
+    i = 0
+    while i < len(compressed):
+        control = compressed[i]
+        if control & compress.MATCH:
+            result.append((i, None))
+            i += 3
+        else:
+            result.append((i, compressed[i + 1:i + control + 2]))
+            i += control + 2
+    assert i == len(compressed)
+    return result
+
+
+def assert_round_trip(keys: bytes) -> bytes:
+    compressed = compress.compress(keys)
+    assert reports(compressed, payload.COMPRESSED) == reports(keys)
+    return compressed
+
+
+@pytest.mark.parametrize('path', TYPING_SCRIPTS)
+@pytest.mark.parametrize('encoding', ducky.TEXT_ENCODINGS)
+def test_typing_scripts(path, encoding):
+    with open(path, 'r') as f:
+        keys = ducky.compile_script(f, encoding, ducky.MAX_OPT_LEVEL).keys
+    assert_round_trip(keys)
+
+
+@pytest.mark.parametrize('script', [REPEATS, FUNCTIONS])
+@pytest.mark.parametrize('opt_level', range(ducky.MAX_OPT_LEVEL + 1))
+def test_rewinds_are_tokens_of_their_own(script, opt_level):
+    keys = ducky.compile_script(script, opt_level=opt_level).keys
+    compressed = assert_round_trip(keys)
+    found = tokens(compressed)
+    starts = {offset for offset, _ in found}
+    rewinds = 0
+    for offset, data in found:
+        if data is None or data[0] not in (hid_keys.REPEAT_KEY,
+                                           hid_keys.CALL_KEY):
+            continue
+        rewinds += 1
+        # the block is rewound to from right after the control byte, and
+        # starts and ends at a token
+        back = int.from_bytes(data[1:3] if data[0] == hid_keys.CALL_KEY
+                              else data[-2:], 'little')
+        block = offset + 1 - back
+        assert block in starts
+        if data[0] == hid_keys.CALL_KEY:
+            assert len(data) == hid_keys.CALL_SIZE
+            assert block + int.from_bytes(data[3:5], 'little') in starts
+        else:
+            assert len(data) == hid_keys.REPEAT_HEADER_SIZE
+    assert rewinds
+
+
+def test_matches_do_not_span_blocks():
+    # the repeated block is typed again right before the REPEAT_KEY, so
+    # the text would otherwise be matched across the block start
+    script = 'STRING abcdefghijkl\nSTRING abcdefghijkl\nREPEAT 5\n' * 3
+    assert_round_trip(ducky.compile_script(script, opt_level=0).keys)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_scripts(seed):
+    generator = random.Random(seed)
+    words = ['hello', 'world', 'Hello', 'WORLD', 'abc', 'x']
+    lines = []
+    for _ in range(generator.randrange(5, 40)):
+        kind = generator.random()
+        if kind < 0.5 or not lines:
+            lines.append('STRING ' + ' '.join(
+                generator.choice(words)
+                for _ in range(generator.randrange(1, 6))))
+        elif kind < 0.7:
+            lines.append(f'REPEAT {generator.randrange(1, 4)}')
+        elif kind < 0.85:
+            lines.append(f'DELAY {generator.randrange(0, 300)}')
+        else:
+            lines.append(generator.choice(['ENTER', 'GUI r', 'CTRL c']))
+    for opt_level in (0, ducky.MAX_OPT_LEVEL):
+        keys = ducky.compile_script('\n'.join(lines),
+                                    generator.choice(ducky.TEXT_ENCODINGS),
+                                    opt_level).keys
+        assert_round_trip(keys)
+
+
+def test_repeat_before_the_keys():
+    keys = bytes([4, hid_keys.REPEAT_KEY, 2, 0, 5, 0])
+    with pytest.raises(ValueError):
+        compress.compress(keys)
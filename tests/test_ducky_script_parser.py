@@ -0,0 +1,40 @@
+import pytest
+import ducky_script_parser as dsp
+from ducky_ir import Chord, Delay, Text
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('GUI r', 'GUI r'),
+    ('  GUI \t r  ', 'GUI r'),
+    ('DELAY   500', 'DELAY 500'),
+    ('', ''),
+    ('  STRING  two  spaces ', 'STRING  two  spaces '),
+])
+def test_normalize(line, expected):
+    assert dsp.normalize(line) == expected
+
+
+def test_whitespace_variants_hit_the_cache():
+    parser = dsp.DuckyScriptParser()
+    ops = parser.parse(['GUI r', ' GUI r', 'GUI  r', 'GUI r\t',
+                        'DELAY 500', '\tDELAY   500 '])
+    assert ops[:4] == [ops[0]] * 4
+    assert ops[4:] == [Delay(500)] * 2
+    stats = parser.cache.stats()
+    assert (stats.hits, stats.misses, stats.size) == (4, 2, 2)
+
+
+def test_string_text_is_kept():
+    parser = dsp.DuckyScriptParser()
+    ops = parser.parse(['STRING a  b', ' STRING a  b', 'STRING a b',
+                        'STRING a b '])
+    assert [x.text for x in ops] == ['a  b', 'a  b', 'a b', 'a b ']
+    assert parser.cache.stats().hits == 1
+
+
+def test_uncached_parser_normalizes_too():
+    cached = dsp.DuckyScriptParser().parse(['  GUI   r', 'STRING  x '])
+    uncached = dsp.DuckyScriptParser(0).parse(['  GUI   r', 'STRING  x '])
+    assert cached == uncached
+    assert isinstance(uncached[0], Chord)
+    assert uncached[1] == Text(' x ')
@@ -0,0 +1,107 @@
+import pytest
+import ducky
+import intel_hex
+import payload
+
+# usb_keys starts at a page, after code that shares no record with it
+START = 2 * payload.PAGE_SIZE + 5
+CAPACITY = payload.page_capacity(100)
+
+
+def template(start: int = START, keys: bytes = b'old keys',
+             code: bytes = bytes(range(256)) * 2) -> tuple:
+    '''
+    Returns the lines of an image holding usb_keys at `start` after `code`
+    and before some more, and its memory
+    '''
+    image = payload.build_image([payload.Payload(keys)], CAPACITY)
+    memory = code + bytes(start - len(code)) + image + bytes(range(40))
+    return intel_hex.format_memory(memory, [(0, len(memory))]), memory
+
+
+def test_payloads_are_replaced():
+    lines, memory = template()
+    new = [payload.Payload(b'new keys, longer'),
+           payload.Payload(b'\x01\x02', payload.COMPRESSED)]
+    patched = intel_hex.patch(lines, new)
+    result, defined = intel_hex.read_memory(patched)
+    end = START + payload.HEADER_SIZE + CAPACITY
+    assert all(defined)
+    assert result[START:end] == payload.build_image(new, CAPACITY)
+    assert result[:START] == memory[:START]
+    assert result[end:] == memory[end:]
+
+
+def test_records_outside_usb_keys_are_kept():
+    lines, _ = template()
+    patched = intel_hex.patch(lines, [payload.Payload(b'other')])
+    assert len(patched) == len(lines)
+    first = START // intel_hex.RECORD_SIZE
+    last = (START + payload.HEADER_SIZE + CAPACITY - 1) \
+        // intel_hex.RECORD_SIZE
+    for i, (old, new) in enumerate(zip(lines, patched)):
+        if not first <= i <= last:
+            assert old == new
+    for line in patched:
+        # the checksums of the rewritten records are right
+        intel_hex.parse_record(line)
+
+
+def test_addresses_above_64k():
+    lines, memory = template(0x10000 - 3)
+    assert any(intel_hex.parse_record(x)[3]
+               == intel_hex.EXTENDED_LINEAR_ADDRESS for x in lines)
+    new = [payload.Payload(b'across the 64k boundary')]
+    result, _ = intel_hex.read_memory(intel_hex.patch(lines, new))
+    start = 0x10000 - 3
+    assert result[start:start + payload.HEADER_SIZE + CAPACITY] == \
+        payload.build_image(new, CAPACITY)
+
+
+def test_payloads_larger_than_the_capacity():
+    lines, _ = template()
+    with pytest.raises(ValueError):
+        intel_hex.patch(lines, [payload.Payload(bytes(CAPACITY))])
+
+
+def test_image_without_usb_keys():
+    lines = intel_hex.format_memory(bytes(range(200)), [(0, 200)])
+    with pytest.raises(ValueError):
+        intel_hex.patch(lines, [payload.Payload(b'keys')])
+
+
+def test_partly_defined_usb_keys():
+    lines, memory = template()
+    # drop the last record of usb_keys
+    end = START + payload.HEADER_SIZE + CAPACITY
+    lines = intel_hex.format_memory(memory, [(0, end - 1)])
+    with pytest.raises(ValueError):
+        intel_hex.patch(lines, [payload.Payload(b'keys')])
+
+
+def test_magic_typed_as_text():
+    # STRING text is stored as it is with the ascii encoding
+    keys = ducky.compile_script('STRING ' + payload.MAGIC.decode() * 2,
+                                'ascii').keys
+    assert payload.MAGIC in keys
+    lines, _ = template(keys=keys)
+    for _ in range(2):
+        lines = intel_hex.patch(lines, [payload.Payload(keys)])
+    result, _ = intel_hex.read_memory(lines)
+    assert intel_hex.find_payload(result) == START
+    assert result[START:START + payload.HEADER_SIZE + CAPACITY] == \
+        payload.build_image([payload.Payload(keys)], CAPACITY)
+
+
+def test_magic_before_the_header():
+    code = bytes(range(256)) + payload.MAGIC + bytes(range(248))
+    lines, _ = template(code=code)
+    result, _ = intel_hex.read_memory(intel_hex.patch(
+        lines, [payload.Payload(b'keys')]))
+    assert intel_hex.find_payload(result) == START
+
+
+def test_magic_without_a_header():
+    memory = bytes(100) + payload.MAGIC + bytes(range(200))
+    with pytest.raises(ValueError):
+        intel_hex.find_payload(memory)
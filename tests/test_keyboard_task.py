@@ -0,0 +1,32 @@
+import os
+import ducky
+import payload
+import symbols
+
+KEYBOARD_TASK_PATH = os.path.join(ducky.FIRMWARE_PATH, ducky.KEYBOARD_TASK)
+
+
+def usb_keys() -> list:
+    '''
+    Returns the elements of the usb_keys initializer of keyboard_task.c
+    '''
+    with open(KEYBOARD_TASK_PATH, 'r') as f:
+        line = next(x for x in f if x.startswith('const U8 code usb_keys'))
+    return line[line.index('{') + 1:line.rindex('}')].split(',')
+
+
+def test_usb_keys_fills_whole_pages():
+    page_size = symbols.load(ducky.FIRMWARE_PATH)['USB_KEYS_PAGE_SIZE']
+    assert page_size == payload.PAGE_SIZE
+    assert len(usb_keys()) % page_size == 0
+
+
+def test_usb_keys_capacity_matches_its_length():
+    elements = usb_keys()
+    capacity = int(elements[len(payload.MAGIC)], 0) \
+        + (int(elements[len(payload.MAGIC) + 1], 0) << 8)
+    assert payload.HEADER_SIZE + capacity == len(elements)
+
+
+def test_firmware_matches_the_encoded_keys():
+    assert symbols.check(symbols.load(ducky.FIRMWARE_PATH)) == []
@@ -0,0 +1,144 @@
+import glob
+import os
+import pytest
+import ducky
+import ducky_script_parser as dsp
+import ducky_to_hid as dth
+import hid_keys
+import optimizer
+import simulator
+
+CAPS_LOCK = hid_keys.keycode('CAPSLOCK')
+TYPING_SCRIPTS = sorted(glob.glob(os.path.join(
+    ducky.ROOT_PATH, 'benchmarks', 'typing', '*.txt')))
+SCRIPTS = [
+    'DELAY 100\nDELAY 0\nDELAY 200\nSTRING a\nDELAY 0\n',
+    'STRING ABC\nSTRING DEF\nSTRING ghi\n',
+    'CTRL ESC\nCONTROL-SHIFT ESC\nALT-SHIFT\nALT F4\nSHIFT TAB\nGUI r\n',
+    'STRING typed twice, typed twice\nENTER\n'
+    'STRING typed twice, typed twice\nENTER\n',
+    'STRING repeated\nREPEAT 3\nDELAY 0\nDELAY 10\nREPEAT 2\n',
+    'FUNCTION f\nSTRING in a function\nDELAY 50\nEND_FUNCTION\n'
+    'CALL f\nCALL f\nREPEAT 2\nCALL f\n',
+]
+
+
+def convert(script: str, encoding: str = 'keys') -> list:
+    '''
+    Returns the chunks the converter streams for the script
+    '''
+    ops = dsp.DuckyScriptParser().iter_parse(script.splitlines())
+    return list(dth.DuckyScriptConverter(encoding).iter_convert(ops))
+
+
+def reports(keys: bytes) -> list:
+    return [(x.modifier, x.keycodes)
+            for x in simulator.simulate(keys).reports]
+
+
+def typed(keys: bytes) -> list:
+    '''
+    Returns the (modifiers, keycode, caps lock) of every key the host sees
+    pressed, the caps lock key itself aside - cancel-caps drops toggles
+    '''
+    result = []
+    caps = False
+    held = ()
+    for modifier, keycodes in reports(keys):
+        for keycode in keycodes:
+            if not keycode or keycode in held:
+                continue
+            if keycode == CAPS_LOCK:
+                caps = not caps
+            else:
+                result.append((modifier, keycode, caps))
+        held = keycodes
+    return result
+
+
+def script_text(path: str) -> str:
+    with open(path, 'r') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('script', SCRIPTS + [
+    script_text(x) for x in TYPING_SCRIPTS])
+@pytest.mark.parametrize('encoding', sorted(dth.TEXT_ENCODINGS))
+def test_levels_type_the_same(script, encoding):
+    keys = b''.join(convert(script, encoding))
+    expected = typed(keys)
+    sizes = []
+    for level in range(optimizer.MAX_LEVEL + 1):
+        optimized, _ = optimizer.optimize(keys, level)
+        assert typed(optimized) == expected
+        sizes.append(len(optimized))
+    assert sizes == sorted(sizes, reverse=True)
+    # dedup types the very same reports
+    assert reports(optimizer.optimize(keys, 3)[0]) == \
+        reports(optimizer.optimize(keys, 2)[0])
+
+
+@pytest.mark.parametrize('script', SCRIPTS)
+@pytest.mark.parametrize('level', range(optimizer.MAX_LEVEL + 1))
+def test_streamed_chunks(script, level):
+    chunks = convert(script)
+    streamed = optimizer.Optimizer(level).iter_optimize(iter(chunks))
+    assert b''.join(streamed) == \
+        optimizer.optimize(b''.join(chunks), level)[0]
+
+
+def test_level_0_keeps_the_keys():
+    keys = b''.join(convert(SCRIPTS[0]))
+    assert optimizer.optimize(keys, 0) == (keys, [])
+
+
+def test_delays_are_merged():
+    keys, passes = optimizer.optimize(b''.join(convert(SCRIPTS[0])), 1,
+                                      report=True)
+    # DELAY 300 before the text, DELAY 0 after it is dropped
+    assert [x[0] for x in optimizer.split(keys)[0]].count(
+        hid_keys.DELAY_KEY) == 1
+    assert [x.name for x in passes] == ['drop-delays', 'merge-delays']
+    assert passes[-1].bytes_after == len(keys)
+
+
+def test_chords_are_converted_folded():
+    # every chord is a single escape with its modifiers or-ed together, so
+    # the converter leaves no modifiers to fold
+    keys = b''.join(convert(SCRIPTS[2]))
+    escapes = [x for x in optimizer.split(keys)[0]
+               if x[0] > hid_keys.ESCAPE_KEY_START]
+    assert len(escapes) == len(SCRIPTS[2].splitlines())
+    for escape in escapes:
+        assert escape[0] == hid_keys.ESCAPE_KEY_START + 1
+        assert escape[1] != hid_keys.MODIFIER_NONE
+    assert optimizer.optimize(keys, optimizer.MAX_LEVEL)[0] == keys
+
+
+def test_passes_are_counted_on_demand():
+    keys = b''.join(convert(SCRIPTS[0]))
+    _, passes = optimizer.optimize(keys, optimizer.MAX_LEVEL)
+    assert passes == []
+
+
+def test_repeated_blocks_are_called():
+    keys = b''.join(convert(SCRIPTS[3]))
+    optimized, passes = optimizer.optimize(keys, optimizer.MAX_LEVEL,
+                                           report=True)
+    assert hid_keys.CALL_KEY in optimized
+    assert passes[-1].name == 'dedup'
+    assert passes[-1].bytes_after < passes[-1].bytes_before
+    assert reports(optimized) == reports(keys)
+
+
+def test_call_depth_is_bounded():
+    # every line types the two lines before it again, so the copies call
+    # copies; the firmware skips a call that is too deep and types less
+    lines = ['STRING abcdefgh', 'STRING ijklmnop']
+    for _ in range(12):
+        lines.append('STRING ' + ' '.join(x.split(' ', 1)[1]
+                                          for x in lines[-2:]))
+    keys = b''.join(convert('\n'.join(lines)))
+    optimized, _ = optimizer.optimize(keys, optimizer.MAX_LEVEL)
+    assert optimized.count(hid_keys.CALL_KEY) > 1
+    assert reports(optimized) == reports(keys)
@@ -0,0 +1,27 @@
+import io
+import pytest
+import ducky
+import payload
+import rubber_ducky_to_hex
+
+
+def test_c_array_matches_the_compiled_payloads(tmp_path):
+    script = tmp_path / 'script.txt'
+    script.write_text('GUI r\nSTRING notepad\nENTER\n')
+    output = tmp_path / 'usb_keys.c'
+    rubber_ducky_to_hex.main([str(script), '--c-array', str(output)])
+    keys = ducky.compile_script(script.read_text())
+    assert output.read_text() == ducky.c_array([keys]) + '\n'
+
+
+def test_c_array_fails_before_reading_everything():
+    read = []
+
+    def chunks():
+        for i in range(payload.MAX_SIZE):
+            read.append(i)
+            yield bytes(100)
+
+    with pytest.raises(ValueError, match='do not fit in'):
+        payload.write_c_array(io.StringIO(), [(chunks(), 0)], 1000)
+    assert len(read) == payload.page_capacity(1000) // 100 + 1
@@ -0,0 +1,12 @@
+import ducky
+import simulator
+
+
+def test_main_runs_the_payload_the_cli_writes(tmp_path, capsys):
+    # too short to compress, so the keys are stored as they are
+    script = tmp_path / 'script.txt'
+    script.write_text('GUI r\nSTRING notepad\nENTER\n')
+    keys = ducky.compile_script(script.read_text(), compress=True)
+    assert keys.flags == 0
+    simulator.main([str(script), '--compress'])
+    assert capsys.readouterr().out.startswith(f'{len(keys.keys)} bytes, ')
@@ -0,0 +1,43 @@
+import symbols
+
+
+def test_parse_defines():
+    lines = ['#define CALL_KEY 245 // reserved',
+             '  #define  MASK 0x80 /* top bit */',
+             '#define COPY CALL_KEY',
+             '#define UNKNOWN SOMETHING_ELSE',
+             '#define NOT_AN_INT (1 << 2)',
+             'int CALL_SIZE = 4;']
+    assert symbols.parse(lines) == {'CALL_KEY': 245, 'MASK': 0x80,
+                                    'COPY': 245}
+
+
+def test_parse_resolves_known_symbols():
+    assert symbols.parse(['#define B A'], {'A': 3}) == {'B': 3}
+
+
+def test_check_accepts_the_expected_values():
+    assert symbols.check(symbols.expected()) == []
+
+
+def test_check_reports_mismatches():
+    defines = symbols.expected()
+    del defines['CALL_KEY']
+    defines['REPEAT_KEY'] += 1
+    problems = symbols.check(defines)
+    assert len(problems) == 2
+    assert 'CALL_KEY is not defined' in problems
+    assert any(x.startswith('REPEAT_KEY is') for x in problems)
+
+
+def test_cache_follows_the_sources(tmp_path):
+    header = tmp_path / 'keys.h'
+    cache_path = str(tmp_path / symbols.CACHE_NAME)
+    header.write_text('#define CALL_KEY 245\n')
+    cache = symbols.SymbolCache(cache_path)
+    assert cache.file_symbols(str(header), {}) == {'CALL_KEY': 245}
+    cache.save()
+    # a new size, so the change is seen whatever the mtime resolution
+    header.write_text('#define CALL_KEY 5\n')
+    assert symbols.SymbolCache(cache_path).file_symbols(
+        str(header), {}) == {'CALL_KEY': 5}
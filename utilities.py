@@ -1,4 +1,4 @@
-from typing import List
+from typing import Callable, Iterator, List, Optional, TextIO
 import os
 
 
@@ -7,6 +7,15 @@ def get_lines(path: str) -> List[str]:
         return [x.replace('\n', '') for x in f.readlines()]  # remove \n at end
 
 
+def iter_lines(path: str) -> Iterator[str]:
+    '''
+    Yields the lines of `path` one at a time without the trailing \n
+    '''
+    with open(path, 'r') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
 def replace_line(lines: List[str], to_replace: str,
                  replacement: str) -> List[str]:
     result = []
@@ -23,15 +32,50 @@ def create_array_string(type_of_arr: str, name: str, value: str) -> str:
     return result
 
 
+def rewrite_line(file_path: str, to_replace: str,
+                 write_replacement: Callable[[TextIO], object]) -> bool:
+    '''
+    Streaming version of `replace_line` working on a file.
+    The first line starting with `to_replace` is replaced by whatever
+    `write_replacement` writes. The file is only replaced once the new content
+    is complete, so a failure leaves the original untouched.
+    Returns whether the file changed - an unchanged file keeps its mtime so
+    make does not rebuild it.
+    '''
+    import filecmp
+    tmp_path = file_path + '.tmp'
+    try:
+        with open(file_path, 'r') as src, open(tmp_path, 'w') as dst:
+            replaced = False
+            for line in src:
+                if not replaced and line.startswith(to_replace):
+                    write_replacement(dst)
+                    # keep the line ending of the replaced line
+                    dst.write(line[len(line.rstrip('\n')):])
+                    replaced = True
+                else:
+                    dst.write(line)
+        if filecmp.cmp(tmp_path, file_path, shallow=False):
+            return False
+        os.replace(tmp_path, file_path)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def write_file(file_path: str, new_content: str) -> str:
     with open(file_path, 'w') as f:
         f.write(new_content)
     return new_content
 
 
-def make(path: str) -> None:
+def make(path: str, jobs: Optional[int] = None, quiet: bool = False) -> None:
     '''
-    Go to `path` and run gnu make utility
+    Run gnu make utility in `path` with `jobs` parallel jobs
+    (one per cpu by default). `quiet` hides its output but not its errors.
     '''
-    os.chdir(path)
-    os.system('make')
+    import subprocess
+    jobs = jobs or os.cpu_count() or 1
+    subprocess.run(['make', f'-j{jobs}'], cwd=path, check=True,
+                   stdout=subprocess.DEVNULL if quiet else None)